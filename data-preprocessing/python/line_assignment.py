@@ -0,0 +1,232 @@
+"""
+Assign fixations to lines of text and correct vertical drift in reading data
+Course: Eye-tracking in Language Research
+
+Even with a drift check before every trial, fixations on multi-line texts tend to slowly move up or down, so
+some of them end up in the IA of the line above or below. This script moves every fixation to the line the
+participant was most likely reading, using the IAs of the trial (the IAREA messages or the .ias file that the
+reading template sends, see paragraph_mode). The algorithms are described in Carr et al. (2022), Algorithms for
+the automated correction of vertical drift in eye-tracking data, Behavior Research Methods:
+
+- attach: every fixation goes to the closest line
+- chain: consecutive fixations that are close together form a chain, and every chain goes to the closest line
+- regression: fits a line (slope, offset) through the fixations that best explains them as lines of text
+  (Cohen, 2013), corrects the fixations and then attaches them
+- warp: aligns the sequence of fixations to the sequence of words with dynamic time warping, and every
+  fixation goes to the line of its word
+
+The trials are corrected in parallel. Use it on the .asc version of the .EDF file:
+
+    python line_assignment.py et_results/pp_12/12.asc warp
+
+The result (12_lines.csv) has one row per fixation: TRIALID, start, end, x, y, line (1 = first line) and
+corrected_y (the y coordinate of that line), all in EDF coordinates.
+"""
+
+import csv
+import multiprocessing
+import os
+import sys
+
+import numpy
+
+
+methods = ['attach', 'chain', 'regression', 'warp']
+
+
+def read_trials(asc_file, eye = None):
+    """Read the fixations and the IAs of every trial of an .asc file
+
+    eye: 'L' or 'R', None = the first eye with fixations in the file
+    returns a list of dicts with trial_id, fixations (array: start, end, x, y) and ias (array: left, top, right, bottom)
+    """
+
+    folder = os.path.dirname(asc_file)
+    trials = []
+    trial = None
+    with open(asc_file) as f:
+        for line in f:
+            if line.startswith('MSG'):
+                fields = line.split(None, 2)
+                text = fields[2].strip() if len(fields) > 2 else ''
+                words = text.split()
+                if words and words[0].lstrip('-').isdigit(): # '<offset> <message>'
+                    words = words[1:]
+                if not words:
+                    continue
+                if words[0] == 'TRIALID':
+                    trial = {'trial_id': words[1] if len(words) > 1 else '', 'fixations': [], 'ias': []}
+                elif trial is None:
+                    continue
+                elif words[:3] == ['!V', 'IAREA', 'RECTANGLE'] and len(words) >= 8:
+                    trial['ias'].append([float(value) for value in words[4:8]])
+                elif words[:3] == ['!V', 'IAREA', 'FILE'] and len(words) >= 4:
+                    trial['ias'].extend(read_ias_file(os.path.join(folder, words[3])))
+                elif words[0] == 'TRIAL_RESULT':
+                    trials.append(trial)
+                    trial = None
+            elif line.startswith('EFIX') and trial is not None:
+                fields = line.split()
+                if eye is None:
+                    eye = fields[1]
+                if len(fields) < 7 or fields[1] != eye or '.' in fields[5:7]:
+                    continue
+                trial['fixations'].append([float(fields[2]), float(fields[3]), float(fields[5]), float(fields[6])])
+
+    for trial in trials:
+        trial['fixations'] = numpy.array(trial['fixations'], dtype = float).reshape(-1, 4)
+        trial['ias'] = numpy.array(trial['ias'], dtype = float).reshape(-1, 4)
+    return trials
+
+
+def read_ias_file(ias_file):
+    # IAs of an interest area file (RECTANGLE id left top right bottom label), as [left, top, right, bottom]
+    ias = []
+    with open(ias_file) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 6 and fields[0] == 'RECTANGLE':
+                ias.append([float(value) for value in fields[2:6]])
+    return ias
+
+
+def line_positions(ias):
+    # y coordinate of the middle of every line of text (IAs on the same line share their top and bottom)
+    return numpy.unique(numpy.round((ias[:, 1] + ias[:, 3]) / 2, 1))
+
+
+def attach(fixations, lines):
+    # index of the closest line for every fixation
+    return numpy.argmin(numpy.abs(fixations[:, 3, None] - lines[None, :]), axis = 1)
+
+
+def chain(fixations, lines, x_threshold = 20, y_threshold = 40):
+    # fixations closer than the thresholds (pixels) to the previous one form a chain, which goes to the closest line
+    if len(fixations) == 0:
+        return numpy.zeros(0, dtype = int)
+    dx = numpy.abs(numpy.diff(fixations[:, 2]))
+    dy = numpy.abs(numpy.diff(fixations[:, 3]))
+    new_chain = numpy.concatenate([[True], (dx > x_threshold) | (dy > y_threshold)])
+    chain_id = numpy.cumsum(new_chain) - 1
+    mean_y = numpy.bincount(chain_id, weights = fixations[:, 3]) / numpy.bincount(chain_id)
+    return numpy.argmin(numpy.abs(mean_y[:, None] - lines[None, :]), axis = 1)[chain_id]
+
+
+def regression(fixations, lines, slopes = numpy.linspace(-0.1, 0.1, 41), offsets = None, sd = 20):
+    """Fit y = y + slope * (x - x of the first fixation) + offset, so that the fixations fall on the lines as well as possible
+
+    All combinations of slope and offset are tried (all offsets at once); the best one maximises the likelihood of the fixations
+    under a mixture of normal distributions (one per line, standard deviation sd in pixels).
+    """
+
+    if len(fixations) == 0:
+        return numpy.zeros(0, dtype = int)
+    if offsets is None:
+        spacing = numpy.min(numpy.diff(lines)) if len(lines) > 1 else 2 * sd
+        offsets = numpy.linspace(-spacing, spacing, 41)
+    x = fixations[:, 2] - fixations[0, 2]
+    log_likelihood = numpy.empty((len(slopes), len(offsets)))
+    for i, slope in enumerate(slopes):
+        # offsets x fixations x lines, one slope at a time so that long passages do not fill the memory
+        corrected = fixations[None, :, 3] - slope * x[None, :] - offsets[:, None]
+        distance = numpy.min(numpy.abs(corrected[..., None] - lines), axis = -1)
+        log_likelihood[i] = -numpy.sum(distance ** 2, axis = -1) / (2 * sd ** 2)
+    best_slope, best_offset = numpy.unravel_index(numpy.argmax(log_likelihood), log_likelihood.shape)
+    corrected_y = fixations[:, 3] - slopes[best_slope] * x - offsets[best_offset]
+    return numpy.argmin(numpy.abs(corrected_y[:, None] - lines[None, :]), axis = 1)
+
+
+def warp(fixations, ias, lines):
+    """Align the fixations to the words (IAs in reading order) with dynamic time warping
+
+    The cost of matching a fixation with a word is their euclidean distance; every fixation is then assigned to
+    the line of the word it was matched with.
+    """
+
+    if len(fixations) == 0:
+        return numpy.zeros(0, dtype = int)
+    centres = numpy.column_stack([(ias[:, 0] + ias[:, 2]) / 2, (ias[:, 1] + ias[:, 3]) / 2])
+    word_line = numpy.argmin(numpy.abs(centres[:, 1, None] - lines[None, :]), axis = 1)
+    cost = numpy.hypot(fixations[:, 2, None] - centres[None, :, 0], fixations[:, 3, None] - centres[None, :, 1])
+    n, m = cost.shape
+    total = numpy.full((n + 1, m + 1), numpy.inf)
+    total[0, 0] = 0
+    for i in range(1, n + 1):
+        # a word can be matched with several fixations and a fixation with several words, so every cell depends on the
+        # row above and on the cell to its left: min over k <= j of (from_above[k] + cost of the words k+1..j)
+        from_above = numpy.minimum(total[i - 1, 1:], total[i - 1, :-1]) + cost[i - 1]
+        cumulative = numpy.cumsum(cost[i - 1])
+        total[i, 1:] = cumulative + numpy.minimum.accumulate(from_above - cumulative)
+    # walk back along the cheapest path, every fixation goes to the last word it was matched with
+    assigned = numpy.full(n, -1)
+    i, j = n, m
+    while i > 0 and j > 0:
+        if assigned[i - 1] < 0:
+            assigned[i - 1] = j - 1
+        step = numpy.argmin([total[i - 1, j - 1], total[i - 1, j], total[i, j - 1]])
+        if step == 0:
+            i, j = i - 1, j - 1
+        elif step == 1:
+            i -= 1
+        else:
+            j -= 1
+    return word_line[assigned]
+
+
+def assign_lines(trial, method = 'warp'):
+    """Assign the fixations of one trial to lines with one of the methods
+
+    returns an array with the index of the line of every fixation (0 = first line), -1 if the trial has no IAs
+    """
+
+    fixations = trial['fixations']
+    if len(trial['ias']) == 0:
+        return numpy.full(len(fixations), -1, dtype = int)
+    lines = line_positions(trial['ias'])
+    if method == 'attach':
+        return attach(fixations, lines)
+    if method == 'chain':
+        return chain(fixations, lines)
+    if method == 'regression':
+        return regression(fixations, lines)
+    if method == 'warp':
+        return warp(fixations, trial['ias'], lines)
+    raise ValueError('unknown method %s, use one of %s' % (method, ', '.join(methods)))
+
+
+def correct_trial(arguments):
+    # for the worker processes: (trial, method) -> (line of every fixation, corrected y)
+    trial, method = arguments
+    assigned = assign_lines(trial, method)
+    if len(trial['ias']) == 0:
+        return assigned, trial['fixations'][:, 3].copy()
+    lines = line_positions(trial['ias'])
+    return assigned, lines[assigned]
+
+
+def correct_file(asc_file, method = 'warp', output_file = None, processes = None):
+    """Assign the fixations of every trial in an .asc file to lines, in parallel, and save them in a .csv file
+
+    returns the path of the .csv file
+    """
+
+    trials = read_trials(asc_file)
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(correct_trial, [(trial, method) for trial in trials], chunksize = 16)
+
+    if output_file is None:
+        output_file = os.path.splitext(asc_file)[0] + '_lines.csv'
+    with open(output_file, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(['TRIALID', 'start', 'end', 'x', 'y', 'line', 'corrected_y'])
+        for trial, (assigned, corrected_y) in zip(trials, results):
+            for fixation, line, y in zip(trial['fixations'], assigned, corrected_y):
+                writer.writerow([trial['trial_id'], int(fixation[0]), int(fixation[1]), fixation[2], fixation[3], line + 1, y])
+    return output_file
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python line_assignment.py <file.asc> [%s] [output.csv]' % '|'.join(methods))
+        sys.exit(1)
+    print(correct_file(sys.argv[1], *sys.argv[2:4]))
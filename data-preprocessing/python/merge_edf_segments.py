@@ -0,0 +1,137 @@
+"""
+Merge the .EDF segments of a resumed session
+Course: Eye-tracking in Language Research
+
+When a session of the VWP or reading template is resumed after a crash or an abort, the data of that
+participant is split over several .EDF files (e.g., 12.EDF, 12_2.EDF, 12_3.EDF). The order of the files
+is saved in et_results/pp_<participant>/checkpoint.json.
+
+.EDF files are binary, so we merge their .asc versions. Convert every segment first with edf2asc
+(EyeLink Developers Kit), keeping the .asc file next to the .EDF file, and then run:
+
+    python merge_edf_segments.py et_results/pp_12/checkpoint.json
+
+The merged file (pp_12_merged.asc) keeps:
+- everything outside trials (header, calibration, validation) of every segment
+- every trial with a TRIAL_RESULT message, unless the same TRIALID is recorded again in a later segment
+  (the trial that was interrupted is run again when the session is resumed, so the later version wins)
+After the header of each segment there is a 'MSG <time> EDF_SEGMENT <file name>' line so you can still tell them apart.
+"""
+
+import json
+import os
+import sys
+
+
+def message_text(line):
+    # 'MSG\t<time> <text>' -> (time, text), None for any other line
+    if not line.startswith('MSG'):
+        return None
+    fields = line.split(None, 2)
+    if len(fields) < 3:
+        return None
+    return fields[1], fields[2].strip()
+
+
+def split_trials(lines):
+    """Split the lines of an .asc file into blocks
+
+    returns a list of (trial_id, complete, lines); trial_id is None for lines outside trials
+    a trial goes from its TRIALID message to its TRIAL_RESULT message (both included)
+    """
+
+    blocks = []
+    current = []
+    trial_id = None
+    for line in lines:
+        msg = message_text(line)
+        if msg is not None and msg[1].startswith('TRIALID'):
+            if current:
+                # a new trial starts before the previous one ended (e.g., crash during the trial)
+                blocks.append((trial_id, False, current))
+            current = [line]
+            trial_id = msg[1].split()[1] if len(msg[1].split()) > 1 else ''
+            continue
+        current.append(line)
+        if trial_id is not None and msg is not None and msg[1].startswith('TRIAL_RESULT'):
+            blocks.append((trial_id, True, current))
+            current = []
+            trial_id = None
+    if current:
+        blocks.append((trial_id, trial_id is None, current))
+    return blocks
+
+
+def merge_segments(asc_files):
+    """Merge the .asc files of the segments of one session, in recording order
+
+    asc_files: list of paths to the .asc files
+    returns the lines of the merged file
+    """
+
+    segments = []
+    for asc_file in asc_files:
+        with open(asc_file) as f:
+            segments.append(split_trials(f.readlines()))
+
+    # the last segment in which a trial is complete is the one we keep
+    keep_in = {}
+    for i, blocks in enumerate(segments):
+        for trial_id, complete, _ in blocks:
+            if trial_id is not None and complete:
+                keep_in[trial_id] = i
+
+    merged = []
+    for i, blocks in enumerate(segments):
+        name = os.path.splitext(os.path.basename(asc_files[i]))[0]
+        first_time = None
+        for _, _, block_lines in blocks:
+            for line in block_lines:
+                fields = line.split()
+                if len(fields) > 1 and fields[0] in ('MSG', 'START') and fields[1].isdigit():
+                    first_time = fields[1]
+                    break
+            if first_time is not None:
+                break
+        segment_lines = []
+        for trial_id, complete, block_lines in blocks:
+            if trial_id is None or (complete and keep_in.get(trial_id) == i):
+                segment_lines.extend(block_lines)
+        # the marker goes right after the header of the segment (lines starting with '**')
+        header_end = 0
+        while header_end < len(segment_lines) and segment_lines[header_end].startswith('**'):
+            header_end += 1
+        segment_lines.insert(header_end, 'MSG\t%s EDF_SEGMENT %s\n' % (first_time or '0', name))
+        merged.extend(segment_lines)
+    return merged
+
+
+def merge_session(checkpoint_file, output_file = None):
+    """Merge the segments listed in the checkpoint of a session (see the templates in experimental-scripts)
+
+    The .asc files are looked for next to the checkpoint, with the same name as the .EDF files
+    returns the path of the merged file
+    """
+
+    with open(checkpoint_file) as f:
+        checkpoint = json.load(f)
+    folder = os.path.dirname(checkpoint_file)
+    asc_files = []
+    for edf_file in checkpoint['edf_segments']:
+        asc_file = os.path.join(folder, os.path.splitext(edf_file)[0] + '.asc')
+        if not os.path.isfile(asc_file):
+            raise FileNotFoundError('%s not found, convert %s with edf2asc first' % (asc_file, edf_file))
+        asc_files.append(asc_file)
+
+    if output_file is None:
+        output_file = os.path.join(folder, 'pp_%s_merged.asc' % checkpoint['participant'])
+    with open(output_file, 'w') as f:
+        f.writelines(merge_segments(asc_files))
+    return output_file
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python merge_edf_segments.py <checkpoint.json> [output.asc]')
+        sys.exit(1)
+    print(merge_session(*sys.argv[1:3]))
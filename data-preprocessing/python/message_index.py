@@ -0,0 +1,207 @@
+"""
+Index the messages of a recording, to find trials and events without going through the whole file
+Course: Eye-tracking in Language Research
+
+Every analysis needs the same messages: TRIALID, preview_onset / text_onset, target_onset, TRIAL_RESULT and
+the !V TRIAL_VAR messages. Instead of reading the whole .asc file every time, build an index once:
+
+    python message_index.py et_results/pp_12/12.asc
+
+This saves, next to the .asc file:
+- 12_samples.npy: the samples (time, x, y and pupil of the left and the right eye; NaN if missing)
+- 12_index.npz: every message with its time (corrected for the '<offset> <message>' form the templates use),
+  its trial and the position of the first sample at or after it
+
+Then, for example:
+
+    index = RecordingIndex('et_results/pp_12/12')
+    samples = index.trial_samples('3')                                   # samples of TRIALID 3
+    epochs, trial_ids = index.epochs('target_onset', before = 200, after = 1000)  # trials x samples x columns
+    index.trial_vars()['3']['RT']
+
+The samples are memory-mapped (only the parts you use are read from the disk) and every search is a binary
+search (numpy.searchsorted) in the sorted times.
+"""
+
+import os
+import sys
+
+import numpy
+
+
+sample_columns = ['time', 'x_left', 'y_left', 'pupil_left', 'x_right', 'y_right', 'pupil_right']
+
+
+def message_parts(line):
+    # 'MSG\t<time> [<offset>] <text>' -> (time at which the message was meant, text), None for any other line
+    fields = line.split(None, 2)
+    if len(fields) < 3 or fields[0] != 'MSG':
+        return None
+    time = float(fields[1])
+    text = fields[2].strip()
+    first = text.split(None, 1)
+    if len(first) == 2 and first[0].lstrip('-').isdigit():
+        time -= float(first[0])
+        text = first[1]
+    return time, text
+
+
+def recorded_eyes(asc_file):
+    # which eyes are in the samples, from the first SAMPLES line
+    with open(asc_file) as f:
+        for line in f:
+            if line.startswith('SAMPLES'):
+                return [eye for eye in ['LEFT', 'RIGHT'] if eye in line.split()]
+    return ['LEFT']
+
+
+def sample_values(fields, eyes):
+    # the fields of a sample line -> time, x, y, pupil (left) and x, y, pupil (right)
+    values = [numpy.nan] * 7
+    values[0] = float(fields[0])
+    targets = [1, 2, 3, 4, 5, 6] if len(eyes) == 2 else ([1, 2, 3] if eyes == ['LEFT'] else [4, 5, 6])
+    for column, target in enumerate(targets, start = 1):
+        if column < len(fields) and fields[column] != '.':
+            try:
+                values[target] = float(fields[column])
+            except ValueError:
+                pass
+    return values
+
+
+def build_index(asc_file, prefix = None, chunk_size = 100000):
+    """Save the samples (.npy) and the message index (.npz) of an .asc file
+
+    The file is read twice (first to count the samples), so the memory needed does not grow with the recording.
+    returns the prefix of the saved files (e.g., et_results/pp_12/12)
+    """
+
+    if prefix is None:
+        prefix = os.path.splitext(asc_file)[0]
+    eyes = recorded_eyes(asc_file)
+    with open(asc_file) as f:
+        nr_samples = sum(1 for line in f if line[:1].isdigit())
+
+    samples = numpy.lib.format.open_memmap(prefix + '_samples.npy', mode = 'w+', dtype = numpy.float64, shape = (nr_samples, 7))
+    message_time = []
+    message_type = []
+    message_text = []
+    message_trial = []
+    trial_id = ''
+    written = 0
+    rows = []
+    with open(asc_file) as f:
+        for line in f:
+            if line[:1].isdigit():
+                rows.append(sample_values(line.split(), eyes))
+                if len(rows) == chunk_size:
+                    samples[written:written + len(rows)] = rows
+                    written += len(rows)
+                    rows = []
+            elif line.startswith('MSG'):
+                parts = message_parts(line)
+                if parts is None:
+                    continue
+                time, text = parts
+                words = text.split()
+                if not words:
+                    continue
+                if words[0] == 'TRIALID':
+                    trial_id = words[1] if len(words) > 1 else ''
+                kind = 'TRIAL_VAR' if words[:2] == ['!V', 'TRIAL_VAR'] else words[0]
+                message_time.append(time)
+                message_type.append(kind)
+                message_text.append(text)
+                message_trial.append(trial_id)
+                if kind == 'TRIAL_RESULT':
+                    trial_id = ''
+    samples[written:written + len(rows)] = rows
+    samples.flush()
+
+    message_time = numpy.array(message_time, dtype = numpy.float64)
+    order = numpy.argsort(message_time, kind = 'stable') # messages sent with an offset can be out of order
+    numpy.savez(prefix + '_index.npz',
+                time = message_time[order],
+                sample = numpy.searchsorted(samples[:, 0], message_time[order]),
+                type = numpy.array(message_type, dtype = str)[order],
+                trial = numpy.array(message_trial, dtype = str)[order],
+                text = numpy.array(message_text, dtype = str)[order],
+                eyes = numpy.array(eyes))
+    return prefix
+
+
+class RecordingIndex:
+    """Samples and message index of one recording (see build_index)"""
+
+    def __init__(self, prefix):
+        self.samples = numpy.load(prefix + '_samples.npy', mmap_mode = 'r')
+        index = numpy.load(prefix + '_index.npz')
+        self.time = index['time']
+        self.sample = index['sample']
+        self.type = index['type']
+        self.trial = index['trial']
+        self.text = index['text']
+        self.sample_time = self.samples[:, 0]
+        # first and last message of every trial
+        starts = numpy.flatnonzero(self.type == 'TRIALID')
+        ends = numpy.flatnonzero(self.type == 'TRIAL_RESULT')
+        self.trials = {}
+        for start, end in zip(starts, numpy.searchsorted(ends, starts)):
+            if end < len(ends) and self.trial[ends[end]] == self.trial[start]:
+                end = ends[end]
+                self.trials[self.trial[start]] = (self.sample[start], self.sample[end], self.time[start], self.time[end])
+
+    def messages(self, message_type, trial_id = None):
+        # times and sample positions of every message of a type (e.g., 'target_onset'), optionally of one trial only
+        selected = self.type == message_type
+        if trial_id is not None:
+            selected &= self.trial == str(trial_id)
+        return self.time[selected], self.sample[selected], self.trial[selected]
+
+    def trial_samples(self, trial_id):
+        # the samples between TRIALID and TRIAL_RESULT of a trial (a view, nothing is copied)
+        first, last, _, _ = self.trials[str(trial_id)]
+        return self.samples[first:last]
+
+    def time_slice(self, start_time, end_time):
+        # the samples between two times (ms, tracker clock)
+        first, last = numpy.searchsorted(self.sample_time, [start_time, end_time])
+        return self.samples[first:last]
+
+    def epochs(self, message_type, before = 0, after = 1000, columns = None):
+        """Samples around every message of a type, e.g., from 200 ms before to 1000 ms after target_onset
+
+        returns (epochs, trial ids): epochs is an array trials x time points x columns, with time points every
+        sample from -before to +after ms (time 0 = the message, NaN where there are no samples, e.g., between recordings)
+        """
+
+        times, _, trial_ids = self.messages(message_type)
+        if columns is None:
+            columns = list(range(1, self.samples.shape[1]))
+        step = numpy.median(numpy.diff(self.sample_time[:1000])) if len(self.sample_time) > 1 else 1.0
+        offsets = numpy.arange(-before, after + step / 2, step)
+        wanted = times[:, None] + offsets[None, :]
+        positions = numpy.searchsorted(self.sample_time, wanted)
+        positions = numpy.minimum(positions, len(self.sample_time) - 1)
+        found = numpy.abs(self.sample_time[positions] - wanted) < step / 2
+        epochs = numpy.full(wanted.shape + (len(columns),), numpy.nan)
+        epochs[found] = self.samples[positions[found]][:, columns]
+        return epochs, trial_ids
+
+    def trial_vars(self):
+        # {trial id: {variable: value}} from the !V TRIAL_VAR messages (values are text)
+        trial_vars = {}
+        for trial_id, text in zip(self.trial[self.type == 'TRIAL_VAR'], self.text[self.type == 'TRIAL_VAR']):
+            fields = text.split(None, 3)
+            if len(fields) >= 3:
+                trial_vars.setdefault(trial_id, {})[fields[2]] = fields[3] if len(fields) > 3 else ''
+        return trial_vars
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python message_index.py <file.asc>')
+        sys.exit(1)
+    prefix = build_index(sys.argv[1])
+    index = RecordingIndex(prefix)
+    print('%s: %d samples, %d messages, %d trials' % (prefix, len(index.samples), len(index.time), len(index.trials)))
@@ -0,0 +1,245 @@
+"""
+Detect microsaccades in the raw samples (Engbert & Kliegl, 2003)
+Course: Eye-tracking in Language Research
+
+The EyeLink parser finds saccades with fixed velocity and acceleration thresholds, which miss most
+microsaccades. This script finds them in the samples of the .asc file, as in Engbert & Kliegl (2003),
+Microsaccades uncover the orientation of covert attention, Vision Research:
+
+- the velocity is computed over 5 samples: (x[n+2] + x[n+1] - x[n-1] - x[n-2]) / (6 * sample duration),
+  as a convolution over the whole array
+- the threshold is threshold_factor times a median-based estimate of the standard deviation of the velocity
+  (separately for x and y, so it adapts to the noise of every trial and participant)
+- a microsaccade is at least min_duration ms above the threshold
+- with both eyes recorded, only microsaccades that overlap in time in both eyes are kept (binocular = True)
+
+The samples are read in chunks (trials, cut into pieces of at most chunk_size samples), so whole sessions
+can be processed with little memory. detect() works on arrays you already have (batch); MicrosaccadeDetector
+can be fed samples as they come (streaming) and returns the microsaccades that are complete.
+
+    python microsaccades.py et_results/pp_12/12.asc
+
+The result (12_microsaccades.csv) has one row per microsaccade: TRIALID, eye (L, R or LR), start, end
+(tracker time, ms), peak velocity (pixels/s) and amplitude (pixels).
+"""
+
+import csv
+import os
+import sys
+
+import numpy
+
+
+velocity_kernel = numpy.array([1, 1, 0, -1, -1]) / 6.0
+
+
+def velocity(position, sampling_rate):
+    # velocity over 5 samples (pixels/s), NaN for the first and last two samples and around missing data
+    v = numpy.full(len(position), numpy.nan)
+    if len(position) >= 5:
+        v[2:-2] = numpy.convolve(position, velocity_kernel, mode = 'valid') * sampling_rate
+    return v
+
+
+def median_threshold(v, threshold_factor):
+    # threshold_factor times the median-based standard deviation of the velocity
+    sd = numpy.sqrt(numpy.nanmedian(v ** 2) - numpy.nanmedian(v) ** 2)
+    return threshold_factor * max(sd, 1e-10)
+
+
+def detect_eye(x, y, sampling_rate, threshold_factor = 6, min_duration = 6, thresholds = None):
+    """Microsaccades of one eye
+
+    thresholds: (x, y) velocity thresholds to use, None = computed from these samples
+    returns an array with one row per microsaccade: first sample, last sample + 1, peak velocity, amplitude
+    """
+
+    vx = velocity(x, sampling_rate)
+    vy = velocity(y, sampling_rate)
+    if thresholds is None:
+        if numpy.all(numpy.isnan(vx)):
+            return numpy.zeros((0, 4))
+        thresholds = (median_threshold(vx, threshold_factor), median_threshold(vy, threshold_factor))
+    above = (vx / thresholds[0]) ** 2 + (vy / thresholds[1]) ** 2 > 1 # NaN is never above
+    change = numpy.diff(numpy.concatenate([[0], above.astype(numpy.int8), [0]]))
+    starts = numpy.flatnonzero(change == 1)
+    ends = numpy.flatnonzero(change == -1)
+    keep = ends - starts >= max(1, int(round(min_duration * sampling_rate / 1000.0)))
+    starts, ends = starts[keep], ends[keep]
+    if len(starts) == 0:
+        return numpy.zeros((0, 4))
+    speed = numpy.hypot(vx, vy)
+    speed[numpy.isnan(speed)] = 0
+    peaks = numpy.maximum.reduceat(numpy.append(speed, 0), numpy.column_stack([starts, ends]).ravel())[::2]
+    amplitudes = numpy.hypot(x[ends - 1] - x[starts], y[ends - 1] - y[starts])
+    return numpy.column_stack([starts, ends, peaks, amplitudes])
+
+
+def binocular_overlap(left, right):
+    # for every microsaccade in left, the index of the overlapping one in right (-1 if there is none)
+    if len(left) == 0 or len(right) == 0:
+        return numpy.full(len(left), -1)
+    # the last microsaccade of the right eye that starts before the left one ends, does it end after it starts?
+    candidate = numpy.searchsorted(right[:, 0], left[:, 1]) - 1
+    overlaps = (candidate >= 0) & (right[numpy.maximum(candidate, 0), 1] > left[:, 0])
+    return numpy.where(overlaps, candidate, -1)
+
+
+def detect(samples, sampling_rate, threshold_factor = 6, min_duration = 6, binocular = True):
+    """Microsaccades in an array of samples (batch)
+
+    samples: array with columns time, x left, y left, x right, y right (NaN for an eye that was not recorded)
+    returns a list of (eye, start time, end time, peak velocity, amplitude); binocular microsaccades have eye 'LR',
+    with the earliest start, the latest end, the highest peak velocity and the mean amplitude of both eyes
+    """
+
+    time = samples[:, 0]
+    eyes = {}
+    for eye, columns in [('L', (1, 2)), ('R', (3, 4))]:
+        if not numpy.all(numpy.isnan(samples[:, columns[0]])):
+            eyes[eye] = detect_eye(samples[:, columns[0]], samples[:, columns[1]], sampling_rate, threshold_factor, min_duration)
+
+    found = []
+    if binocular and len(eyes) == 2:
+        left, right = eyes['L'], eyes['R']
+        match = binocular_overlap(left, right)
+        for ms, other in zip(left[match >= 0], right[match[match >= 0]]):
+            start = int(min(ms[0], other[0]))
+            end = int(max(ms[1], other[1]))
+            found.append(('LR', time[start], time[end - 1], max(ms[2], other[2]), (ms[3] + other[3]) / 2))
+    else:
+        for eye, events in eyes.items():
+            for ms in events:
+                found.append((eye, time[int(ms[0])], time[int(ms[1]) - 1], ms[2], ms[3]))
+    found.sort(key = lambda ms: ms[1])
+    return found
+
+
+class MicrosaccadeDetector:
+    """Find microsaccades in samples that come in pieces (streaming)
+
+    feed() takes the next samples (same columns as detect) and returns the microsaccades that are complete;
+    the last samples are kept, because a microsaccade can continue in the next piece. The thresholds are computed
+    for every piece, so pieces should be long enough to estimate the noise (e.g., one second or more).
+    Call flush() after the last samples.
+    """
+
+    def __init__(self, sampling_rate, threshold_factor = 6, min_duration = 6, binocular = True, max_kept = 200):
+        self.sampling_rate = sampling_rate
+        self.threshold_factor = threshold_factor
+        self.min_duration = min_duration
+        self.binocular = binocular
+        self.max_kept = max_kept # samples kept from one piece to the next, so the memory stays bounded
+        self.kept = numpy.zeros((0, 5))
+        self.reported_until = -numpy.inf
+
+    def feed(self, samples, final = False):
+        buffer = numpy.concatenate([self.kept, samples]) if len(self.kept) else samples
+        found = detect(buffer, self.sampling_rate, self.threshold_factor, self.min_duration, self.binocular)
+        # the velocity of the last two samples is not known yet: what touches them may still go on
+        complete_until = buffer[-1, 0] if final else buffer[max(len(buffer) - 3, 0), 0]
+        complete = [ms for ms in found if ms[1] > self.reported_until and ms[2] < complete_until]
+        if complete:
+            self.reported_until = complete[-1][2]
+        open_starts = [ms[1] for ms in found if ms[2] >= complete_until]
+        keep_from = max(len(buffer) - self.max_kept, 0)
+        if open_starts:
+            keep_from = max(keep_from, min(int(numpy.searchsorted(buffer[:, 0], open_starts[0])) - 2, len(buffer) - 4))
+        else:
+            keep_from = max(keep_from, len(buffer) - 4)
+        self.kept = buffer[max(keep_from, 0):]
+        return complete
+
+    def flush(self):
+        if len(self.kept) == 0:
+            return []
+        complete = self.feed(numpy.zeros((0, 5)), final = True)
+        self.kept = numpy.zeros((0, 5))
+        return complete
+
+
+def sampling_info(asc_file):
+    # sampling rate and recorded eyes, from the first SAMPLES line of the .asc file
+    with open(asc_file) as f:
+        for line in f:
+            if line.startswith('SAMPLES'):
+                fields = line.split()
+                rate = float(fields[fields.index('RATE') + 1]) if 'RATE' in fields else 1000.0
+                return rate, [eye for eye in ['LEFT', 'RIGHT'] if eye in fields]
+    return 1000.0, ['LEFT']
+
+
+def iter_trial_samples(asc_file, chunk_size = 100000):
+    """Read the samples of every trial in pieces of at most chunk_size samples
+
+    yields (trial id, samples, last piece of the trial); samples has the columns time, x left, y left, x right,
+    y right (NaN for missing data and for the eye that was not recorded)
+    """
+
+    _, eyes = sampling_info(asc_file)
+    binocular = len(eyes) == 2
+    columns = [1, 2, 4, 5] if binocular else [1, 2]
+    target = [1, 2, 3, 4] if binocular else ([1, 2] if eyes == ['LEFT'] else [3, 4])
+    trial_id = None
+    rows = []
+
+    def piece(rows):
+        values = numpy.full((len(rows), 5), numpy.nan)
+        fields = [row.split() for row in rows]
+        values[:, 0] = [float(field[0]) for field in fields]
+        for column, to in zip(columns, target):
+            values[:, to] = [float(field[column]) if len(field) > column and field[column] != '.' else numpy.nan for field in fields]
+        return values
+
+    with open(asc_file) as f:
+        for line in f:
+            if line[:1].isdigit():
+                if trial_id is not None:
+                    rows.append(line)
+                    if len(rows) >= chunk_size:
+                        yield trial_id, piece(rows), False
+                        rows = []
+            elif line.startswith('MSG'):
+                words = line.split()[2:]
+                if words and words[0].lstrip('-').isdigit(): # '<offset> <message>'
+                    words = words[1:]
+                if words[:1] == ['TRIALID']:
+                    trial_id = words[1] if len(words) > 1 else ''
+                    rows = []
+                elif words[:1] == ['TRIAL_RESULT'] and trial_id is not None:
+                    yield trial_id, piece(rows), True
+                    trial_id = None
+                    rows = []
+
+
+def detect_file(asc_file, output_file = None, chunk_size = 100000, **parameters):
+    """Find the microsaccades of every trial in an .asc file and save them in a .csv file
+
+    parameters: threshold_factor, min_duration, binocular (see detect)
+    returns the path of the .csv file
+    """
+
+    sampling_rate, _ = sampling_info(asc_file)
+    if output_file is None:
+        output_file = os.path.splitext(asc_file)[0] + '_microsaccades.csv'
+    with open(output_file, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(['TRIALID', 'eye', 'start', 'end', 'peak_velocity', 'amplitude'])
+        detector = None
+        for trial_id, samples, last in iter_trial_samples(asc_file, chunk_size):
+            if detector is None:
+                detector = MicrosaccadeDetector(sampling_rate, **parameters)
+            found = detector.feed(samples) if len(samples) else []
+            if last:
+                found += detector.flush()
+                detector = None
+            for eye, start, end, peak, amplitude in found:
+                writer.writerow([trial_id, eye, int(start), int(end), round(peak, 1), round(amplitude, 2)])
+    return output_file
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python microsaccades.py <file.asc> [output.csv]')
+        sys.exit(1)
+    print(detect_file(*sys.argv[1:3]))
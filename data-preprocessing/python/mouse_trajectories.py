@@ -0,0 +1,130 @@
+"""
+Read the mouse trajectories of the VWP template and compute curvature measures
+Course: Eye-tracking in Language Research
+
+In task mode (task_look = 'task'), the VWP template records the position of the mouse from target_onset until
+the click and saves it in et_results/pp_<participant>/<edf name>_mouse.bin. Every trial is saved as two int32
+(TRIALID, number of samples) followed by the samples as float32: time (ms, 0 = end of the target, the same zero
+as RT), x and y (pixels, 0, 0 = centre of the screen, y goes up).
+
+The measures are computed for all trials at once, on the part of the trajectory after the end of the target
+(when the mouse is visible and starts at the centre of the screen), compared to the straight line from the
+first to the last sample:
+- md: maximum deviation (pixels, positive = to the left of the straight line when moving towards the click)
+- auc: area under the curve, between the trajectory and the straight line (pixels²)
+- x_flips: number of changes of direction along the x-axis
+
+The VWP template computes the same measures online with trajectory_metrics from this file (mouse_md, mouse_auc,
+mouse_x_flips in the behavioural file), so they always agree with the ones computed here.
+
+    python mouse_trajectories.py et_results/pp_12/12_mouse.bin [output.csv]
+"""
+
+import csv
+import os
+import sys
+
+import numpy
+
+
+def read_trajectories(mouse_file):
+    """Read a mouse sidecar file
+
+    returns (trial_ids, trajectories): trial_ids is an int array, trajectories a float32 array
+    (trials x samples x [time, x, y]) padded with NaN after the last sample of each trial
+    """
+
+    raw = numpy.fromfile(mouse_file, dtype = numpy.float32)
+    as_int = raw.view(numpy.int32)
+    # walk over the trial headers, the samples themselves are not copied until the end
+    starts = []
+    lengths = []
+    trial_ids = []
+    position = 0
+    # a trial that was cut (e.g., the STIM PC crashed while writing), in its header or in its samples, is left out
+    while position + 2 <= len(raw):
+        length = int(as_int[position + 1])
+        if length < 0 or position + 2 + 3 * length > len(raw):
+            break
+        trial_ids.append(int(as_int[position]))
+        lengths.append(length)
+        starts.append(position + 2)
+        position += 2 + 3 * length
+
+    trajectories = numpy.full((len(lengths), max(lengths, default = 0), 3), numpy.nan, dtype = numpy.float32)
+    for i, (start, length) in enumerate(zip(starts, lengths)):
+        trajectories[i, :length] = raw[start:start + 3 * length].reshape(length, 3)
+    return numpy.array(trial_ids, dtype = int), trajectories
+
+
+def trajectory_metrics(trajectories, from_time = 0):
+    """Maximum deviation, area under the curve and x-flips of every trajectory (see the top of this file)
+
+    trajectories: trials x samples x [time, x, y], padded with NaN (see read_trajectories)
+    from_time: samples before this time (ms) are left out
+    returns a dict of arrays (one value per trial)
+    """
+
+    t = trajectories[:, :, 0].astype(float)
+    x = trajectories[:, :, 1].astype(float)
+    y = trajectories[:, :, 2].astype(float)
+    valid = ~numpy.isnan(t) & (t >= from_time)
+    x = numpy.where(valid, x, numpy.nan)
+    y = numpy.where(valid, y, numpy.nan)
+    nr_trials = len(trajectories)
+    has_samples = valid.any(axis = 1)
+
+    # first and last valid sample of every trial
+    first = numpy.argmax(valid, axis = 1)
+    last = valid.shape[1] - 1 - numpy.argmax(valid[:, ::-1], axis = 1)
+    rows = numpy.arange(nr_trials)
+    x0, y0 = x[rows, first][:, None], y[rows, first][:, None]
+    dx = x[rows, last][:, None] - x0
+    dy = y[rows, last][:, None] - y0
+    length = numpy.hypot(dx, dy)
+    length[length == 0] = numpy.nan
+
+    # position of every sample along and across the straight line
+    along = ((x - x0) * dx + (y - y0) * dy) / length
+    across = (dx * (y - y0) - dy * (x - x0)) / length
+    abs_across = numpy.where(numpy.isnan(across), -1, numpy.abs(across))
+    md = across[rows, numpy.argmax(abs_across, axis = 1)]
+    segments = (across[:, 1:] + across[:, :-1]) * numpy.diff(along, axis = 1) / 2
+    auc = numpy.nansum(segments, axis = 1)
+    auc[numpy.isnan(md)] = numpy.nan
+
+    # x-flips: changes of sign of the steps along the x-axis, ignoring steps without movement
+    direction = numpy.sign(numpy.diff(x, axis = 1))
+    direction[numpy.isnan(direction)] = 0
+    moving = direction != 0
+    # carry the last direction forward over the steps without movement, then count the changes
+    index = numpy.where(moving, numpy.arange(direction.shape[1]), 0)
+    numpy.maximum.accumulate(index, axis = 1, out = index)
+    carried = numpy.take_along_axis(direction, index, axis = 1)
+    x_flips = numpy.sum(moving[:, 1:] & (carried[:, 1:] != carried[:, :-1]) & (carried[:, :-1] != 0), axis = 1)
+
+    md[~has_samples] = numpy.nan
+    auc[~has_samples] = numpy.nan
+    return {'md': md, 'auc': auc, 'x_flips': x_flips}
+
+
+def save_metrics(mouse_file, output_file = None):
+    # compute the measures of every trial in mouse_file and save them in a .csv file, returns its path
+    trial_ids, trajectories = read_trajectories(mouse_file)
+    metrics = trajectory_metrics(trajectories)
+    if output_file is None:
+        output_file = os.path.splitext(mouse_file)[0] + '_metrics.csv'
+    with open(output_file, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(['TRIALID', 'nr_samples', 'mouse_md', 'mouse_auc', 'mouse_x_flips'])
+        nr_samples = numpy.sum(~numpy.isnan(trajectories[:, :, 0]), axis = 1)
+        for row in zip(trial_ids, nr_samples, metrics['md'], metrics['auc'], metrics['x_flips']):
+            writer.writerow(row)
+    return output_file
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python mouse_trajectories.py <mouse .bin file> [output.csv]')
+        sys.exit(1)
+    print(save_metrics(*sys.argv[1:3]))
@@ -0,0 +1,64 @@
+"""
+Look up sessions in the participant registry
+Course: Eye-tracking in Language Research
+
+The VWP and reading templates register every session in participants.sqlite (next to the script): the
+participant number, the segment (resumed sessions have more than one), the name of the .EDF file (the Host PC
+only allows 8 characters, so long participant numbers get a P0000001-like name), the status of the session
+(running, aborted, finished) and some metadata (files, screen size, order seed).
+
+Use this to find the files of a participant, or the participant of an .EDF file:
+
+    python participant_registry.py participants.sqlite            # all sessions
+    python participant_registry.py participants.sqlite 12         # sessions of participant 12
+    python participant_registry.py participants.sqlite P0000003   # session saved as P0000003.EDF
+"""
+
+import json
+import sqlite3
+import sys
+
+
+def read_sessions(registry_file, participant = None, edf_name = None, experiment = None):
+    """Read the sessions in the registry
+
+    participant, edf_name, experiment: only return the sessions that match (None = all)
+    returns a list of dicts, sorted by experiment, participant and segment; metadata is already decoded
+    """
+
+    query = 'SELECT * FROM sessions WHERE 1 = 1'
+    values = []
+    for column, value in [('participant', participant), ('edf_name', edf_name), ('experiment', experiment)]:
+        if value is not None:
+            query += ' AND %s = ?' % column
+            values.append(str(value))
+    query += ' ORDER BY experiment, participant, segment'
+
+    # read-only, so we never lock a registry that an experiment is using
+    connection = sqlite3.connect('file:%s?mode=ro' % registry_file, uri = True)
+    connection.row_factory = sqlite3.Row
+    try:
+        sessions = [dict(row) for row in connection.execute(query, values)]
+    finally:
+        connection.close()
+    for session in sessions:
+        session['metadata'] = json.loads(session['metadata']) if session['metadata'] else {}
+    return sessions
+
+
+def edf_participants(registry_file):
+    # .EDF name -> (experiment, participant, segment), handy when going through a folder of .EDF files
+    return {session['edf_name']: (session['experiment'], session['participant'], session['segment'])
+            for session in read_sessions(registry_file)}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python participant_registry.py <participants.sqlite> [participant number or EDF name]')
+        sys.exit(1)
+    sessions = read_sessions(sys.argv[1])
+    if len(sys.argv) > 2:
+        sessions = [session for session in sessions if sys.argv[2] in (session['participant'], session['edf_name'])]
+    for session in sessions:
+        print('%s\t%s\t%d\t%s.EDF\t%s\t%s' % (session['experiment'], session['participant'], session['segment'],
+                                             session['edf_name'], session['status'], session['started']))
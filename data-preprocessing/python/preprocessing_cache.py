@@ -0,0 +1,410 @@
+"""
+Preprocess eye-tracking data in stages, and only redo the stages that changed
+Course: Eye-tracking in Language Research
+
+Preprocessing a VWP study goes through the same stages for every participant:
+
+- parse: read the samples, fixations, blinks, messages and IAs of the .asc file
+- events: the fixations (from the EyeLink parser, or with a velocity threshold on the samples)
+- aoi: the IA of every fixation (from the !V IAREA RECTANGLE messages of the trial)
+- binning: the proportion of every time bin (relative to target_onset) spent on every IA
+- pupil: the pupil size without blinks, interpolated, with a baseline per trial
+
+Every result is saved in a cache folder, named after the content of the .asc file (a hash), the parameters of
+the stage and the stages it uses. When you change a parameter, only that stage and the stages that depend on it
+are computed again: a new bin_width only redoes the binning, a new blink_padding only the pupil, and participants
+whose files did not change are only loaded. The parameters are a .json file with the values you want to change:
+
+    {"binning": {"bin_width": 20, "window": [-200, 1500]}, "pupil": {"baseline": 500}}
+
+    python preprocessing_cache.py preprocessing_cache parameters.json et_results/*/*.asc
+
+The results of every set of parameters are kept, so going back to earlier parameters only loads them again.
+To remove the results that the current parameters and files do not use any more:
+
+    python preprocessing_cache.py --prune preprocessing_cache parameters.json et_results/*/*.asc
+
+or, in Python:
+
+    pipeline = Pipeline('preprocessing_cache', {'binning': {'bin_width': 20}})
+    results, computed = pipeline.run('et_results/pp_12/12.asc')
+    results['binning']['proportion']
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+import sys
+
+import numpy
+
+from message_index import message_parts
+from microsaccades import sampling_info, velocity
+
+
+# change cache_version when a stage is changed, so that old results are not used any more
+cache_version = 2
+
+default_parameters = {
+    'parse': {'eye': None}, # 'LEFT' or 'RIGHT', None = the first recorded eye
+    'events': {'method': 'eyelink', 'min_fixation': 50, 'velocity_threshold': 1500}, # method 'eyelink' or 'velocity' (pixels/s)
+    'aoi': {'margin': 0}, # pixels added around every IA
+    'binning': {'time_zero': 'target_onset', 'bin_width': 50, 'window': [-200, 2000]}, # ms
+    'pupil': {'blink_padding': 100, 'max_gap': 300, 'baseline_message': 'target_onset', 'baseline': 200}, # ms
+}
+
+# the stages in the order in which they run, with the stages they use
+stages = [('parse', []),
+          ('events', ['parse']),
+          ('aoi', ['parse', 'events']),
+          ('binning', ['parse', 'aoi']),
+          ('pupil', ['parse'])]
+
+
+def file_hash(path, block_size = 1 << 20):
+    # sha1 of the content of a file, read in blocks
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def parse(asc_file, eye = None):
+    """Samples (time, x, y, pupil of one eye), fixations, blinks, messages and IAs of an .asc file
+
+    Trials are numbered in the order they were recorded (their index in trials), because a TRIALID can be used
+    more than once (e.g., practice trials); fixations, messages and IAs refer to that index, not to the TRIALID.
+    """
+
+    _, eyes = sampling_info(asc_file)
+    eye = eye or eyes[0]
+    column = 1 if len(eyes) == 1 or eye == 'LEFT' else 4
+    samples = []
+    fixations = []
+    fixation_trials = []
+    blinks = []
+    messages = []
+    trials = []
+    ias = []
+    trial_id = None
+    with open(asc_file) as f:
+        for line in f:
+            if line[:1].isdigit():
+                fields = line.split()
+                samples.append([float(fields[0])] + [float(value) if value != '.' else numpy.nan for value in fields[column:column + 3]])
+            elif line.startswith('EFIX') or line.startswith('EBLINK'):
+                fields = line.split()
+                if fields[1] != eye[0] or trial_id is None:
+                    continue
+                if fields[0] == 'EBLINK':
+                    blinks.append([float(fields[2]), float(fields[3])])
+                elif '.' not in fields[5:7]:
+                    fixations.append([float(fields[2]), float(fields[3]), float(fields[5]), float(fields[6])])
+                    fixation_trials.append(len(trials) - 1)
+            elif line.startswith('MSG'):
+                parts = message_parts(line)
+                if parts is None:
+                    continue
+                time, text = parts
+                words = text.split()
+                if words[:1] == ['TRIALID']:
+                    trial_id = words[1] if len(words) > 1 else ''
+                    trials.append([trial_id, time, numpy.nan])
+                    ias.append([])
+                elif trial_id is None:
+                    continue
+                elif words[:3] == ['!V', 'IAREA', 'RECTANGLE'] and len(words) >= 8:
+                    ias[-1].append((words[8] if len(words) > 8 else words[3], [float(value) for value in words[4:8]]))
+                elif words[:1] == ['TRIAL_RESULT']:
+                    trials[-1][2] = time
+                    trial_id = None
+                if trial_id is not None or words[:1] == ['TRIAL_RESULT']:
+                    messages.append((time, len(trials) - 1, text))
+
+    return {'samples': numpy.array(samples, dtype = float).reshape(-1, 4),
+            'fixations': numpy.array(fixations, dtype = float).reshape(-1, 4),
+            'fixation_trials': numpy.array(fixation_trials, dtype = int),
+            'blinks': numpy.array(blinks, dtype = float).reshape(-1, 2),
+            'messages': messages,
+            'trials': trials,
+            'ias': ias,
+            'sampling_rate': sampling_info(asc_file)[0]}
+
+
+def message_times(parsed, message):
+    # {trial (index in parsed['trials']): time of the message in that trial}
+    return {trial: time for time, trial, text in parsed['messages'] if text.split(None, 1)[0] == message}
+
+
+def detect_events(parsed, method = 'eyelink', min_fixation = 50, velocity_threshold = 1500):
+    """Fixations (start, end, x, y) and their trials (index in parsed['trials'])
+
+    method 'eyelink' keeps the fixations of the EyeLink parser, 'velocity' takes every run of samples below
+    velocity_threshold (pixels/s) as a fixation; in both cases fixations shorter than min_fixation ms are dropped
+    """
+
+    if method == 'eyelink':
+        fixations, trials = parsed['fixations'], parsed['fixation_trials']
+    elif method == 'velocity':
+        samples = parsed['samples']
+        speed = numpy.hypot(velocity(samples[:, 1], parsed['sampling_rate']), velocity(samples[:, 2], parsed['sampling_rate']))
+        slow = numpy.diff(numpy.concatenate([[0], (speed < velocity_threshold).astype(numpy.int8), [0]]))
+        starts = numpy.flatnonzero(slow == 1)
+        ends = numpy.flatnonzero(slow == -1)
+        # mean position of every run, from cumulative sums (slow samples are never missing)
+        sums = numpy.vstack([numpy.zeros(2), numpy.cumsum(numpy.nan_to_num(samples[:, 1:3]), axis = 0)])
+        means = (sums[ends] - sums[starts]) / (ends - starts)[:, None]
+        fixations = numpy.column_stack([samples[starts, 0], samples[ends - 1, 0], means])
+        # the trial of every fixation, from the TRIALID and TRIAL_RESULT times
+        trial_starts = numpy.array([trial[1] for trial in parsed['trials']])
+        trial_ends = numpy.array([trial[2] for trial in parsed['trials']])
+        trial = numpy.searchsorted(trial_starts, fixations[:, 0], side = 'right') - 1
+        inside = (trial >= 0) & (fixations[:, 1] <= trial_ends[numpy.maximum(trial, 0)]) if len(trial_starts) else trial >= 0
+        fixations = fixations[inside]
+        trials = trial[inside]
+    else:
+        raise ValueError('unknown method %s, use eyelink or velocity' % method)
+    keep = fixations[:, 1] - fixations[:, 0] >= min_fixation
+    return {'fixations': fixations[keep], 'trials': trials[keep]}
+
+
+def map_aois(parsed, events, margin = 0):
+    # the IA label of every fixation ('' if it is on none of the IAs of its trial)
+    labels = numpy.full(len(events['fixations']), '', dtype = object)
+    for trial, trial_ias in enumerate(parsed['ias']):
+        selected = numpy.flatnonzero(events['trials'] == trial)
+        if len(selected) == 0 or not trial_ias:
+            continue
+        rects = numpy.array([rect for _, rect in trial_ias])
+        x = events['fixations'][selected, 2, None]
+        y = events['fixations'][selected, 3, None]
+        on = (x >= rects[:, 0] - margin) & (x <= rects[:, 2] + margin) & (y >= rects[:, 1] - margin) & (y <= rects[:, 3] + margin)
+        first = numpy.argmax(on, axis = 1) # the first IA, if IAs overlap
+        names = numpy.array([name for name, _ in trial_ias], dtype = object)
+        labels[selected] = numpy.where(on.any(axis = 1), names[first], '')
+    return {'fixations': events['fixations'], 'trials': events['trials'], 'aoi': labels.astype(str)}
+
+
+def bin_aois(parsed, aois, time_zero = 'target_onset', bin_width = 50, window = (-200, 2000)):
+    """Proportion of every time bin spent on every IA, per trial
+
+    returns arrays with one value per trial, bin and IA: trial (TRIALID), trial_index (index in parsed['trials']),
+    bin (start of the bin in ms from time_zero), aoi and proportion (of the bin covered by fixations on that IA)
+    """
+
+    edges = numpy.arange(window[0], window[1] + bin_width, bin_width, dtype = float)
+    bins = edges[:-1]
+    zero = message_times(parsed, time_zero)
+    result = {'trial': [], 'trial_index': [], 'bin': [], 'aoi': [], 'proportion': []}
+    for trial, onset in zero.items():
+        selected = (aois['trials'] == trial) & (aois['aoi'] != '')
+        if not selected.any():
+            continue
+        start = aois['fixations'][selected, 0, None] - onset
+        end = aois['fixations'][selected, 1, None] - onset
+        # fixations x bins: the ms of every fixation inside every bin
+        overlap = numpy.clip(numpy.minimum(end, edges[1:]) - numpy.maximum(start, edges[:-1]), 0, None)
+        names, which = numpy.unique(aois['aoi'][selected], return_inverse = True)
+        per_aoi = numpy.zeros((len(names), len(bins)))
+        numpy.add.at(per_aoi, which, overlap)
+        result['trial'].append(numpy.repeat(parsed['trials'][trial][0], per_aoi.size))
+        result['trial_index'].append(numpy.repeat(trial, per_aoi.size))
+        result['bin'].append(numpy.tile(bins, len(names)))
+        result['aoi'].append(numpy.repeat(names, len(bins)))
+        result['proportion'].append((per_aoi / bin_width).ravel())
+    return {name: numpy.concatenate(values) if values else numpy.zeros(0) for name, values in result.items()}
+
+
+def clean_pupil(parsed, blink_padding = 100, max_gap = 300, baseline_message = 'target_onset', baseline = 200):
+    """Pupil size without blinks (blink_padding ms removed on both sides), with gaps up to max_gap ms interpolated
+
+    returns time, pupil and, per trial (index in parsed['trials']), the mean pupil size in the baseline ms before baseline_message
+    """
+
+    time = parsed['samples'][:, 0]
+    pupil = parsed['samples'][:, 3].copy()
+    pupil[pupil <= 0] = numpy.nan
+    if len(parsed['blinks']):
+        first = numpy.searchsorted(time, parsed['blinks'][:, 0] - blink_padding)
+        last = numpy.searchsorted(time, parsed['blinks'][:, 1] + blink_padding, side = 'right')
+        # mark the start and end of every blink, the cumulative sum is > 0 inside blinks
+        inside = numpy.zeros(len(time) + 1, dtype = int)
+        numpy.add.at(inside, first, 1)
+        numpy.add.at(inside, last, -1)
+        pupil[numpy.cumsum(inside[:-1]) > 0] = numpy.nan
+    valid = ~numpy.isnan(pupil)
+    if valid.sum() > 1:
+        previous = numpy.maximum.accumulate(numpy.where(valid, numpy.arange(len(pupil)), 0))
+        following = numpy.minimum.accumulate(numpy.where(valid, numpy.arange(len(pupil)), len(pupil) - 1)[::-1])[::-1]
+        short = ~valid & valid[previous] & valid[following] & (time[following] - time[previous] <= max_gap)
+        pupil[short] = numpy.interp(time[short], time[valid], pupil[valid])
+    baselines = {}
+    for trial, onset in message_times(parsed, baseline_message).items():
+        first, last = numpy.searchsorted(time, [onset - baseline, onset])
+        baselines[trial] = numpy.nanmean(pupil[first:last]) if numpy.any(~numpy.isnan(pupil[first:last])) else numpy.nan
+    return {'time': time, 'pupil': pupil, 'baselines': baselines}
+
+
+class Pipeline:
+    """The stages with their parameters (default_parameters, updated with parameters) and a cache folder"""
+
+    def __init__(self, cache_folder, parameters = None, hashes = None):
+        self.cache_folder = cache_folder
+        self.parameters = {stage: dict(values) for stage, values in default_parameters.items()}
+        for stage, values in (parameters or {}).items():
+            if stage not in self.parameters:
+                raise ValueError('unknown stage %s, the stages are %s' % (stage, ', '.join(self.parameters)))
+            self.parameters[stage].update(values)
+        self.hashes = hashes if hashes is not None else {} # {path: [size, modification time, hash]}
+
+    def input_hash(self, asc_file):
+        # hash of the content of the file, only computed again if its size or modification time changed
+        path = os.path.abspath(asc_file)
+        status = os.stat(path)
+        known = self.hashes.get(path)
+        if known is None or known[:2] != [status.st_size, status.st_mtime_ns]:
+            known = self.hashes[path] = [status.st_size, status.st_mtime_ns, file_hash(path)]
+        return known[2]
+
+    def keys(self, asc_file):
+        # {stage: key}, the key of a stage depends on the input file, its parameters and the keys of the stages it uses
+        source = self.input_hash(asc_file)
+        keys = {}
+        for stage, uses in stages:
+            description = [cache_version, stage, source, self.parameters[stage], [keys[used] for used in uses]]
+            keys[stage] = hashlib.sha1(json.dumps(description, sort_keys = True).encode()).hexdigest()[:16]
+        return keys
+
+    def folder(self, asc_file):
+        # the cache folder of an .asc file: its name and the start of the hash of its content
+        return os.path.join(self.cache_folder, os.path.splitext(os.path.basename(asc_file))[0] + '_' + self.input_hash(asc_file)[:8])
+
+    def prune(self, asc_files):
+        """Remove the cached results these .asc files do not use with the current parameters
+
+        That is the results of other parameters, and the folders of older versions of the files (same name, other hash).
+        The folders of files that are not in asc_files are left alone.
+        returns the number of files and folders removed
+        """
+
+        folders = {}
+        for asc_file in asc_files:
+            keys = self.keys(asc_file)
+            folders[self.folder(asc_file)] = {'%s_%s.pkl' % (stage, key) for stage, key in keys.items()}
+        names = {os.path.splitext(os.path.basename(asc_file))[0] for asc_file in asc_files}
+        removed = 0
+        for entry in os.listdir(self.cache_folder) if os.path.isdir(self.cache_folder) else []:
+            path = os.path.join(self.cache_folder, entry)
+            if not os.path.isdir(path) or entry.rsplit('_', 1)[0] not in names:
+                continue
+            if path not in folders: # an older version of one of the files
+                shutil.rmtree(path)
+                removed += 1
+                continue
+            for name in os.listdir(path):
+                if name not in folders[path]:
+                    os.remove(os.path.join(path, name))
+                    removed += 1
+        return removed
+
+    def run(self, asc_file, wanted = None):
+        """Results of the stages in wanted (default: all) for one .asc file
+
+        returns (results, computed): {stage: result} and the list of the stages that had to be computed
+        """
+
+        keys = self.keys(asc_file)
+        folder = self.folder(asc_file)
+        os.makedirs(folder, exist_ok = True)
+        uses = dict(stages)
+        results = {}
+        computed = []
+
+        def result(stage):
+            # from the cache if possible, otherwise computed (with the results of the stages it uses)
+            if stage in results:
+                return results[stage]
+            path = os.path.join(folder, '%s_%s.pkl' % (stage, keys[stage]))
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    results[stage] = pickle.load(f)
+                return results[stage]
+            inputs = [result(used) for used in uses[stage]]
+            if stage == 'parse':
+                results[stage] = parse(asc_file, **self.parameters['parse'])
+            else:
+                function = {'events': detect_events, 'aoi': map_aois, 'binning': bin_aois, 'pupil': clean_pupil}[stage]
+                results[stage] = function(*inputs, **self.parameters[stage])
+            # results with other parameters stay in the cache (see prune), the new one is written to a temporary file
+            # first, so a crash leaves no half file
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump(results[stage], f, protocol = pickle.HIGHEST_PROTOCOL)
+            os.replace(path + '.tmp', path)
+            computed.append(stage)
+            return results[stage]
+
+        for stage in wanted or [stage for stage, _ in stages]:
+            result(stage)
+        return {stage: results[stage] for stage in wanted or [stage for stage, _ in stages]}, computed
+
+
+def run_participant(arguments):
+    # for the worker processes: (cache folder, parameters, known hashes, .asc file) -> (stages computed, hash of the file)
+    cache_folder, parameters, hashes, asc_file = arguments
+    pipeline = Pipeline(cache_folder, parameters, hashes)
+    _, computed = pipeline.run(asc_file, wanted = ['binning', 'pupil'])
+    return computed, pipeline.hashes.get(os.path.abspath(asc_file))
+
+
+def run_files(asc_files, cache_folder, parameters = None, processes = None):
+    """Run the pipeline on several .asc files (participants) in parallel
+
+    The hashes of the files are kept in hashes.json in the cache folder, so unchanged files are not read again.
+    returns {file: stages that were computed}
+    """
+
+    os.makedirs(cache_folder, exist_ok = True)
+    hashes_file = os.path.join(cache_folder, 'hashes.json')
+    hashes = {}
+    if os.path.exists(hashes_file):
+        with open(hashes_file) as f:
+            hashes = json.load(f)
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(run_participant, [(cache_folder, parameters, hashes, asc_file) for asc_file in asc_files])
+    for asc_file, (_, known) in zip(asc_files, results):
+        hashes[os.path.abspath(asc_file)] = known
+    with open(hashes_file, 'w') as f:
+        json.dump(hashes, f, indent = 1)
+    return {asc_file: computed for asc_file, (computed, _) in zip(asc_files, results)}
+
+
+def prune_files(asc_files, cache_folder, parameters = None):
+    """Remove the cached results the .asc files do not use with these parameters (see Pipeline.prune)
+
+    returns the number of files and folders removed
+    """
+
+    hashes_file = os.path.join(cache_folder, 'hashes.json')
+    hashes = {}
+    if os.path.exists(hashes_file):
+        with open(hashes_file) as f:
+            hashes = json.load(f)
+    return Pipeline(cache_folder, parameters, hashes).prune(asc_files)
+
+
+if __name__ == '__main__':
+    arguments = [argument for argument in sys.argv[1:] if argument != '--prune']
+    if len(arguments) < 3:
+        print('usage: python preprocessing_cache.py [--prune] <cache folder> <parameters.json> <file.asc> [<file.asc> ...]')
+        sys.exit(1)
+    with open(arguments[1]) as f:
+        parameters = json.load(f)
+    if '--prune' in sys.argv:
+        print('%d cached results removed' % prune_files(arguments[2:], arguments[0], parameters))
+        sys.exit(0)
+    for asc_file, computed in run_files(arguments[2:], arguments[0], parameters).items():
+        print('%s: %s' % (asc_file, ', '.join(computed) if computed else 'up to date'))
@@ -0,0 +1,263 @@
+"""
+Summarise the data quality of every session
+Course: Eye-tracking in Language Research
+
+Run this on the .asc version of the .EDF files as soon as the session is over (edf2asc takes a few seconds),
+so you can still run the participant again if something went wrong:
+
+    python quality_report.py report.html et_results/pp_12/12.asc
+    python quality_report.py report.json et_results/*/*.asc
+
+For every session (in parallel), the report has:
+- calibration and validation: the result of every calibration, and the average and maximum error (degrees)
+  of every validation (!CAL messages)
+- drift checks: the offset (degrees) of every DRIFTCORRECT and the decisions of the adaptive drift check
+  of the templates (DRIFT_MONITOR messages, error in pixels)
+- per trial: duration, track loss (share of samples without gaze), sampling irregularities (intervals between
+  samples that are not 1000 / sampling rate ms, and the longest gap) and how the trial ended (ok, or
+  skipped / error: trial_skipped, tracker_disconnected or a TRIAL_RESULT other than 0)
+- per trial and IA (!V IAREA RECTANGLE messages): share of the samples on the IA and the track loss while the
+  participant was looking at it (missing samples count for the IA of the last valid gaze position)
+
+The .json file has everything; the .html file has a summary table per session, with the values above the
+thresholds (see the top of the file) in red, and the trials underneath.
+"""
+
+import html
+import json
+import multiprocessing
+import os
+import re
+import sys
+
+import numpy
+
+from message_index import message_parts
+
+
+# values above these thresholds are flagged in the report
+max_validation_error = 0.5 # average error of the last validation, degrees
+max_drift_offset = 1.0 # degrees
+max_track_loss = 0.25 # share of samples of a trial
+max_error_trials = 0.1 # share of trials skipped or ended with an error
+
+validation_pattern = re.compile(r'!CAL VALIDATION (\S+) \S+ (LEFT|RIGHT)\s+(\S+)\s+ERROR\s+([\d.]+) avg\.\s+([\d.]+) max')
+calibration_pattern = re.compile(r'!CAL CALIBRATION (\S+) \S+ (LEFT|RIGHT)\s+(\S+)')
+drift_pattern = re.compile(r'DRIFTCORRECT \S+ (LEFT|RIGHT) at \S+\s+OFFSET ([\d.]+) deg\.')
+
+
+def read_session(asc_file):
+    """One pass through an .asc file: samples (time, gaze x and y, recording block) and messages
+
+    The gaze position of a sample is that of the first recorded eye with data (NaN if no eye has data).
+    """
+
+    rate = 1000.0
+    eyes = ['LEFT']
+    time = []
+    gaze = []
+    block = []
+    messages = []
+    nr_blocks = 0
+    with open(asc_file) as f:
+        for line in f:
+            if line[:1].isdigit():
+                fields = line.split()
+                time.append(float(fields[0]))
+                block.append(nr_blocks)
+                if fields[1] != '.':
+                    gaze.append((fields[1], fields[2]))
+                elif len(eyes) == 2 and len(fields) > 5 and fields[4] != '.':
+                    gaze.append((fields[4], fields[5]))
+                else:
+                    gaze.append(('nan', 'nan'))
+            elif line.startswith('MSG'):
+                parts = message_parts(line)
+                if parts is not None:
+                    messages.append(parts)
+            elif line.startswith('START'):
+                nr_blocks += 1
+            elif line.startswith('SAMPLES'):
+                fields = line.split()
+                rate = float(fields[fields.index('RATE') + 1]) if 'RATE' in fields else rate
+                eyes = [eye for eye in ['LEFT', 'RIGHT'] if eye in fields] or eyes
+    gaze = numpy.array(gaze, dtype = float).reshape(-1, 2)
+    return {'time': numpy.array(time), 'x': gaze[:, 0], 'y': gaze[:, 1], 'block': numpy.array(block),
+            'messages': messages, 'rate': rate, 'eyes': eyes}
+
+
+def trial_quality(session, first, last, ias):
+    # track loss, sampling irregularities and IAs of the samples first to last of a trial
+    time = session['time'][first:last]
+    x = session['x'][first:last]
+    y = session['y'][first:last]
+    lost = numpy.isnan(x)
+    interval = 1000.0 / session['rate']
+    same_block = numpy.diff(session['block'][first:last]) == 0
+    steps = numpy.diff(time)[same_block]
+    quality = {'samples': int(last - first),
+               'track_loss': float(lost.mean()) if len(lost) else None,
+               'irregular_intervals': int(numpy.sum(numpy.abs(steps - interval) > interval / 2)),
+               'longest_gap': float(steps.max()) if len(steps) else None,
+               'aois': {}}
+    if ias and len(time):
+        # every sample belongs to the IA of the last valid gaze position (so missing samples count for that IA)
+        valid = numpy.flatnonzero(~lost)
+        last_valid = numpy.maximum.accumulate(numpy.where(~lost, numpy.arange(len(x)), -1))
+        rects = numpy.array([rect for _, rect in ias])
+        gx = x[valid, None]
+        gy = y[valid, None]
+        on = (gx >= rects[:, 0]) & (gx <= rects[:, 2]) & (gy >= rects[:, 1]) & (gy <= rects[:, 3])
+        ia_of_valid = numpy.where(on.any(axis = 1), numpy.argmax(on, axis = 1), -1)
+        ia_of_sample = numpy.full(len(x), -1)
+        has_valid = last_valid >= 0
+        ia_of_sample[has_valid] = ia_of_valid[numpy.searchsorted(valid, last_valid[has_valid])]
+        for i, (label, _) in enumerate(ias):
+            on_ia = ia_of_sample == i
+            quality['aois'][label] = {'share': float(on_ia.mean()),
+                                      'track_loss': float(lost[on_ia].mean()) if on_ia.any() else None}
+    return quality
+
+
+def session_report(asc_file):
+    """Data quality of one session (see the top of this file), as a dict that can be saved as .json"""
+
+    session = read_session(asc_file)
+    report = {'session': os.path.splitext(os.path.basename(asc_file))[0], 'file': asc_file, 'sampling_rate': session['rate'],
+              'eyes': session['eyes'], 'calibrations': [], 'validations': [], 'drift_checks': [], 'trials': []}
+    trial = None
+    trial_ias = []
+    pending_drift = [] # drift checks between trials belong to the next trial
+    for time, text in session['messages']:
+        words = text.split()
+        if not words:
+            continue
+        match = validation_pattern.search(text)
+        if match:
+            report['validations'].append({'time': time, 'type': match.group(1), 'eye': match.group(2), 'result': match.group(3),
+                                          'average': float(match.group(4)), 'max': float(match.group(5))})
+            continue
+        match = calibration_pattern.search(text)
+        if match:
+            report['calibrations'].append({'time': time, 'type': match.group(1), 'eye': match.group(2), 'result': match.group(3)})
+            continue
+        match = drift_pattern.search(text)
+        if match:
+            (trial['drift'] if trial else pending_drift).append({'eye': match.group(1), 'offset': float(match.group(2))})
+            continue
+        if words[0] == 'DRIFT_MONITOR' and len(words) > 2:
+            error = float(words[2]) if words[2] not in ('NA', 'scheduled') else None
+            (trial['drift'] if trial else pending_drift).append({'decision': words[1], 'error_px': error})
+        elif words[0] == 'TRIALID':
+            trial = {'trial': words[1] if len(words) > 1 else '', 'start': time, 'drift': pending_drift, 'events': []}
+            trial_ias = []
+            pending_drift = []
+        elif trial is None:
+            continue
+        elif words[:3] == ['!V', 'IAREA', 'RECTANGLE'] and len(words) >= 8:
+            trial_ias.append((words[8] if len(words) > 8 else words[3], [float(value) for value in words[4:8]]))
+        elif words[0] in ('trial_skipped', 'tracker_disconnected', 'experiment_aborted'):
+            trial['events'].append(words[0])
+        elif words[0] == 'TRIAL_RESULT':
+            code = int(words[1]) if len(words) > 1 and words[1].lstrip('-').isdigit() else 0
+            trial['duration'] = time - trial['start']
+            trial['result'] = 'ok' if code == 0 and not trial['events'] else 'error'
+            first, last = numpy.searchsorted(session['time'], [trial['start'], time])
+            trial.update(trial_quality(session, first, last, trial_ias))
+            report['drift_checks'].extend(dict(check, trial = trial['trial']) for check in trial['drift'])
+            del trial['drift']
+            report['trials'].append(trial)
+            trial = None
+
+    report['summary'] = summarise(report)
+    return report
+
+
+def summarise(report):
+    # one row per session for the summary table
+    trials = report['trials']
+    track_loss = numpy.array([trial['track_loss'] for trial in trials if trial['track_loss'] is not None])
+    offsets = numpy.array([check['offset'] for check in report['drift_checks'] if 'offset' in check])
+    monitor = numpy.array([check['error_px'] for check in report['drift_checks'] if check.get('error_px') is not None])
+    last_validation = report['validations'][-1] if report['validations'] else None
+    return {'trials': len(trials),
+            'error_trials': float(numpy.mean([trial['result'] != 'ok' for trial in trials])) if trials else None,
+            'track_loss_mean': float(track_loss.mean()) if len(track_loss) else None,
+            'track_loss_max': float(track_loss.max()) if len(track_loss) else None,
+            'trials_above_track_loss': int(numpy.sum(track_loss > max_track_loss)),
+            'calibrations': len(report['calibrations']),
+            'validation_average': last_validation['average'] if last_validation else None,
+            'validation_max': last_validation['max'] if last_validation else None,
+            'drift_offset_mean': float(offsets.mean()) if len(offsets) else None,
+            'drift_offset_max': float(offsets.max()) if len(offsets) else None,
+            'drift_monitor_error_mean': float(monitor.mean()) if len(monitor) else None,
+            'irregular_intervals': int(sum(trial['irregular_intervals'] for trial in trials))}
+
+
+def flagged(name, value):
+    # is a summary value above its threshold?
+    limits = {'error_trials': max_error_trials, 'track_loss_mean': max_track_loss, 'validation_average': max_validation_error,
+              'drift_offset_max': max_drift_offset, 'track_loss': max_track_loss}
+    return value is not None and name in limits and value > limits[name]
+
+
+def cell(name, value):
+    if value is None:
+        text = 'NA'
+    elif isinstance(value, float):
+        text = '%.3f' % value
+    else:
+        text = html.escape(str(value))
+    return '<td class="bad">%s</td>' % text if flagged(name, value) else '<td>%s</td>' % text
+
+
+def write_html(reports, output_file):
+    # summary table of every session, and the trials of every session underneath
+    summary_columns = list(reports[0]['summary']) if reports else []
+    trial_columns = ['trial', 'result', 'duration', 'samples', 'track_loss', 'irregular_intervals', 'longest_gap']
+    lines = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8"><title>Data quality</title>',
+             '<style>body{font-family:sans-serif;font-size:13px} table{border-collapse:collapse;margin-bottom:1em}'
+             ' td,th{border:1px solid #ccc;padding:2px 6px;text-align:right} .bad{background:#f4b6b6}</style></head><body>',
+             '<h1>Data quality</h1>', '<table><tr><th>session</th>%s</tr>' % ''.join('<th>%s</th>' % name for name in summary_columns)]
+    for report in reports:
+        lines.append('<tr><td>%s</td>%s</tr>' % (html.escape(report['session']),
+                                                 ''.join(cell(name, report['summary'][name]) for name in summary_columns)))
+    lines.append('</table>')
+    for report in reports:
+        lines.append('<details><summary>%s</summary>' % html.escape(report['session']))
+        lines.append('<p>validations: %s</p>' % html.escape(', '.join('%s %s %.2f avg. %.2f max' % (v['eye'], v['result'], v['average'], v['max'])
+                                                                    for v in report['validations']) or 'none'))
+        lines.append('<table><tr>%s<th>IAs (share, track loss)</th></tr>' % ''.join('<th>%s</th>' % name for name in trial_columns))
+        for trial in report['trials']:
+            aois = ', '.join('%s %.2f %s' % (label, aoi['share'], 'NA' if aoi['track_loss'] is None else '%.2f' % aoi['track_loss'])
+                             for label, aoi in trial['aois'].items())
+            lines.append('<tr>%s<td>%s</td></tr>' % (''.join(cell(name, trial.get(name)) for name in trial_columns), html.escape(aois)))
+        lines.append('</table></details>')
+    lines.append('</body></html>')
+    with open(output_file, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def quality_report(asc_files, output_file, processes = None):
+    """Report of several sessions (in parallel), saved as .html or .json depending on the extension of output_file"""
+
+    if len(asc_files) == 1:
+        reports = [session_report(asc_files[0])] # straight after a session, no need to start other processes
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            reports = pool.map(session_report, asc_files)
+    if output_file.endswith('.json'):
+        with open(output_file, 'w') as f:
+            json.dump(reports, f, indent = 1)
+    else:
+        write_html(reports, output_file)
+    return reports
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('usage: python quality_report.py <report.html or report.json> <file.asc> [<file.asc> ...]')
+        sys.exit(1)
+    for report in quality_report(sys.argv[2:], sys.argv[1]):
+        print(report['session'], ', '.join('%s %s' % (name, 'NA' if value is None else round(value, 3))
+                                           for name, value in report['summary'].items()))
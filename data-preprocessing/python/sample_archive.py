@@ -0,0 +1,241 @@
+"""
+Store the samples of every participant in a memory-mapped archive
+Course: Eye-tracking in Language Research
+
+The samples of a whole study do not fit in memory as data frames. This script saves them, per participant,
+in a folder with one binary file per column (fixed width, so any row can be found without reading the rest):
+
+    time                                   float64, tracker time (ms)
+    x_left, y_left, pupil_left             float32, NaN if missing
+    status_left                            uint8, see the status flags below
+    x_right, y_right, pupil_right          float32
+    status_right                           uint8
+
+The columns are opened with numpy.memmap: a slice only reads that part from the disk, and several processes
+can read the same archive at the same time without copies (the operating system shares the pages). The
+archive.json file describes the columns and every chunk of chunk_size rows: first and last time, minimum and
+maximum of every column (to skip chunks without reading them) and a checksum. pack() compresses every chunk of
+every column separately (zlib) for storage or transfer, and unpack() brings the columns back.
+
+    python sample_archive.py et_results/pp_12/archive et_results/pp_12/12.asc et_results/pp_12/12_2.asc
+
+    archive = SampleArchive('et_results/pp_12/archive')
+    x = archive.column('x_left')[1000:2000]
+    part = archive.time_range(152000, 158000) # {column: array}
+"""
+
+import json
+import os
+import sys
+import zlib
+
+import numpy
+
+
+columns = [('time', 'float64'),
+           ('x_left', 'float32'), ('y_left', 'float32'), ('pupil_left', 'float32'), ('status_left', 'uint8'),
+           ('x_right', 'float32'), ('y_right', 'float32'), ('pupil_right', 'float32'), ('status_right', 'uint8')]
+
+# status flags (bits) of every eye
+missing = 1 # no gaze position (blink, track loss or the eye was not recorded)
+interpolated = 2 # the EyeLink marked the sample as interpolated
+corneal_reflection_missing = 4
+
+
+class SampleArchive:
+    """Samples of one participant, one memory-mapped file per column (see the top of this file)"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, 'archive.json')) as f:
+            self.meta = json.load(f)
+        self.maps = {}
+
+    @classmethod
+    def create(cls, folder, chunk_size = 65536):
+        # a new, empty archive
+        os.makedirs(folder, exist_ok = True)
+        meta = {'columns': columns, 'rows': 0, 'chunk_size': chunk_size, 'chunks': [], 'packed': False}
+        with open(os.path.join(folder, 'archive.json'), 'w') as f:
+            json.dump(meta, f, indent = 1)
+        for name, _ in columns:
+            open(os.path.join(folder, name + '.bin'), 'wb').close()
+        return cls(folder)
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def save_meta(self):
+        # write archive.json next to the columns, replacing the old version only when the new one is complete
+        path = os.path.join(self.folder, 'archive.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.meta, f, indent = 1)
+        os.replace(path + '.tmp', path)
+
+    def column(self, name):
+        # the whole column as a read-only memory map (nothing is read until you use it)
+        if self.meta['packed']:
+            raise ValueError('the archive is packed, unpack() it first')
+        if name not in self.maps:
+            dtype = dict(self.meta['columns'])[name]
+            if self.meta['rows'] == 0:
+                return numpy.zeros(0, dtype = dtype)
+            self.maps[name] = numpy.memmap(os.path.join(self.folder, name + '.bin'), dtype = dtype, mode = 'r',
+                                           shape = (self.meta['rows'],))
+        return self.maps[name]
+
+    def rows(self, start, stop, names = None):
+        # rows start to stop of some (default: all) columns, as views on the memory maps
+        return {name: self.column(name)[start:stop] for name in (names or [name for name, _ in self.meta['columns']])}
+
+    def time_range(self, start_time, end_time, names = None):
+        # the rows between two times: the chunk table narrows the search down, then a binary search in that chunk
+        chunks = self.meta['chunks']
+        first_times = numpy.array([chunk['first_time'] for chunk in chunks])
+        time = self.column('time')
+        bounds = []
+        for wanted in [start_time, end_time]:
+            chunk = max(int(numpy.searchsorted(first_times, wanted, side = 'right')) - 1, 0) if len(chunks) else 0
+            begin = chunk * self.meta['chunk_size']
+            end = min(begin + self.meta['chunk_size'], len(self))
+            bounds.append(begin + int(numpy.searchsorted(time[begin:end], wanted)))
+        return self.rows(bounds[0], bounds[1], names)
+
+    def append(self, block):
+        """Add samples at the end of the archive
+
+        block: {column: array}, all of the same length; columns that are left out are NaN (status: missing)
+        """
+
+        if self.meta['packed']:
+            raise ValueError('the archive is packed, unpack() it first')
+        length = len(block['time'])
+        if length == 0:
+            return
+        if self.meta['rows'] and block['time'][0] < self.meta['chunks'][-1]['last_time']:
+            raise ValueError('samples have to be added in time order')
+        for name, dtype in self.meta['columns']:
+            default = missing if name.startswith('status') else numpy.nan
+            values = numpy.asarray(block.get(name, numpy.full(length, default)), dtype = dtype)
+            with open(os.path.join(self.folder, name + '.bin'), 'ab') as f:
+                f.write(values.tobytes())
+        first_chunk = self.meta['rows'] // self.meta['chunk_size']
+        self.meta['rows'] += length
+        self.maps = {}
+        # the last chunk may have been completed, and new ones may have been started
+        del self.meta['chunks'][first_chunk:]
+        for start in range(first_chunk * self.meta['chunk_size'], self.meta['rows'], self.meta['chunk_size']):
+            self.meta['chunks'].append(self.chunk_info(start, min(start + self.meta['chunk_size'], self.meta['rows'])))
+        self.save_meta()
+
+    def chunk_info(self, start, stop):
+        # what we know about a chunk without reading it: times, minimum and maximum of every column and a checksum
+        info = {'start': start, 'rows': stop - start, 'min': {}, 'max': {}, 'crc32': {}}
+        for name, _ in self.meta['columns']:
+            values = self.column(name)[start:stop]
+            if values.dtype.kind == 'f' and numpy.all(numpy.isnan(values)):
+                info['min'][name] = info['max'][name] = None
+            else:
+                info['min'][name] = float(numpy.nanmin(values))
+                info['max'][name] = float(numpy.nanmax(values))
+            info['crc32'][name] = zlib.crc32(values.tobytes())
+        info['first_time'] = info['min']['time']
+        info['last_time'] = info['max']['time']
+        return info
+
+    def pack(self, level = 6):
+        # compress every chunk of every column separately (<column>.z), the offsets are saved in archive.json
+        if self.meta['packed']:
+            return
+        for name, _ in self.meta['columns']:
+            column = self.column(name)
+            offset = 0
+            with open(os.path.join(self.folder, name + '.z'), 'wb') as f:
+                for chunk in self.meta['chunks']:
+                    data = zlib.compress(column[chunk['start']:chunk['start'] + chunk['rows']].tobytes(), level)
+                    f.write(data)
+                    chunk.setdefault('packed', {})[name] = [offset, len(data)]
+                    offset += len(data)
+        self.maps = {}
+        self.meta['packed'] = True
+        self.save_meta()
+        for name, _ in self.meta['columns']:
+            os.remove(os.path.join(self.folder, name + '.bin'))
+
+    def unpack(self):
+        # decompress the columns again, checking every chunk against its checksum
+        if not self.meta['packed']:
+            return
+        for name, dtype in self.meta['columns']:
+            with open(os.path.join(self.folder, name + '.z'), 'rb') as packed, open(os.path.join(self.folder, name + '.bin'), 'wb') as f:
+                for chunk in self.meta['chunks']:
+                    offset, size = chunk['packed'][name]
+                    packed.seek(offset)
+                    data = zlib.decompress(packed.read(size))
+                    if zlib.crc32(data) != chunk['crc32'][name]:
+                        raise ValueError('chunk at row %d of %s is damaged' % (chunk['start'], name))
+                    f.write(data)
+        self.meta['packed'] = False
+        for chunk in self.meta['chunks']:
+            chunk.pop('packed', None)
+        self.save_meta()
+        for name, _ in self.meta['columns']:
+            os.remove(os.path.join(self.folder, name + '.z'))
+
+
+def read_asc_samples(asc_file, chunk_size = 100000):
+    """Read the samples of an .asc file in blocks of at most chunk_size rows, ready for SampleArchive.append
+
+    yields {column: array}; the status of an eye comes from the missing values and the flags at the end of the line
+    """
+
+    eyes = []
+    with open(asc_file) as f:
+        for line in f:
+            if line.startswith('SAMPLES'):
+                eyes = [eye for eye in ['left', 'right'] if eye.upper() in line.split()]
+                break
+    eyes = eyes or ['left']
+    rows = []
+
+    def block(rows):
+        result = {'time': numpy.array([float(fields[0]) for fields in rows])}
+        for i, eye in enumerate(eyes):
+            for j, name in enumerate(['x', 'y', 'pupil']):
+                result['%s_%s' % (name, eye)] = numpy.array([float(fields[1 + 3 * i + j]) if fields[1 + 3 * i + j] != '.' else numpy.nan
+                                                             for fields in rows], dtype = numpy.float32)
+            # flags: '...' for one eye, '.....' for both; the first one (interpolated) is shared by the eyes,
+            # then CR missing and CR recovering for every eye (left: 1 and 2, right: 3 and 4)
+            flags = [fields[1 + 3 * len(eyes)] if len(fields) > 1 + 3 * len(eyes) else '' for fields in rows]
+            status = numpy.isnan(result['x_' + eye]).astype(numpy.uint8) * missing
+            status |= numpy.array([flag[:1] == 'I' for flag in flags], dtype = numpy.uint8) * interpolated
+            status |= numpy.array([len(flag) > 2 * i + 1 and flag[2 * i + 1] == 'C' for flag in flags], dtype = numpy.uint8) * corneal_reflection_missing
+            result['status_' + eye] = status
+        return result
+
+    with open(asc_file) as f:
+        for line in f:
+            if line[:1].isdigit():
+                rows.append(line.split())
+                if len(rows) == chunk_size:
+                    yield block(rows)
+                    rows = []
+    if rows:
+        yield block(rows)
+
+
+def archive_participant(folder, asc_files, chunk_size = 65536):
+    # a new archive with the samples of all the .asc files of a participant (in recording order)
+    archive = SampleArchive.create(folder, chunk_size)
+    for asc_file in asc_files:
+        for block in read_asc_samples(asc_file):
+            archive.append(block)
+    return archive
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('usage: python sample_archive.py <archive folder> <file.asc> [<file.asc> ...]')
+        sys.exit(1)
+    archive = archive_participant(sys.argv[1], sys.argv[2:])
+    print('%s: %d samples in %d chunks' % (sys.argv[1], len(archive), len(archive.meta['chunks'])))
@@ -0,0 +1,225 @@
+"""
+Exclude trials with rules that are declared once
+Course: Eye-tracking in Language Research
+
+Instead of writing loops to drop trials in every project, declare the exclusion criteria in a .json file:
+
+    [{"name": "timeout", "column": "RT", "is": "==", "value": "timeout"},
+     {"name": "wrong object", "column": "object_clicked", "is": "!=", "value": "target",
+      "where": {"column": "trialtype", "is": "==", "value": "critical"}},
+     {"name": "skipped", "messages": ["trial_skipped", "tracker_disconnected"]},
+     {"name": "track loss", "samples": "track_loss", "from": "target_onset", "to": "TRIAL_RESULT", "is": ">", "value": 0.25}]
+
+There are three kinds of rules:
+- column: compares a column of the trial table (e.g., merged.csv from trial_var_merge.py) with a value;
+  "is" is one of ==, !=, <, <=, >, >=, in, not in
+- messages: the trial has any of these messages in the .EDF file
+- samples: a measure of the samples of the trial (track_loss: share of samples without gaze, duration: ms),
+  between two messages ("from", default TRIALID, and "to", default TRIAL_RESULT), compared with a value
+Any rule can have a "where" (another column rule): the rule only applies to the trials that match it.
+
+Every rule is turned into a boolean mask over all the trials at once (numpy), the messages and samples come
+from the indexes of message_index.py (et_results/pp_<participant>/*_index.npz, build them first):
+
+    python trial_exclusion.py rules.json merged.csv et_results clean.csv
+
+This saves clean.csv (the trials that are kept) and clean_audit.csv, with one row per trial: participant, TRIALID,
+excluded, the first rule that excluded it (in the order of the .json file) and all the rules it matched.
+"""
+
+import csv
+import glob
+import json
+import os
+import re
+import sys
+
+import numpy
+
+from message_index import RecordingIndex
+from trial_var_merge import typed_column
+
+
+operators = {'==': numpy.equal, '!=': numpy.not_equal, '<': numpy.less, '<=': numpy.less_equal,
+             '>': numpy.greater, '>=': numpy.greater_equal}
+
+
+def read_table(csv_file):
+    # a .csv file as {column: array}, with number columns where all the values are numbers
+    # participant and TRIALID stay text: they name files and messages (participant 012 is pp_012, not pp_12)
+    with open(csv_file, newline = '') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        columns = list(zip(*reader)) or [()] * len(header)
+    return {name: numpy.array(values, dtype = str) if name in ('participant', 'TRIALID') else typed_column(list(values))
+            for name, values in zip(header, columns)}
+
+
+def as_numbers(column):
+    # a column as floats, NaN for values that are not numbers (e.g., RT = 'timeout')
+    if column.dtype.kind in 'iuf':
+        return column.astype(float)
+    numbers = numpy.full(len(column), numpy.nan)
+    for row, value in enumerate(column):
+        try:
+            numbers[row] = float(value)
+        except ValueError:
+            pass
+    return numbers
+
+
+def compare(column, operator, value):
+    # mask of the rows where 'column operator value' holds; text and numbers are never equal
+    if operator in ('in', 'not in'):
+        values = value if isinstance(value, list) else [value]
+        mask = numpy.isin(column.astype(str), [str(v) for v in values])
+        return mask if operator == 'in' else ~mask
+    if operator not in operators:
+        raise ValueError('unknown operator %s, use one of %s, in, not in' % (operator, ', '.join(operators)))
+    if isinstance(value, str):
+        if operator not in ('==', '!='):
+            raise ValueError('%s only compares numbers, not %r' % (operator, value))
+        return operators[operator](column.astype(str), value)
+    numbers = as_numbers(column)
+    mask = operators[operator](numbers, value)
+    return mask & ~numpy.isnan(numbers) if operator != '!=' else mask | numpy.isnan(numbers)
+
+
+def segment_number(path):
+    # the segment of a recording from its name: <participant>_index.npz is 1, <participant>_<segment>_index.npz the others
+    match = re.match(r'(.+?)(?:_(\d+))?_index\.npz$', os.path.basename(path))
+    return int(match.group(2) or 1) if match else 1
+
+
+def load_indexes(et_results, participants):
+    """The message indexes of the participants: {participant: [RecordingIndex, ...]} in recording order
+
+    The recordings are sorted by segment number (12, 12_2, ..., 12_10), not by name.
+    A merged recording (pp_<participant>_merged_index.npz) is used on its own if there is one.
+    """
+
+    indexes = {}
+    for participant in participants:
+        folder = os.path.join(et_results, 'pp_%s' % participant)
+        files = sorted(glob.glob(os.path.join(folder, '*_index.npz')), key = lambda path: (segment_number(path), path))
+        merged = [path for path in files if path.endswith('_merged_index.npz')]
+        indexes[participant] = [RecordingIndex(path[:-len('_index.npz')]) for path in (merged or files)]
+    return indexes
+
+
+def trial_windows(index, start_message, end_message):
+    # {trial id: (first sample, last sample)} between the first start_message and the first end_message of every trial
+    starts = dict(zip(index.trial[index.type == start_message][::-1], index.sample[index.type == start_message][::-1]))
+    ends = dict(zip(index.trial[index.type == end_message][::-1], index.sample[index.type == end_message][::-1]))
+    return {trial_id: (starts[trial_id], ends[trial_id]) for trial_id in index.trials if trial_id in starts and trial_id in ends}
+
+
+def sample_measure(index, measure, start_message, end_message):
+    # (trial ids, values) of a measure of the samples between two messages, for all the trials of a recording at once
+    windows = trial_windows(index, start_message, end_message)
+    trial_ids = numpy.array(list(windows), dtype = str)
+    bounds = numpy.array(list(windows.values()), dtype = numpy.int64).reshape(-1, 2)
+    first, last = bounds[:, 0], numpy.maximum(bounds[:, 1], bounds[:, 0])
+    if measure == 'track_loss':
+        gaze = index.samples[:, [1, 4]] # x of both eyes: no gaze if both are missing
+        lost = numpy.concatenate([[0], numpy.cumsum(numpy.all(numpy.isnan(gaze), axis = 1))])
+        counts = last - first
+        values = numpy.where(counts > 0, (lost[last] - lost[first]) / numpy.maximum(counts, 1), numpy.nan)
+    elif measure == 'duration':
+        time = numpy.append(index.sample_time, numpy.nan)
+        values = time[numpy.minimum(last, len(index.sample_time) - 1)] - time[first]
+    else:
+        raise ValueError('unknown sample measure %s, use track_loss or duration' % measure)
+    return trial_ids, values
+
+
+def rule_mask(rule, table, indexes):
+    """The trials (rows of table) a rule matches"""
+
+    participants = table['participant'].astype(str)
+    trial_ids = table['TRIALID'].astype(str)
+    if 'column' in rule:
+        if rule['column'] not in table:
+            raise ValueError('rule %s: there is no column %s in the trial table' % (rule['name'], rule['column']))
+        mask = compare(table[rule['column']], rule.get('is', '=='), rule['value'])
+    elif 'messages' in rule:
+        mask = numpy.zeros(len(trial_ids), dtype = bool)
+        for participant, recordings in indexes.items():
+            rows = numpy.flatnonzero(participants == participant)
+            for index in recordings: # a trial recorded again in a later segment replaces the earlier one
+                with_message = numpy.unique(index.trial[numpy.isin(index.type, rule['messages'])])
+                recorded = rows[numpy.isin(trial_ids[rows], list(index.trials))]
+                mask[recorded] = numpy.isin(trial_ids[recorded], with_message)
+    elif 'samples' in rule:
+        values = numpy.full(len(trial_ids), numpy.nan)
+        for participant, recordings in indexes.items():
+            rows = numpy.flatnonzero(participants == participant)
+            for index in recordings: # a trial recorded again in a later segment replaces the earlier one
+                measured_ids, measured = sample_measure(index, rule['samples'], rule.get('from', 'TRIALID'), rule.get('to', 'TRIAL_RESULT'))
+                order = numpy.argsort(measured_ids)
+                position = numpy.searchsorted(measured_ids[order], trial_ids[rows])
+                found = position < len(order)
+                found[found] &= measured_ids[order][position[found]] == trial_ids[rows][found]
+                values[rows[found]] = measured[order][position[found]]
+        mask = compare(values, rule.get('is', '>'), rule['value'])
+    else:
+        raise ValueError('rule %s needs a column, messages or samples' % rule.get('name'))
+    if 'where' in rule:
+        mask &= rule_mask(dict(rule['where'], name = rule['name']), table, indexes)
+    return mask
+
+
+def apply_rules(rules, table, indexes = None):
+    """Apply the rules to the trial table
+
+    returns (kept, audit): the mask of the trials that are kept, and the audit table {column: array} with
+    participant, TRIALID, excluded, rule (the first rule that matched) and rules (all of them, separated by ;)
+    """
+
+    indexes = indexes or {}
+    nr_trials = len(table['participant'])
+    masks = numpy.array([rule_mask(rule, table, indexes) for rule in rules], dtype = bool).reshape(len(rules), nr_trials)
+    names = numpy.array([rule['name'] for rule in rules] + [''], dtype = object)
+    excluded = masks.any(axis = 0)
+    # a last row that every trial matches: the first match is len(rules) ('') for the trials no rule excluded
+    first = numpy.argmax(numpy.vstack([masks, numpy.ones((1, nr_trials), dtype = bool)]), axis = 0)
+    matched = [';'.join(names[:-1][masks[:, row]]) for row in range(nr_trials)]
+    audit = {'participant': table['participant'], 'TRIALID': table['TRIALID'], 'excluded': excluded,
+             'rule': names[first], 'rules': numpy.array(matched, dtype = object)}
+    return ~excluded, audit
+
+
+def exclude(rules_file, trials_file, et_results, output_file):
+    """Apply the rules of a .json file to a trial table (.csv), save the kept trials and the audit table
+
+    returns {rule: number of trials it was the first to exclude}
+    """
+
+    with open(rules_file) as f:
+        rules = json.load(f)
+    table = read_table(trials_file)
+    needs_samples = any('messages' in rule or 'samples' in rule for rule in rules)
+    indexes = load_indexes(et_results, numpy.unique(table['participant'].astype(str))) if needs_samples else {}
+    kept, audit = apply_rules(rules, table, indexes)
+
+    with open(trials_file, newline = '') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = [row for row, keep in zip(reader, kept) if keep]
+    with open(output_file, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+    with open(os.path.splitext(output_file)[0] + '_audit.csv', 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(list(audit))
+        writer.writerows(zip(*audit.values()))
+    return {rule['name']: int(numpy.sum(audit['rule'] == rule['name'])) for rule in rules}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 5:
+        print('usage: python trial_exclusion.py <rules.json> <trials.csv> <et_results folder> <output.csv>')
+        sys.exit(1)
+    for name, count in exclude(*sys.argv[1:5]).items():
+        print('%s: %d trials' % (name, count))
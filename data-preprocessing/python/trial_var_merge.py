@@ -0,0 +1,253 @@
+"""
+Merge the TRIAL_VAR messages of the .EDF files with the behavioural files, and check that they agree
+Course: Eye-tracking in Language Research
+
+The templates save the information of every trial twice: in the .EDF file (!V TRIAL_VAR messages, e.g.,
+trial_type, fluency, honesty, RT, object_clicked, frequency) and in the behavioural file (trials.addData).
+This script reads all the TRIAL_VAR messages of a study into columns (numbers where all the values are
+numbers, text otherwise), joins them to the rows of the behavioural files on participant and TRIALID, and
+reports every value that is different in the two files (e.g., an RT that was rounded differently, or a trial
+that is missing in one of them).
+
+The files are found as the templates save them:
+- et_results/pp_<participant>/pp_<participant>_merged.asc if the segments were merged (merge_edf_segments.py),
+  otherwise the .asc versions of the segments listed in et_results/pp_<participant>/checkpoint.json
+- behavioural/pp_<participant>.csv, pp_<participant>_2.csv, ... (one per segment)
+
+    python trial_var_merge.py et_results behavioural merged.csv
+
+This saves merged.csv (the behavioural rows with the TRIAL_VAR columns added, as edf_<variable>) and
+merged_mismatches.csv (participant, TRIALID, variable, behavioural value, EDF value). The join is one pass over
+a hash table (a dict with one entry per participant and trial), and the comparisons are done on whole columns,
+so studies with a million trials take seconds, not hours. The .asc files are read in parallel.
+"""
+
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import re
+import sys
+
+import numpy
+
+
+# TRIAL_VAR names that are called differently in the behavioural file (the column of the trial list)
+column_names = {'trial_type': 'trialtype'}
+
+
+def read_trial_vars(asc_file):
+    """The TRIAL_VAR messages of an .asc file
+
+    returns {TRIALID: {variable: value}}, values are text; the last recording of a TRIALID wins
+    """
+
+    trial_vars = {}
+    trial_id = None
+    with open(asc_file) as f:
+        for line in f:
+            if not line.startswith('MSG'):
+                continue
+            words = line.split(None, 5)[2:]
+            if words and words[0].lstrip('-').isdigit(): # '<offset> <message>'
+                words = line.split(None, 6)[3:]
+            if not words:
+                continue
+            if words[0] == 'TRIALID':
+                trial_id = words[1].strip() if len(words) > 1 else ''
+                trial_vars[trial_id] = {}
+            elif trial_id is not None and words[:2] == ['!V', 'TRIAL_VAR'] and len(words) > 2:
+                trial_vars[trial_id][words[2].strip()] = words[3].strip() if len(words) > 3 else ''
+    return trial_vars
+
+
+def participant_asc_files(folder):
+    # the .asc files of a participant folder, in recording order (the merged file if there is one)
+    merged = glob.glob(os.path.join(folder, '*_merged.asc'))
+    if merged:
+        return merged[:1]
+    checkpoint_file = os.path.join(folder, 'checkpoint.json')
+    if os.path.isfile(checkpoint_file):
+        with open(checkpoint_file) as f:
+            segments = json.load(f)['edf_segments']
+        asc_files = [os.path.join(folder, os.path.splitext(os.path.basename(edf_file))[0] + '.asc') for edf_file in segments]
+        return [asc_file for asc_file in asc_files if os.path.isfile(asc_file)]
+    return sorted(glob.glob(os.path.join(folder, '*.asc')))
+
+
+def read_participant(arguments):
+    # for the worker processes: (participant, .asc files) -> (participant, {TRIALID: {variable: value}})
+    participant, asc_files = arguments
+    trial_vars = {}
+    for asc_file in asc_files:
+        trial_vars.update(read_trial_vars(asc_file)) # trials run again in a later segment replace the earlier ones
+    return participant, trial_vars
+
+
+def typed_column(values):
+    # a list of text values -> int64 or float64 array if they are all numbers (empty = NaN), text array otherwise
+    try:
+        numbers = numpy.array([float(value) if value != '' else numpy.nan for value in values], dtype = float)
+    except ValueError:
+        return numpy.array(values, dtype = str)
+    if not numpy.isnan(numbers).any() and numpy.all(numbers == numpy.round(numbers)):
+        return numbers.astype(numpy.int64)
+    return numbers
+
+
+def as_text(column):
+    # column -> text, numbers written without '.0' when they are whole, so '523' and 523.0 are the same value
+    if column.dtype.kind in 'iu':
+        return column.astype(str)
+    if column.dtype.kind == 'f':
+        whole = numpy.isfinite(column) & (column == numpy.round(column))
+        text = column.astype(str)
+        text[whole] = column[whole].astype(numpy.int64).astype(str)
+        text[numpy.isnan(column)] = ''
+        return text
+    return numpy.char.strip(column.astype(str))
+
+
+def different(a, b, tolerance = 1e-6):
+    # for every row, are the two values different? numbers are compared as numbers (two missing values are equal)
+    if a.dtype.kind in 'iuf' and b.dtype.kind in 'iuf':
+        a = a.astype(float)
+        b = b.astype(float)
+        return ~(numpy.isclose(a, b, rtol = 0, atol = tolerance) | (numpy.isnan(a) & numpy.isnan(b)))
+    return as_text(a) != as_text(b)
+
+
+def read_edf_side(et_results, processes = None):
+    """TRIAL_VAR columns of every participant in et_results (folders pp_<participant>)
+
+    returns a table {column: array} with participant, TRIALID and one column per variable
+    """
+
+    folders = sorted(glob.glob(os.path.join(et_results, 'pp_*')))
+    jobs = [(os.path.basename(folder)[3:], participant_asc_files(folder)) for folder in folders]
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(read_participant, jobs)
+    participants = []
+    trial_ids = []
+    values = {}
+    for participant, trial_vars in results:
+        for trial_id, variables in trial_vars.items():
+            if not variables: # e.g., the trial during which the session was aborted
+                continue
+            row = len(participants)
+            participants.append(participant)
+            trial_ids.append(trial_id)
+            for variable, value in variables.items():
+                values.setdefault(variable, ['' for _ in range(row)]).append(value)
+            for variable in values:
+                if len(values[variable]) == row: # a variable this trial did not have
+                    values[variable].append('')
+    table = {'participant': numpy.array(participants, dtype = str), 'TRIALID': numpy.array(trial_ids, dtype = str)}
+    for variable, column in values.items():
+        table[variable] = typed_column(column)
+    return table
+
+
+def read_behavioural_side(behavioural):
+    """The rows of all the behavioural files (pp_<participant>.csv, pp_<participant>_<segment>.csv)
+
+    Practice rows are left out. The TRIALID of a row is the one the template sent: trials of earlier segments of
+    the participant + trials.thisN.
+    returns a table {column: array} with participant, TRIALID and the columns of the files (as text)
+    """
+
+    files = []
+    for path in glob.glob(os.path.join(behavioural, 'pp_*.csv')):
+        match = re.match(r'pp_(.+?)(?:_(\d+))?\.csv$', os.path.basename(path))
+        if match:
+            files.append((match.group(1), int(match.group(2) or 1), path))
+    columns = {'participant': [], 'TRIALID': []}
+    completed = {}
+    for participant, segment, path in sorted(files, key = lambda file: (file[0], file[1])):
+        first_row = len(columns['participant'])
+        with open(path, newline = '') as f:
+            for row in csv.DictReader(f):
+                if row.get('trials.thisN', '') == '':
+                    continue
+                trial_id = completed.get(participant, 0) + int(float(row['trials.thisN']))
+                length = len(columns['participant'])
+                columns['participant'].append(participant)
+                columns['TRIALID'].append(str(trial_id))
+                for column, value in row.items():
+                    if column in ('participant', 'TRIALID'):
+                        continue
+                    columns.setdefault(column, ['' for _ in range(length)]).append(value)
+                for column in columns:
+                    if len(columns[column]) == length:
+                        columns[column].append('')
+        completed[participant] = completed.get(participant, 0) + len(columns['participant']) - first_row
+    return {column: numpy.array(values, dtype = str) for column, values in columns.items()}
+
+
+def hash_join(left_keys, right_keys):
+    """Match the rows of two tables on their keys (lists of tuples)
+
+    returns (left rows, right rows) of the matches, and the rows of each table without a match
+    """
+
+    index = {key: row for row, key in enumerate(right_keys)} # later rows with the same key win
+    right_rows = numpy.fromiter((index.get(key, -1) for key in left_keys), dtype = numpy.int64, count = len(left_keys))
+    matched = right_rows >= 0
+    unmatched_right = numpy.ones(len(right_keys), dtype = bool)
+    unmatched_right[right_rows[matched]] = False
+    return numpy.flatnonzero(matched), right_rows[matched], numpy.flatnonzero(~matched), numpy.flatnonzero(unmatched_right)
+
+
+def merge(et_results, behavioural, output_file, processes = None):
+    """Join the TRIAL_VAR columns to the behavioural rows, save both and the mismatches
+
+    returns the path of the mismatches file and the number of mismatches
+    """
+
+    edf = read_edf_side(et_results, processes)
+    behaviour = read_behavioural_side(behavioural)
+    csv_rows, edf_rows, csv_only, edf_only = hash_join(list(zip(behaviour['participant'], behaviour['TRIALID'])),
+                                                      list(zip(edf['participant'], edf['TRIALID'])))
+
+    mismatches = [] # (participant, TRIALID, variable, behavioural value, EDF value)
+    for variable in edf:
+        column = column_names.get(variable, variable)
+        if variable in ('participant', 'TRIALID') or column not in behaviour:
+            continue
+        edf_values = edf[variable][edf_rows]
+        csv_values = typed_column(list(behaviour[column][csv_rows]))
+        for row in numpy.flatnonzero(different(csv_values, edf_values)):
+            mismatches.append((behaviour['participant'][csv_rows[row]], behaviour['TRIALID'][csv_rows[row]], variable,
+                               behaviour[column][csv_rows[row]], as_text(edf_values[row:row + 1])[0]))
+    for row in csv_only:
+        mismatches.append((behaviour['participant'][row], behaviour['TRIALID'][row], 'TRIALID', behaviour['TRIALID'][row], ''))
+    for row in edf_only:
+        mismatches.append((edf['participant'][row], edf['TRIALID'][row], 'TRIALID', '', edf['TRIALID'][row]))
+
+    # the behavioural rows, with the TRIAL_VAR columns of the matching trial (empty if there is none)
+    variables = [variable for variable in edf if variable not in ('participant', 'TRIALID')]
+    with open(output_file, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(list(behaviour) + ['edf_' + variable for variable in variables])
+        edf_columns = []
+        for variable in variables:
+            text = numpy.full(len(behaviour['participant']), '', dtype = object)
+            text[csv_rows] = as_text(edf[variable][edf_rows])
+            edf_columns.append(text)
+        writer.writerows(zip(*list(behaviour.values()), *edf_columns))
+
+    mismatches_file = os.path.splitext(output_file)[0] + '_mismatches.csv'
+    with open(mismatches_file, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(['participant', 'TRIALID', 'variable', 'behavioural', 'edf'])
+        writer.writerows(mismatches)
+    return mismatches_file, len(mismatches)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print('usage: python trial_var_merge.py <et_results folder> <behavioural folder> <output.csv>')
+        sys.exit(1)
+    mismatches_file, nr_mismatches = merge(*sys.argv[1:4])
+    print('%d mismatches, see %s' % (nr_mismatches, mismatches_file))
@@ -0,0 +1,129 @@
+"""
+Convert gaze positions from pixels to degrees of visual angle
+Course: Eye-tracking in Language Research
+
+Velocities, dispersion and margins around IAs are easier to compare between labs (and screens) in degrees
+of visual angle. The VWP and reading templates save the geometry of the screen (width and height in cm,
+distance to the eyes, resolution) in the participant registry and in the .EDF file (SCREEN_GEOMETRY and
+DISPLAY_COORDS messages).
+
+The position of every pixel column and row in degrees (from the centre of the screen) is computed once per
+screen in a lookup table, so converting millions of samples is an interpolation instead of an arctangent
+per sample:
+
+    import visual_angle
+    screen = visual_angle.Screen.from_asc('et_results/pp_12/12.asc')
+    x_deg, y_deg = screen.to_degrees(x, y)
+    speed = screen.velocity(time, x, y) # degrees/s
+"""
+
+import json
+import sqlite3
+
+import numpy
+
+
+class Screen:
+    """Geometry of a screen: resolution (pixels), size (cm) and distance to the eyes (cm)
+
+    The lookup tables hold the position in degrees of every pixel edge, horizontally and vertically. Positions are in
+    EDF coordinates (0, 0 = top left corner), degrees are measured from the centre of the screen (up is positive).
+    """
+
+    def __init__(self, width_px, height_px, width_cm, height_cm, distance_cm):
+        self.width_px = int(width_px)
+        self.height_px = int(height_px)
+        self.width_cm = float(width_cm)
+        self.height_cm = float(height_cm)
+        self.distance_cm = float(distance_cm)
+        self.pixels_x = numpy.arange(self.width_px + 1, dtype = float)
+        self.pixels_y = numpy.arange(self.height_px + 1, dtype = float)
+        cm_x = (self.pixels_x - self.width_px / 2.0) * self.width_cm / self.width_px
+        cm_y = (self.height_px / 2.0 - self.pixels_y) * self.height_cm / self.height_px
+        self.degrees_x = numpy.degrees(numpy.arctan2(cm_x, self.distance_cm))
+        self.degrees_y = numpy.degrees(numpy.arctan2(cm_y, self.distance_cm))
+
+    @classmethod
+    def from_asc(cls, asc_file, distance_cm = None):
+        # geometry from the DISPLAY_COORDS and SCREEN_GEOMETRY messages at the start of an .asc file
+        resolution = None
+        geometry = None
+        with open(asc_file) as f:
+            for line in f:
+                if line.startswith('MSG') and 'DISPLAY_COORDS' in line:
+                    fields = line.split('DISPLAY_COORDS', 1)[1].split()
+                    resolution = (float(fields[2]) - float(fields[0]) + 1, float(fields[3]) - float(fields[1]) + 1)
+                elif line.startswith('MSG') and 'SCREEN_GEOMETRY' in line:
+                    geometry = [float(value) for value in line.split('SCREEN_GEOMETRY', 1)[1].split()[:3]]
+                elif line.startswith('START'): # the recordings start, no more configuration messages
+                    break
+        if resolution is None or geometry is None:
+            raise ValueError('%s has no DISPLAY_COORDS or SCREEN_GEOMETRY message, use Screen() with the values of your lab' % asc_file)
+        return cls(resolution[0], resolution[1], geometry[0], geometry[1], distance_cm or geometry[2])
+
+    @classmethod
+    def from_registry(cls, registry_file, edf_name):
+        # geometry saved in the participant registry (participants.sqlite) for the session saved as <edf_name>.EDF
+        connection = sqlite3.connect('file:%s?mode=ro' % registry_file, uri = True)
+        try:
+            row = connection.execute('SELECT metadata FROM sessions WHERE edf_name = ?', (edf_name,)).fetchone()
+        finally:
+            connection.close()
+        if row is None or not row[0]:
+            raise ValueError('no session %s in %s' % (edf_name, registry_file))
+        metadata = json.loads(row[0])
+        return cls(metadata['screen_width'], metadata['screen_height'], metadata['screen_width_cm'],
+                   metadata['screen_height_cm'], metadata['screen_distance_cm'])
+
+    def to_degrees(self, x, y):
+        # positions (pixels, EDF coordinates) to degrees from the centre of the screen, NaN stays NaN
+        x = numpy.asarray(x, dtype = float)
+        y = numpy.asarray(y, dtype = float)
+        # the tables only cover the screen, gaze outside of it (rare) is computed directly (numpy.where instead of
+        # assigning to a mask, so that single positions work too); NaN stays NaN in the direct computation
+        direct_x = numpy.degrees(numpy.arctan2((x - self.width_px / 2.0) * self.width_cm / self.width_px, self.distance_cm))
+        direct_y = numpy.degrees(numpy.arctan2((self.height_px / 2.0 - y) * self.height_cm / self.height_px, self.distance_cm))
+        x_deg = numpy.where((x < 0) | (x > self.width_px) | numpy.isnan(x), direct_x, numpy.interp(x, self.pixels_x, self.degrees_x))
+        y_deg = numpy.where((y < 0) | (y > self.height_px) | numpy.isnan(y), direct_y, numpy.interp(y, self.pixels_y, self.degrees_y))
+        return x_deg, y_deg
+
+    def to_pixels(self, x_deg, y_deg):
+        # degrees from the centre of the screen back to pixels (EDF coordinates)
+        x = numpy.interp(x_deg, self.degrees_x, self.pixels_x)
+        y = numpy.interp(y_deg, self.degrees_y[::-1], self.pixels_y[::-1])
+        return x, y
+
+    def pixels_per_degree(self, x = None, y = None):
+        # pixels per degree (horizontal) at the positions x, y; at the centre of the screen if no position is given
+        if x is None:
+            x = self.width_px / 2.0
+        x_deg, _ = self.to_degrees(numpy.atleast_1d(x), numpy.atleast_1d(self.height_px / 2.0 if y is None else y))
+        left, _ = self.to_pixels(x_deg - 0.5, 0)
+        right, _ = self.to_pixels(x_deg + 0.5, 0)
+        return right - left
+
+    def distance(self, x1, y1, x2, y2):
+        # distance in degrees between two (arrays of) positions in pixels
+        x1_deg, y1_deg = self.to_degrees(x1, y1)
+        x2_deg, y2_deg = self.to_degrees(x2, y2)
+        return numpy.hypot(x2_deg - x1_deg, y2_deg - y1_deg)
+
+    def velocity(self, time, x, y):
+        # sample-to-sample velocity (degrees/s), time in ms; the first sample is NaN
+        x_deg, y_deg = self.to_degrees(x, y)
+        speed = numpy.full(len(x_deg), numpy.nan)
+        speed[1:] = numpy.hypot(numpy.diff(x_deg), numpy.diff(y_deg)) / (numpy.diff(numpy.asarray(time, dtype = float)) / 1000.0)
+        return speed
+
+    def dispersion(self, x, y):
+        # dispersion of a set of samples in degrees: (max x - min x) + (max y - min y), ignoring missing data
+        x_deg, y_deg = self.to_degrees(x, y)
+        return (numpy.nanmax(x_deg) - numpy.nanmin(x_deg)) + (numpy.nanmax(y_deg) - numpy.nanmin(y_deg))
+
+    def expand_ia(self, left, top, right, bottom, margin_deg):
+        # an IA (pixels, EDF coordinates) made bigger by margin_deg degrees on every side, e.g., to allow for some inaccuracy
+        left_deg, top_deg = self.to_degrees(numpy.atleast_1d(left), numpy.atleast_1d(top))
+        right_deg, bottom_deg = self.to_degrees(numpy.atleast_1d(right), numpy.atleast_1d(bottom))
+        new_left, new_top = self.to_pixels(left_deg - margin_deg, top_deg + margin_deg)
+        new_right, new_bottom = self.to_pixels(right_deg + margin_deg, bottom_deg - margin_deg)
+        return new_left, new_top, new_right, new_bottom
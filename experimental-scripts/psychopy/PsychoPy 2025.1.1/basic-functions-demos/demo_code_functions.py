@@ -15,8 +15,12 @@ Last updated: 28/08/2024
 
 import pylink
 import os # for path creation
+import sys
 from psychopy import gui, visual, event, logging, data, core
 from EyeLinkCoreGraphicsPsychoPy import EyeLinkCoreGraphicsPsychoPy # for calibration and validation 
+# helper functions shared by all the scripts (experiment_helpers.py, one folder up)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from experiment_helpers import prepare_text_screens, get_text_stim
 
 # Set up a a variable to run the script on a computer not connected to the tracker
 # We will use this variable in a series of if-else statements everytime there would be a line of code calling the tracker
@@ -56,13 +60,16 @@ if not os.path.exists(results_folder):
 local_edf = os.path.join(results_folder, edf_file) # we call this at the end to transfer .EDF from ET PC to STIM PC
 
 # To communicate with participants
+# The screens we know in advance are built once when the window is created (see prepare_text_screens)
+# and any other text reuses a TextStim of text_pool (see experiment_helpers.py), so that PsychoPy only has to compute the text layout once
+
+calibration_text = "The calibration will now start. Press the space bar to start. If you double press 'Enter', you can see the camera on the STIM PC, or 'c' to start calibrating afterwards."
+goodbye_text = "That's the end of the experiment. Press the spacebar to exit."
+
+text_pool = {'screens': {}, 'styles': {}}
 
 def message(message_text = "", response_key = "space", duration = 0, height = None, pos = (0, 0), color = "black"):
-    message_on_screen = visual.TextStim(win, text = "OK")
-    message_on_screen.text    = message_text
-    message_on_screen.height  = height
-    message_on_screen.pos     = pos
-    message_on_screen.color   = color
+    message_on_screen = get_text_stim(win, text_pool, message_text, height, pos, color)
     
     message_on_screen.draw()
     win.flip()
@@ -79,6 +86,10 @@ win = visual.Window(fullscr = True, checkTiming=False, color = (0, 0, 0), units
 # https://discourse.psychopy.org/t/is-there-a-way-to-skip-frame-rate-measurement-on-each-initialisation/36232
 # https://github.com/psychopy/psychopy/issues/5937
 
+# Build the screens we already know (see message())
+
+prepare_text_screens(win, text_pool, [calibration_text, goodbye_text])
+
 win_width = win.size[0]
 win_height = win.size[1]
 
@@ -218,7 +229,7 @@ if not dummy_mode:
     
 # 4. Calibration and validation
 
-message("The calibration will now start. Press the space bar to start. If you double press 'Enter', you can see the camera on the STIM PC, or 'c' to start calibrating afterwards.")
+message(calibration_text)
 
 # In this example, we are not customising the calibration and validation
 
@@ -328,7 +339,7 @@ if not dummy_mode:
 
 # Close & quit PsychoPy
 
-message("That's the end of the experiment. Press the spacebar to exit.")
+message(goodbye_text)
 
 win.close()
 core.quit()
@@ -40,11 +40,15 @@ Last update: 29/08/2024
 # Libraries
 
 from psychopy import gui, visual, event, logging, data, core
-import time, os, numpy
+from psychopy.hardware import keyboard
+import time, os, sys, numpy, threading
 
 # eye-tracking libraries
 import pylink
 from EyeLinkCoreGraphicsPsychoPy import EyeLinkCoreGraphicsPsychoPy # remember to put this script in your folder
+# helper functions shared by all the scripts (experiment_helpers.py, two folders up)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from experiment_helpers import prepare_text_screens, get_text_stim, send_message_at, script_time
 
 # Set up a a variable to run the script on a computer not connected to the tracker
 # We will use this variable in a series of if-else statements everytime there would be a line of code calling the tracker
@@ -85,13 +89,17 @@ if not os.path.exists(results_folder):
 local_edf = os.path.join(results_folder, edf_file) # we call this at the end to transfer .EDF from ET PC to STIM PC
 
 # To communicate with participants
+# The screens we know in advance are built once when the window is created (see prepare_text_screens)
+# and any other text reuses a TextStim of text_pool (see experiment_helpers.py), so that PsychoPy only has to compute the text layout once
+
+calibration_text = "The calibration will now start. Press the space bar to start. If you double press 'Enter', you can see the camera on the STIM PC, or 'c' to start calibrating afterwards."
+start_text = "The experiment will start now. Press the spacebar to continue."
+goodbye_text = "That's the end of the experiment. Press the spacebar to exit."
+
+text_pool = {'screens': {}, 'styles': {}}
 
 def message(message_text = "", response_key = "space", duration = 0, height = None, pos = (0, 0), color = "black"):
-    message_on_screen = visual.TextStim(win, text = "OK")
-    message_on_screen.text    = message_text
-    message_on_screen.height  = height
-    message_on_screen.pos     = pos
-    message_on_screen.color   = color
+    message_on_screen = get_text_stim(win, text_pool, message_text, height, pos, color)
     
     message_on_screen.draw()
     win.flip()
@@ -121,6 +129,64 @@ win = visual.Window(fullscr = True, checkTiming=False, color = (0, 0, 0), units
 # https://discourse.psychopy.org/t/is-there-a-way-to-skip-frame-rate-measurement-on-each-initialisation/36232
 # https://github.com/psychopy/psychopy/issues/5937
 
+# Build the screens we already know (see message())
+
+prepare_text_screens(win, text_pool, [calibration_text, start_text, goodbye_text])
+
+# Keyboard responses
+# psychopy.hardware.keyboard timestamps every key press when it happens (not when we check the keyboard in the trial loop)
+# a background thread picks them up, and the trial loop sends a message to the .EDF file stamped at the key press (see log_responses)
+
+response_keyboard = keyboard.Keyboard()
+response_state = {'running': False, 'thread': None, 'keys': [], 'logged': 0, 'key_list': None, 'message': None, 'not_before': 0, 'pressed': threading.Event()}
+
+def capture_responses():
+    """Pick up the key presses of response_keyboard (background thread, see start_response_capture)
+
+    The keyboard (Psychtoolbox backend) timestamps every key press when it happens (key.tDown), independently of the
+    frame loop. This thread does not talk to the tracker (pylink is not thread-safe): log_responses sends the messages
+    from the main thread, with an offset, so that in the .EDF file they are stamped at the moment of the key press.
+    """
+
+    while response_state['running']:
+        for key in response_keyboard.getKeys(keyList = response_state['key_list'], waitRelease = False):
+            if script_time(key.tDown) < response_state['not_before']: # pressed before the stimulus was on screen
+                continue
+            response_state['keys'].append(key)
+            response_state['pressed'].set()
+        time.sleep(0.001)
+
+def log_responses():
+    # send the message of every key press that has not been logged yet (main thread, see capture_responses)
+    while response_state['logged'] < len(response_state['keys']):
+        key = response_state['keys'][response_state['logged']]
+        if response_state['message'] is not None:
+            send_message_at(et_tracker, response_state['message'], script_time(key.tDown))
+        response_state['logged'] += 1
+
+def start_response_capture(key_list, msg = None, not_before = None):
+    # start listening to the keys in key_list, msg (optional) is sent to the .EDF file at every key press
+    # keys that went down before not_before (core.getTime() clock, e.g., the stimulus onset; default: now) are ignored,
+    # so the capture can start right after the flip without losing the keys pressed in between
+    response_state['not_before'] = core.getTime() if not_before is None else not_before
+    response_state['keys'] = []
+    response_state['logged'] = 0
+    response_state['key_list'] = key_list
+    response_state['message'] = msg
+    response_state['pressed'].clear()
+    response_state['running'] = True
+    response_state['thread'] = threading.Thread(target = capture_responses, daemon = True)
+    response_state['thread'].start()
+
+def stop_response_capture():
+    # stop listening to the keyboard, returns all key presses since start_response_capture
+    if response_state['thread'] is not None:
+        response_state['running'] = False
+        response_state['thread'].join()
+        response_state['thread'] = None
+    log_responses()
+    return response_state['keys']
+
 # Define functions for catching errors
 
 def skip_trial():
@@ -257,7 +323,7 @@ if not dummy_mode:
 
 # In this example, we are not customising the calibration and validation
 
-message("The calibration will now start. Press the space bar to start. If you double press 'Enter', you can see the camera on the STIM PC, or 'c' to start calibrating afterwards.")
+message(calibration_text)
 
 if not dummy_mode:
     genv = EyeLinkCoreGraphicsPsychoPy(et_tracker, win) # we are using openGraphicsEx(), cf. manual openGraphics versus this.
@@ -270,7 +336,7 @@ if not dummy_mode:
 
 # Communicate that the experiment is about to start
 
-message("The experiment will start now. Press the spacebar to continue.")
+message(start_text)
 
 # The experiment
 
@@ -336,12 +402,15 @@ for trial in trials:
 
     text_stimuli.draw()
     image_stimuli.draw()
-    win.flip()
+    img_onset_time = win.flip() # record the image onset time, win.flip() returns the time of the flip
     
-    # send trigger that images have been sent
+    # send trigger that images have been sent, stamped at the flip
     if not dummy_mode:
-        et_tracker.sendMessage('image_onset')
-    img_onset_time = core.getTime()  # record the image onset time
+        send_message_at(et_tracker, 'image_onset', img_onset_time)
+
+    # key_pressed is sent to the .EDF file stamped at the moment the key went down (see log_responses)
+    # keys pressed before the images were on screen are ignored
+    start_response_capture(response_keys, 'key_pressed', img_onset_time)
     
     # show the image for 5-secs or until a key is pressed
     
@@ -359,15 +428,14 @@ for trial in trials:
             et_tracker.sendMessage('tracker_disconnected')
             skip_trial()
             get_keypress = True
+        # responses (h or s) are timestamped by the keyboard, see capture_responses
+        if response_state['pressed'].is_set():
+            log_responses()
+            # get response time in ms, PsychoPy report time in sec
+            RT = int((script_time(response_state['keys'][0].tDown) - img_onset_time)*1000)
+            get_keypress = True
         # check keyboard events
         for keycode, modifier in event.getKeys(modifiers=True):
-            # Stop stimulus presentation when the spacebar is pressed
-            if keycode == 'h' or keycode == 's':
-                # send over a message to log the key press
-                et_tracker.sendMessage('key_pressed')
-                # get response time in ms, PsychoPy report time in sec
-                RT = int((core.getTime() - img_onset_time)*1000)
-                get_keypress = True
             if keycode == 'escape': # for skipping a trial
                 et_tracker.sendMessage('trial_skipped')
                 skip_trial()
@@ -375,6 +443,7 @@ for trial in trials:
             if keycode == 'c' and (modifier['ctrl'] is True): # for terminating experiment
                 et_tracker.sendMessage('experiment_aborted')
                 abort_exp()
+    stop_response_capture()
                 
     # stop recording, save information about the trial & mark trial end in the .EDF file
     
@@ -413,7 +482,7 @@ if not dummy_mode:
 
 # Close & quit PsychoPy
 
-message("That's the end of the experiment. Press the spacebar to exit.")
+message(goodbye_text)
 
 win.close()
 core.quit()
@@ -49,16 +49,46 @@ break_text = u''
 excel_conditions = 'template_reading.xlsx' # write the filename of the excel with the experiment information
 excel_practice = ''  # write the filename of the excel that has information about the practice session, if there is
 
+# behavioural data: every trial is added to behavioural/pp_X.csv as soon as it ends, so nothing is lost after a crash
+data_fsync_every = 10 # force the data to the disk every X trials (more often is safer, but slower)
+data_sidecar = False # True to also save a .parquet copy for analysis at the end of the session (needs pandas and pyarrow)
+
+# trial order: random for every participant, with optional constraints (see randomise_trials)
+max_repeats = {} # column of the excel: maximum number of trials in a row with the same value, e.g., {'frequency': 3}
+order_seed = None # None: a random seed for every participant; a number: the seed of every participant comes from it and the participant number, so orders can be generated again (the seed is saved either way)
+
 # information for the GUI
 
 info = {"Participant number": ""} # You can add more if you want
 
+# participant registry: participant numbers, .EDF names and information about every session (see reserve_session)
+
+registry_file = 'participants.sqlite'
+experiment_name = 'reading' # sessions are registered per experiment, so several experiments can share one registry
+
 # eye-tracker configuration
 
 preamble_text = ''
 sampling_frequency = 1000
 calibration_type = "HV5"
 
+# screen geometry, to work in degrees of visual angle (saved in the participant registry and in the .EDF file)
+screen_width_cm = 53.0 # width of the visible part of the screen
+screen_distance_cm = 70.0 # distance from the eyes to the screen
+
+# drift check: 'every_trial' runs a drift check before every trial, 'adaptive' checks gaze on the drift target first
+# and only runs the drift check (or a new calibration) when the error is too large (see drift_check in experiment_helpers.py)
+drift_check_mode = 'every_trial'
+drift_accept_threshold = 30 # in pixels, below this error the drift check is accepted without the participant noticing
+drift_recalibrate_threshold = 100 # in pixels, above this error we recalibrate
+drift_monitor_duration = 0.3 # in seconds, how long we look at gaze on the drift target
+drift_monitor_timeout = 1.0 # in seconds, how long we wait for samples from the tracker before giving up
+drift_check_every = 20 # in adaptive mode, there is a full drift check every X trials anyway
+
+# online data quality: print precision, data loss and blink rate of every trial in the console (see stop_quality_monitor in experiment_helpers.py)
+quality_monitor = False
+quality_buffer_size = 60000 # number of link samples we keep in memory (60 s at 1000 Hz)
+
 # single sentence reading components
 
 # text parameters
@@ -71,10 +101,27 @@ alignTextStim = 'left'
 languageStyleStim = 'LTR'
 colorText = 'black'
 
+# optional: paragraph reading (see layout_text)
+# the text of every trial is wrapped into lines, starting at position_start_text, and the IAs are made automatically
+# for every word, line or character (the nr_ch_IA columns are not needed). Every trial is one page of text
+paragraph_mode = False
+text_column = 'sentence' # column of the excel with the text
+text_width = 1200 # in pixels, maximum width of a line
+line_spacing = 2.0 # distance between two lines, in line heights (more space makes it easier to tell lines apart in the data)
+lines_per_page = 10 # texts with more lines stop the experiment before it starts
+ia_level = 'word' # IAs sent to the .EDF file: 'word', 'line' or 'character'
+
 # optional: timeout parameters
 timeout = False
 timeout_time = None
 
+# optional: boundary paradigm (gaze-contingent display change, see run_boundary)
+# the sentence starts with a preview at one IA, which changes into the target as soon as the eyes cross an invisible boundary
+boundary_mode = False
+boundary_ia = 2 # number of the IA with the preview (IA1, IA2...), the boundary is at its left edge
+preview_column = 'preview_sentence' # column of the excel with the preview version of the sentence (the 'sentence' column has the target)
+boundary_max_latency = 10 # in ms, display changes that took longer than this are marked with a boundary_late message
+
 ##################################
 ## END COSTUMISATION PARAMETERS ##
 ##################################
@@ -88,6 +135,13 @@ timeout_time = None
 def run_trial(trial, nr_ias, position_start_text, timeout, fontExp, sizeExp, anchorHorizExp, alignTextExp, 
               languageStyleExp, timeout_time = None):
 
+    # Perform drift correction (drift check)
+    # before TRIALID and before anything is drawn, so the drift check (and the gaze monitoring of the adaptive mode)
+    # happens between trials and the drift target is shown on an empty screen
+    # the drift target is where the sentence starts
+    if not dummy_mode:
+        drift_check(et_tracker, win, drift_target, position_start_text, scr_width, scr_height, drift_state, abort_exp)
+
     # draw the text
     # this part is a bit convoluted as we are using the position from the previous piece of text to draw the next one
     # and also to draw areas of interest
@@ -96,51 +150,57 @@ def run_trial(trial, nr_ias, position_start_text, timeout, fontExp, sizeExp, anc
     # mark the beginning of the trial
     # # Send message to the .EDF file (for later data segmentation) and to the ET PC for us
     
-    et_tracker.sendMessage('TRIALID %d' % trials.thisN)
+    et_tracker.sendMessage('TRIALID %d' % (trial_offset + trials.thisN))
 
     # Draw text
 
-    sentence_stimulus = visual.TextStim(win, text = trial['sentence'], units = 'pix', pos = position_start_text,
-                                languageStyle = languageStyleExp, anchorHoriz = anchorHorizExp, alignText = alignTextExp,
-                                font = fontExp, color = colorText)
-    
-    sentence_stimulus.size = sizeExp
-    sentence_stimulus.draw()
-    wS, hS = sentence_stimulus.boundingBox
+    pilot_rects = []
+    if paragraph_mode:
+        # the lines and IAs of every text were computed before the experiment started (see build_text_layouts)
+        layout = layout_text(trial[text_column], position_start_text, fontExp, sizeExp)
+        for line_stim in text_stims(layout, fontExp, sizeExp, anchorHorizExp, alignTextExp, languageStyleExp):
+            line_stim.draw()
+        # all the IAs of the page are loaded from one file
+        msgs_IAs = ['!V IAREA FILE %s' % write_ias_file(layout, ia_level)]
+        if pilot_IAs:
+            for left, top, right, bottom in layout['ias'][ia_level]['rects']:
+                rectIA = pilot_IARect(left, right, top, bottom)
+                rectIA.draw()
+                pilot_rects.append(rectIA)
+    else:
+        sentence_stimulus = make_text_stim(win, trial['sentence'], None, position_start_text, colorText, fontExp, sizeExp,
+                                           languageStyleExp, anchorHorizExp, alignTextExp, units = 'pix')
+        
+        sentence_stimulus.draw()
+        wS, hS = sentence_stimulus.boundingBox
 
-    # Calculate widths
+        # Calculate widths
 
-    widthStims = calculate_WidthIA(sentence_stimulus, wS, hS, trial, nr_ias)
-    left_IAs_EDF, right_IAs_EDF = create_xcoors_ias(nr_ias, widthStims, position_start_text[0])
-    top_EDF, bottom_EDF = create_ycoors_ias(hS, padding, position_start_text[1])
-    msgs_IAs = create_msg_ias(nr_ias, left_IAs_EDF, top_EDF, right_IAs_EDF, bottom_EDF)
+        widthStims = calculate_WidthIA(sentence_stimulus, wS, hS, trial, nr_ias)
+        left_IAs_EDF, right_IAs_EDF = create_xcoors_ias(nr_ias, widthStims, position_start_text[0])
+        top_EDF, bottom_EDF = create_ycoors_ias(hS, padding, position_start_text[1])
+        msgs_IAs = create_msg_ias(nr_ias, left_IAs_EDF, top_EDF, right_IAs_EDF, bottom_EDF)
 
-    # If you want to pilot the IAs
-    
-    if pilot_IAs:
-        for ia in range(nr_ias):
-            rectIA = pilot_IARect(left_IAs_EDF[ia], right_IAs_EDF[ia], top_EDF, bottom_EDF)
-            rectIA.draw()
+        # If you want to pilot the IAs
+        
+        if pilot_IAs:
+            for ia in range(nr_ias):
+                rectIA = pilot_IARect(left_IAs_EDF[ia], right_IAs_EDF[ia], top_EDF, bottom_EDF)
+                rectIA.draw()
+                pilot_rects.append(rectIA)
+
+    # boundary paradigm: both versions of the sentence are ready as textures before recording starts
+    # (single sentences only, the boundary is an IA of the nr_ch_IA columns)
+    if boundary_mode and not paragraph_mode:
+        preview_display, target_display = prepare_boundary_displays(trial, sentence_stimulus, position_start_text, fontExp, sizeExp,
+                                                                    anchorHorizExp, alignTextExp, languageStyleExp, pilot_rects)
+        boundary_x = left_IAs_EDF[boundary_ia - 1]
 
     # record_status_message : show some info on the ET PC
     # here we show how many trial has been tested
     # you could put condition, stimuli, etc. whatever is informative for you
-    status_msg = 'TRIAL number %d' % trials.thisN
+    status_msg = 'TRIAL number %d' % (trial_offset + trials.thisN)
     et_tracker.sendCommand("record_status_message '%s'" % status_msg)
-
-    # Perform drift correction (drift check)
-    # 
-    while not dummy_mode:
-        if (not et_tracker.isConnected()) or et_tracker.breakPressed():
-            abort_exp()
-        try:
-            error = et_tracker.doDriftCorrect(position_start_text[0],
-                                              position_start_text[1], 1, 1)
-            # break following a success drift-check
-            if error is not pylink.ESC_KEY:
-                break
-        except:
-            pass
         
     # Start recording
     
@@ -157,32 +217,41 @@ def run_trial(trial, nr_ias, position_start_text, timeout, fontExp, sizeExp, anc
             print("ERROR:", error)
             skip_trial()
 
-    win.flip() # display text on screen
-    et_tracker.sendMessage('text_onset')
-    my_clock.reset()
+    # follow data quality with the link samples (optional, see read_link_samples in experiment_helpers.py)
+    if quality_monitor and not dummy_mode:
+        start_quality_monitor(et_tracker, link_buffer)
+
+    if boundary_mode and not paragraph_mode:
+        preview_display.draw()
+    win.callOnFlip(my_clock.reset) # my_clock starts when the text is on screen (RTs come from the key timestamps, see script_time)
+    text_onset = flip_with_messages(win, et_tracker, flip_timing, 'text_onset') # display text on screen, text_onset is timestamped at the flip
+
+    # space_pressed is sent to the .EDF file stamped at the moment the key went down (see log_responses)
+    # keys pressed before the text was on screen are ignored
+    start_response_capture(['space'], 'space_pressed', text_onset)
 
-    if not timeout:
-        event.waitKeys(keyList = ['space'])
-        et_tracker.sendMessage('space_pressed')
-        RT = round(my_clock.getTime() * 1000)
+    boundary_latency = None
+    if boundary_mode and not paragraph_mode:
+        boundary_latency = run_boundary(boundary_x, target_display, timeout_time if timeout else None)
+
+    response = wait_response(max(0, timeout_time - (core.getTime() - text_onset)) if timeout else None)
+    stop_response_capture()
+    if response is None:
+        et_tracker.sendMessage('timeout_trial')
+        RT = 'timeout'
     else:
-        keys = event.waitKeys(maxWait = timeout_time, keyList = ['space'])
-        if keys is None:
-            et_tracker.sendMessage('timeout_trial')
-            RT = 'timeout'
-        else:
-            et_tracker.sendMessage('space_pressed')
-            RT = round(my_clock.getTime() * 1000)
+        RT = round((script_time(response.tDown) - text_onset) * 1000)
 
     # stop recording; add 100 msec to catch final events before stopping
     pylink.pumpDelay(100)
     et_tracker.stopRecording()
+    stop_quality_monitor(et_tracker, link_buffer, trial_offset + trials.thisN)
 
     # log information about this trial in the EDF file
     # send Areas of Interest
 
-    for ia in range(nr_ias):
-        et_tracker.sendMessage(msgs_IAs[ia])
+    for msg_IA in msgs_IAs:
+        et_tracker.sendMessage(msg_IA)
         
         ## SEND TEXT TO TRACKER & FOR DATA ANALYSIS IN DATAVIEWER
     
@@ -208,6 +277,8 @@ def run_trial(trial, nr_ias, position_start_text, timeout, fontExp, sizeExp, anc
     
     trials.addData('frequency', trial["frequency"])
     trials.addData('RT', RT)
+    if boundary_mode:
+        trials.addData('boundary_latency', boundary_latency)
     
     # send a 'TRIAL_RESULT' message to mark the end of trial, see Data
     # Viewer User Manual, "Protocol for EyeLink Data to Viewer Integration"
@@ -219,6 +290,43 @@ def run_trial(trial, nr_ias, position_start_text, timeout, fontExp, sizeExp, anc
 
 # These are helper functions
 
+# TextStims for communicating with participants
+# the instruction screens are built once (see prepare_text_screens) and other text reuses a TextStim from text_pool
+# (the functions are in experiment_helpers.py)
+
+text_pool = {'screens': {}, 'styles': {}}
+
+# settings of the drift check and number of trials since the last full drift check (see drift_check in experiment_helpers.py)
+
+drift_state = {'mode': drift_check_mode, 'every': drift_check_every, 'accept_threshold': drift_accept_threshold,
+               'recalibrate_threshold': drift_recalibrate_threshold, 'monitor_duration': drift_monitor_duration,
+               'monitor_timeout': drift_monitor_timeout, 'trials_since_check': 0}
+
+# messages to send at the next flip, and the timing of the previous ones (see flip_with_messages)
+
+flip_timing = {'queue': [], 'flip_time': None, 'offsets': [], 'corrected': []}
+
+# keyboard responses, timestamped by psychopy.hardware.keyboard, picked up in a background thread and logged from the main thread (see capture_responses)
+
+response_state = {'running': False, 'thread': None, 'keys': [], 'logged': 0, 'key_list': None, 'message': None, 'not_before': 0, 'pressed': None}
+
+# width of a character and height of a line per font and size, and the layout of every text (see layout_text)
+
+font_metrics = {}
+text_layouts = {}
+
+# tracker time of the last display change in the boundary paradigm (see run_boundary)
+
+boundary_state = {'change_time': None}
+
+# behavioural file we write to after every trial (see write_data_row)
+
+data_writer = {'file': None, 'path': None, 'writer': None, 'columns': None, 'rows': 0}
+
+# ring buffer for the samples we receive over the link (see read_link_samples in experiment_helpers.py)
+
+link_buffer = {'running': False, 'eye_used': 0, 'write': 0, 'trial_start': 0, 'start_time': 0, 'blinks': 0}
+
 def translate_coordinates(coor_val, scr_width, scr_height, axis = 'x', direction = 'to_edf'):
     if direction == 'to_edf':
         if axis == 'x':
@@ -312,14 +420,116 @@ def create_msg_ias(nr_ias, left_edf, top_edf, right_edf, bottom_edf):
 
     return msg_list
 
+def measure_font(font, size):
+    """Width of one character and height of one line of text, in pixels (the template assumes a monospaced font)
+
+    measured once per font and size with the same kind of TextStim we use for the stimuli
+    """
+
+    if (font, size) not in font_metrics:
+        reference = make_text_stim(win, 'x' * 50, None, (0, 0), colorText, font, size,
+                                   anchorHoriz = 'left', alignText = 'left', units = 'pix')
+        width, height = reference.boundingBox
+        font_metrics[(font, size)] = (width / 50.0, height)
+    return font_metrics[(font, size)]
+
+def wrap_text(text, max_characters):
+    # split text into lines of at most max_characters (words are never split, new lines in the text are kept)
+    # returns a list of lines, every word keeps the space that follows it
+    lines = []
+    for paragraph in text.split('\n'):
+        line = ''
+        for word in paragraph.split():
+            if line and len(line) + len(word) > max_characters:
+                lines.append(line)
+                line = ''
+            line += word + ' '
+        lines.append(line)
+    return lines
+
+def layout_text(text, pos, font, size):
+    """Wrap a text into lines and compute its word, line and character IAs, all at once
+
+    pos is the start of the first line (PsychoPy coordinates). The IAs of every level are numpy arrays
+    (left, top, right, bottom in EDF coordinates) plus a label per IA; neighbouring lines share their IA edges.
+    The result is cached per text, so a stimulus is only laid out once (see build_text_layouts).
+    returns a dictionary with the lines, their y positions (PsychoPy coordinates) and the IAs ('word', 'line', 'character')
+    """
+
+    key = (text, tuple(pos), font, size)
+    if key in text_layouts:
+        return text_layouts[key]
+    char_width, line_height = measure_font(font, size)
+    lines = wrap_text(text, int(text_width // char_width))
+    if len(lines) > lines_per_page:
+        raise ValueError('the text does not fit in %d lines, split it over more trials (pages): %s' % (lines_per_page, text[:50]))
+    pitch = line_height * line_spacing
+    line_y = pos[1] - numpy.arange(len(lines)) * pitch
+
+    # every IA as (line, first character, last character + 1)
+    spans = {'word': [], 'line': [], 'character': []}
+    labels = {'word': [], 'line': [], 'character': []}
+    for i, line in enumerate(lines):
+        spans['line'].append((i, 0, len(line)))
+        labels['line'].append('line_%d' % (i + 1))
+        start = 0
+        for word in line.split():
+            spans['word'].append((i, start, start + len(word) + 1))
+            labels['word'].append(word)
+            start += len(word) + 1
+        spans['character'].extend((i, c, c + 1) for c in range(len(line)))
+        labels['character'].extend(line)
+
+    ias = {}
+    for level in spans:
+        span = numpy.array(spans[level], dtype = float).reshape(-1, 3)
+        left = translate_coordinates(pos[0] + span[:, 1] * char_width, scr_width, scr_height, axis = 'x')
+        right = translate_coordinates(pos[0] + span[:, 2] * char_width, scr_width, scr_height, axis = 'x')
+        top = translate_coordinates(line_y[span[:, 0].astype(int)] + pitch / 2, scr_width, scr_height, axis = 'y')
+        bottom = translate_coordinates(line_y[span[:, 0].astype(int)] - pitch / 2, scr_width, scr_height, axis = 'y')
+        ias[level] = {'rects': numpy.round(numpy.column_stack([left, top, right, bottom])).astype(int), 'labels': labels[level]}
+
+    text_layouts[key] = {'lines': lines, 'line_y': line_y, 'ias': ias, 'stims': None, 'ias_files': {}}
+    return text_layouts[key]
+
+def write_ias_file(layout, level):
+    """Write the IAs of a layout to an interest area file, which Data Viewer loads with one message (!V IAREA FILE)
+
+    The file goes to the aoi folder next to the .EDF file and is named after its content, so it is written once per text.
+    returns the path of the file relative to the .EDF file
+    """
+
+    if level not in layout['ias_files']:
+        rows = ['RECTANGLE\t%d\t%d\t%d\t%d\t%d\t%s\n' % ((ia + 1,) + tuple(rect) + (label.strip() or '_',))
+                for ia, (rect, label) in enumerate(zip(layout['ias'][level]['rects'], layout['ias'][level]['labels']))]
+        content = ''.join(rows)
+        ias_file = 'aoi/%s_%s.ias' % (hashlib.sha1(content.encode('utf-8')).hexdigest()[:16], level)
+        if not os.path.isfile(os.path.join(results_folder, ias_file)):
+            with open(os.path.join(results_folder, ias_file), 'w', encoding = 'utf-8') as f:
+                f.write(content)
+        layout['ias_files'][level] = ias_file
+    return layout['ias_files'][level]
+
+def build_text_layouts(condition_lists, pos, font, size):
+    # lay out all the texts of the experiment before it starts (see layout_text), so errors show up before the first trial
+    os.makedirs(os.path.join(results_folder, 'aoi'), exist_ok = True)
+    for condition_list in condition_lists:
+        for condition in condition_list:
+            layout = layout_text(condition[text_column], pos, font, size)
+            write_ias_file(layout, ia_level)
+
+def text_stims(layout, font, size, anchorHoriz, alignText, languageStyle):
+    # one TextStim per line of the layout, created the first time the text is shown
+    if layout['stims'] is None:
+        layout['stims'] = []
+        for line, y in zip(layout['lines'], layout['line_y']):
+            line_stim = make_text_stim(win, line, None, (position_start_text[0], y), colorText, font, size,
+                                       languageStyle, anchorHoriz, alignText, units = 'pix')
+            layout['stims'].append(line_stim)
+    return layout['stims']
+
 def message(message_text = "", response_key = "space", duration = 0, height = None, pos = (0.0, 0.0), color = colorText, font = fontStim, size = sizeStim, languageStyle = languageStyleStim):
-    message_on_screen = visual.TextStim(win, text = "OK", languageStyle = languageStyle)
-    message_on_screen.text    = message_text
-    message_on_screen.height  = height
-    message_on_screen.pos     = pos
-    message_on_screen.color   = color
-    message_on_screen.size    = size
-    message_on_screen.font    = font
+    message_on_screen = get_text_stim(win, text_pool, message_text, height, pos, color, font, size, languageStyle)
     
     message_on_screen.draw()
     win.flip()
@@ -328,6 +538,128 @@ def message(message_text = "", response_key = "space", duration = 0, height = No
     else:
         time.sleep(duration) # for the feedback
 
+def capture_responses():
+    """Pick up the key presses of response_keyboard (background thread, see start_response_capture)
+
+    The keyboard (Psychtoolbox backend) timestamps every key press when it happens (key.tDown), independently of the
+    frame loop. This thread does not talk to the tracker (pylink is not thread-safe): log_responses sends the messages
+    from the main thread, with an offset, so that in the .EDF file they are stamped at the moment of the key press.
+    """
+
+    while response_state['running']:
+        for key in response_keyboard.getKeys(keyList = response_state['key_list'], waitRelease = False):
+            if script_time(key.tDown) < response_state['not_before']: # pressed before the stimulus was on screen
+                continue
+            response_state['keys'].append(key)
+            response_state['pressed'].set()
+        time.sleep(0.001)
+
+def log_responses():
+    # send the message of every key press that has not been logged yet (main thread, see capture_responses)
+    while response_state['logged'] < len(response_state['keys']):
+        key = response_state['keys'][response_state['logged']]
+        if response_state['message'] is not None:
+            send_message_at(et_tracker, response_state['message'], script_time(key.tDown))
+        response_state['logged'] += 1
+
+def start_response_capture(key_list, msg = None, not_before = None):
+    # start listening to the keys in key_list, msg (optional) is sent to the .EDF file at every key press
+    # keys that went down before not_before (core.getTime() clock, e.g., the stimulus onset; default: now) are ignored,
+    # so the capture can start right after the flip without losing the keys pressed in between
+    response_state['not_before'] = core.getTime() if not_before is None else not_before
+    response_state['keys'] = []
+    response_state['logged'] = 0
+    response_state['key_list'] = key_list
+    response_state['message'] = msg
+    response_state['pressed'].clear()
+    response_state['running'] = True
+    response_state['thread'] = threading.Thread(target = capture_responses, daemon = True)
+    response_state['thread'].start()
+
+def wait_response(max_wait = None):
+    # wait for the first key press (max_wait in seconds, None = no limit), returns the key (psychopy KeyPress) or None
+    deadline = None if max_wait is None else core.getTime() + max_wait
+    while not response_state['pressed'].wait(0.005):
+        event.clearEvents() # keep the window responsive while we wait, the key presses are not read from here
+        read_link_samples(et_tracker, link_buffer)
+        if deadline is not None and core.getTime() >= deadline:
+            return None
+    log_responses()
+    return response_state['keys'][0]
+
+def stop_response_capture():
+    # stop listening to the keyboard, returns all key presses since start_response_capture
+    if response_state['thread'] is not None:
+        response_state['running'] = False
+        response_state['thread'].join()
+        response_state['thread'] = None
+    log_responses()
+    return response_state['keys']
+
+def prepare_boundary_displays(trial, target_stimulus, pos, font, size, anchorHoriz, alignText, languageStyle, extra_stims = []):
+    """Render the preview and the target version of the sentence to textures before the trial starts
+
+    The preview sentence is in the preview_column of the excel, the target sentence is the one in the 'sentence' column.
+    extra_stims (e.g., the rectangles of the IAs when piloting) are added to both displays.
+    returns (preview_display, target_display), two BufferImageStims that only have to be drawn during the trial
+    """
+
+    preview_stimulus = make_text_stim(win, trial[preview_column], None, pos, colorText, font, size,
+                                      languageStyle, anchorHoriz, alignText, units = 'pix')
+    # the back buffer is cleared before each capture, so the two versions are never drawn on top of each other
+    win.clearBuffer()
+    preview_display = visual.BufferImageStim(win, stim = [preview_stimulus] + extra_stims)
+    win.clearBuffer()
+    target_display = visual.BufferImageStim(win, stim = [target_stimulus] + extra_stims)
+    win.clearBuffer()
+    return preview_display, target_display
+
+def record_change_time():
+    # called at the flip of the display change (see run_boundary), tracker time so it can be compared with the samples
+    boundary_state['change_time'] = et_tracker.trackerTime()
+
+def run_boundary(boundary_x, target_display, max_wait = None):
+    """Show target_display as soon as the eyes cross boundary_x (EDF coordinates), or until a response / max_wait
+
+    We check every new link sample (at the sampling rate of the tracker) and flip the window as soon as one is past the
+    boundary, so the display changes at the next refresh. BOUNDARY_CROSSED is stamped at the sample that crossed the
+    boundary and display_change at the flip; their difference (the latency) is also saved as a TRIAL_VAR.
+    returns the latency in ms, or None if the boundary was not crossed
+    """
+
+    if dummy_mode:
+        return None
+    eye_used = et_tracker.eyeAvailable()
+    deadline = None if max_wait is None else core.getTime() + max_wait
+    last_time = None
+    while not response_state['pressed'].is_set():
+        if deadline is not None and core.getTime() >= deadline:
+            return None
+        read_link_samples(et_tracker, link_buffer)
+        sample = et_tracker.getNewestSample()
+        if sample is None or sample.getTime() == last_time:
+            continue
+        last_time = sample.getTime()
+        if eye_used == 1 and sample.isRightSample():
+            gaze_x = sample.getRightEye().getGaze()[0]
+        elif eye_used in [0, 2] and sample.isLeftSample():
+            gaze_x = sample.getLeftEye().getGaze()[0]
+        else:
+            continue
+        if gaze_x == pylink.MISSING_DATA or gaze_x < boundary_x:
+            continue
+        # the eyes crossed the boundary: change the display at the next refresh
+        target_display.draw()
+        win.callOnFlip(record_change_time)
+        flip_with_messages(win, et_tracker, flip_timing, 'display_change')
+        et_tracker.sendMessage('%d BOUNDARY_CROSSED' % round(et_tracker.trackerTime() - last_time))
+        latency = boundary_state['change_time'] - last_time
+        et_tracker.sendMessage('!V TRIAL_VAR boundary_latency %d' % round(latency))
+        if latency > boundary_max_latency:
+            et_tracker.sendMessage('boundary_late')
+        return latency
+    return None
+
 def skip_trial():
     """Ends recording """
     
@@ -337,6 +669,7 @@ def skip_trial():
         # add 100 ms to catch final trial events
         pylink.pumpDelay(100)
         et_tracker.stopRecording()
+        stop_quality_monitor(et_tracker, link_buffer, trial_offset + trials.thisN)
     # Clean the screen
     win.flip()
     # send a message to mark trial end
@@ -374,6 +707,10 @@ def abort_exp():
         # Close the link to the tracker.
         et_tracker.close()
 
+    # make sure the behavioural data is on the disk
+    close_data_writer(data_writer, data_sidecar)
+    update_session(registry_file, edf_name, status = 'aborted', completed_trials = checkpoint['completed'])
+
     # close the PsychoPy window
     win.close()
     core.quit()
@@ -385,33 +722,86 @@ def abort_exp():
 
 # import modules
 
-from psychopy import gui, visual, event, logging, data, sound, clock, core, hardware
-import time, os, numpy
+from psychopy import gui, visual, event, logging, data, sound, clock, core, hardware, monitors
+from psychopy.hardware import keyboard
+import time, os, sys, numpy, threading, hashlib
 
 # eye-tracking libraries
 import pylink
+# helper functions shared by all the scripts (experiment_helpers.py, two folders up)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from experiment_helpers import (make_text_stim, prepare_text_screens, get_text_stim, reserve_session, update_session,
+                                load_checkpoint, new_checkpoint, count_trial_rows, save_checkpoint, open_data_writer,
+                                write_data_row, close_data_writer, send_message_at, script_time, flip_with_messages,
+                                report_flip_timing, drift_check, read_link_samples, start_quality_monitor, stop_quality_monitor)
 #from EyeLinkCoreGraphicsPsychoPy import EyeLinkCoreGraphicsPsychoPy # remember to put this script in your folder & sounds
 
 # display GUI
 
 wk_dir = os.getcwd()
 
+# load in stimuli
+
+trial_list = data.importConditions(excel_conditions) 
+
 ppt_number_taken = True
+resume = False
 while ppt_number_taken:
     infoDlg = gui.DlgFromDict(dictionary = info, title = 'Participant information')
     ppt_number = str(info['Participant number'])
-    edf_name = ppt_number # to obtain EDF file name, you could alternatively use ppt_number
     behavioural_file = 'behavioural/pp_' + ppt_number 
-    edf_file = edf_name + '.EDF' # remember to add the .edf extension
     if not infoDlg.OK: #Quit the experiment if 'Cancel' is selected
         core.quit()
-    if not os.path.isfile(behavioural_file + '.csv'):
+    segment = 1
+    checkpoint_file = os.path.join('et_results/pp_' + ppt_number, 'checkpoint.json')
+    checkpoint = load_checkpoint(checkpoint_file)
+    if checkpoint is not None and not checkpoint['finished'] and checkpoint['edf_segments']:
+        # the last session of this participant did not finish (e.g., the STIM PC crashed), we can continue where it stopped
+        resumeDlg = gui.Dlg(title = 'Resume session')
+        resumeDlg.addText('Participant %s stopped after %d of %d trials. Press OK to resume the session, or Cancel to select another participant number' %
+                          (ppt_number, checkpoint['completed'], len(checkpoint['trial_order'])))
+        resumeDlg.show()
+        if not resumeDlg.OK:
+            continue
+        resume = True
+        segment = len(checkpoint['edf_segments']) + 1
+    # the registry gives us the EDF file name (max. 8 characters), or None if the participant number is in use already
+    if os.path.exists(behavioural_file + ('_%d' % segment if resume else '') + '.csv'):
+        edf_name = None # there is a behavioural file for this participant (and segment) already, we never write over it
+    elif checkpoint is not None and checkpoint['finished']:
+        edf_name = None # this participant did the whole experiment on this computer already
+    else:
+        # the checkpoint is saved before the segment is reserved: if the session stops in between (or before the first
+        # trial), the checkpoint says which segment this computer reserved, and the reservation is used again next time
+        new_session = checkpoint is None
+        if new_session:
+            checkpoint, rng = new_checkpoint(ppt_number, trial_list, max_repeats, order_seed)
+        recover = checkpoint.get('reserved_segment') == segment
+        checkpoint['reserved_segment'] = segment
+        os.makedirs(os.path.dirname(checkpoint_file), exist_ok = True)
+        save_checkpoint(checkpoint_file, checkpoint)
+        edf_name = reserve_session(registry_file, experiment_name, ppt_number, segment, recover)
+        if edf_name is None and new_session:
+            os.remove(checkpoint_file) # the participant number belongs to a session of another computer
+        elif edf_name is None: # the segment belongs to another computer, it is not ours to recover
+            del checkpoint['reserved_segment']
+            save_checkpoint(checkpoint_file, checkpoint)
+    if edf_name is not None:
         ppt_number_taken = False
     else:
+        resume = False
         infoDlg2 = gui.Dlg(title = 'Error') #If the participant number is not unique, present an error msg
         infoDlg2.addText('This participant number is in use already, please select another')
         infoDlg2.show() #For this dlg method we need the .show() for presenting
 
+edf_file = edf_name + '.EDF' # remember to add the .edf extension
+
+# A resumed session is saved in a new .EDF file (segment) and behavioural file
+# use merge_edf_segments.py (data-preprocessing folder) to put the .EDF files back together
+
+if resume:
+    behavioural_file = behavioural_file + '_%d' % segment
+
 # Set up the folder to save .edf files in the STIM PC
 # There is one general folder for eye-tracking data (et_results) and within that folder, one per participant
 # This is because we are also taking screenshots of each trial for later data pre-processing
@@ -421,24 +811,71 @@ if not os.path.exists(results_folder):
     os.makedirs(results_folder)
 local_edf = os.path.join(results_folder, edf_file) # we call this at the end to transfer .EDF from ET PC to STIM PC
 
-# load in stimuli
-
-trial_list = data.importConditions(excel_conditions) 
-trials = data.TrialHandler(trial_list, nReps = 1, method = 'random')
-ThisExp = data.ExperimentHandler(dataFileName = behavioural_file, extraInfo = info)
+# a resumed session continues after the last trial that has a row in the behavioural files: the checkpoint is saved
+# after the row, so after a crash it can be one trial behind (trial_var_merge.py numbers the trials from the rows as well)
+if resume:
+    checkpoint['completed'] = count_trial_rows(['behavioural/pp_' + ppt_number + ('_%d' % k if k > 1 else '') + '.csv'
+                                                for k in range(1, segment)])
+
+info['order_seed'] = checkpoint.get('order_seed')
+checkpoint['edf_segments'].append(edf_file)
+del checkpoint['reserved_segment']
+save_checkpoint(checkpoint_file, checkpoint)
+
+trial_offset = checkpoint['completed'] # trials run in previous segments, so that TRIALID is unique across .EDF files
+remaining_trials = [trial_list[i] for i in checkpoint['trial_order'][trial_offset:]]
+trials = data.TrialHandler(remaining_trials, nReps = 1, method = 'sequential')
+# PsychoPy keeps all the data in memory and only saves it at the end of the experiment, we save every trial ourselves instead
+ThisExp = data.ExperimentHandler(dataFileName = behavioural_file, extraInfo = info, savePickle = False, saveWideText = False)
+open_data_writer(data_writer, behavioural_file + '.csv')
 ThisExp.addLoop(trials)
 
 # create screen
 
-win = visual.Window(fullscr = True, checkTiming=False, color = (1, 1, 1), units = 'pix') # checkTiming is due to PsychoPy's latest release where measuring screen rate is shown to participants, in my case it gets stuck, so adding this parameter to prevent that
+experiment_monitor = monitors.Monitor('experimentMonitor', width = screen_width_cm, distance = screen_distance_cm)
+win = visual.Window(fullscr = True, checkTiming=False, color = (1, 1, 1), units = 'pix', monitor = experiment_monitor) # checkTiming is due to PsychoPy's latest release where measuring screen rate is shown to participants, in my case it gets stuck, so adding this parameter to prevent that
 
 scr_width = win.size[0]
 scr_height = win.size[1]
+experiment_monitor.setSizePix([scr_width, scr_height])
+screen_height_cm = screen_width_cm * scr_height / scr_width # square pixels
+
+# what the pre-processing needs to know about this session
+
+update_session(registry_file, edf_name, edf_file = local_edf, behavioural_file = behavioural_file + '.csv', checkpoint_file = checkpoint_file,
+               resumed = resume, screen_width = int(scr_width), screen_height = int(scr_height), order_seed = checkpoint.get('order_seed'),
+               screen_width_cm = screen_width_cm, screen_height_cm = screen_height_cm, screen_distance_cm = screen_distance_cm)
+
+# build the instruction screens once, message() then only has to draw them
+
+prepare_text_screens(win, text_pool, [welcome_text, explanation_eyetracking, instructions_text, practice_text, break_text, goodbye_text],
+                     color = colorText, font = fontStim, size = sizeStim, languageStyle = languageStyleStim)
+
+# paragraph reading: wrap all the texts and compute their IAs before the experiment starts
+
+if paragraph_mode:
+    build_text_layouts([trial_list] + ([data.importConditions(excel_practice)] if practice and not resume else []),
+                       position_start_text, fontStim, sizeStim)
+
+# preallocate the ring buffer for the online data quality
+
+if quality_monitor:
+    for column in ['time', 'x', 'y', 'pupil']:
+        link_buffer[column] = numpy.zeros(quality_buffer_size)
+
+# drift target for the adaptive drift check (see monitor_drift in experiment_helpers.py)
+
+drift_target = visual.Circle(win, radius = 6, fillColor = 'black', lineColor = 'black', units = 'pix')
 
 # create clock
 
 my_clock = core.Clock()
 
+# keyboard for the responses and the event the capture thread sets when a key is pressed (see capture_responses)
+
+response_keyboard = keyboard.Keyboard()
+response_state['pressed'] = threading.Event()
+
 # start the eye-tracking components
 
 if dummy_mode:
@@ -491,6 +928,10 @@ if not dummy_mode:
     et_tracker.sendCommand("calibration_type = %s" %  calibration_type)
     et_tracker.sendCommand("screen_pixel_coords = 0 0 %d %d" % (scr_width-1, scr_height-1)) # this needs to be modified to the Display PC screen size you are using
     et_tracker.sendMessage("DISPLAY_COORDS 0 0 %d %d" % (scr_width-1, scr_height-1)) # this needs to be modified to the Display PC screen size you are using
+    # physical size of the screen (mm, from the centre) and distance to the eyes, the Host PC uses them for the velocities in degrees
+    et_tracker.sendCommand("screen_phys_coords = %.1f %.1f %.1f %.1f" % (-screen_width_cm * 5, screen_height_cm * 5, screen_width_cm * 5, -screen_height_cm * 5))
+    et_tracker.sendCommand("screen_distance = %d" % round(screen_distance_cm * 10))
+    et_tracker.sendMessage("SCREEN_GEOMETRY %.1f %.1f %.1f" % (screen_width_cm, screen_height_cm, screen_distance_cm)) # for the pre-processing (visual_angle.py)
     
     # get the tracker version to see what data can be stored
     
@@ -545,7 +986,7 @@ message(instructions_text)
 
 # optional: practice session
 
-if practice:
+if practice and not resume:
     practice_list = data.importConditions(excel_practice) 
     ptrials = data.TrialHandler(practice_list, nReps = 1, method = 'random')
     ThisExp.addLoop(ptrials)
@@ -553,11 +994,24 @@ if practice:
     for p_trial in ptrials:
         run_trial(p_trial, nr_images)
         ThisExp.nextEntry()
+        write_data_row(data_writer, ThisExp.entries[-1], data_fsync_every)
 
 ThisExp.addLoop(trials)
 for trial in trials:
     run_trial(trial, nr_images)
     ThisExp.nextEntry()
+    write_data_row(data_writer, ThisExp.entries[-1], data_fsync_every)
+    checkpoint['completed'] += 1
+    save_checkpoint(checkpoint_file, checkpoint)
+
+checkpoint['finished'] = True
+save_checkpoint(checkpoint_file, checkpoint)
+close_data_writer(data_writer, data_sidecar)
+update_session(registry_file, edf_name, status = 'finished', completed_trials = checkpoint['completed'])
+
+# how much did we correct the timing of the onset messages?
+
+report_flip_timing(et_tracker, flip_timing)
 
 # We need to close the data file, transfer it from ET PC to STIM PC and then close the connection between both PCs (plus exist PsychoPy)
 
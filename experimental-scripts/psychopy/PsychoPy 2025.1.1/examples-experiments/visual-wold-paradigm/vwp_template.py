@@ -58,16 +58,48 @@ colorText = 'black'
 excel_conditions = 'template_vwp.xlsx' # write the filename of the excel with the experiment information
 excel_practice = ''  # write the filename of the excel that has information about the practice session, if there is
 
+# behavioural data: every trial is added to behavioural/pp_X.csv as soon as it ends, so nothing is lost after a crash
+data_fsync_every = 10 # force the data to the disk every X trials (more often is safer, but slower)
+data_sidecar = False # True to also save a .parquet copy for analysis at the end of the session (needs pandas and pyarrow)
+
+# trial order: random for every participant, with optional constraints (see randomise_trials)
+max_repeats = {'trialtype': 3} # column of the excel: maximum number of trials in a row with the same value, {} for no constraints
+order_seed = None # None: a random seed for every participant; a number: the seed of every participant comes from it and the participant number, so orders can be generated again (the seed is saved either way)
+balance_target_position = True # show the target (image labelled target_label) equally often at every position
+target_label = 'target'
+
 # information for the GUI
 
 info = {"Participant number": ""} # You can add more if you want
 
+# participant registry: participant numbers, .EDF names and information about every session (see reserve_session)
+
+registry_file = 'participants.sqlite'
+experiment_name = 'vwp' # sessions are registered per experiment, so several experiments can share one registry
+
 # eye-tracker configuration
 
 preamble_text = ''
 sampling_frequency = 1000
 calibration_type = "HV5"
 
+# screen geometry, to work in degrees of visual angle (saved in the participant registry and in the .EDF file)
+screen_width_cm = 53.0 # width of the visible part of the screen
+screen_distance_cm = 70.0 # distance from the eyes to the screen
+
+# drift check: 'every_trial' runs a drift check before every trial, 'adaptive' checks gaze on the drift target first
+# and only runs the drift check (or a new calibration) when the error is too large (see drift_check in experiment_helpers.py)
+drift_check_mode = 'every_trial'
+drift_accept_threshold = 30 # in pixels, below this error the drift check is accepted without the participant noticing
+drift_recalibrate_threshold = 100 # in pixels, above this error we recalibrate
+drift_monitor_duration = 0.3 # in seconds, how long we look at gaze on the drift target
+drift_monitor_timeout = 1.0 # in seconds, how long we wait for samples from the tracker before giving up
+drift_check_every = 20 # in adaptive mode, there is a full drift check every X trials anyway
+
+# online data quality: print precision, data loss and blink rate of every trial in the console (see stop_quality_monitor in experiment_helpers.py)
+quality_monitor = False
+quality_buffer_size = 60000 # number of link samples we keep in memory (60 s at 1000 Hz)
+
 # visual world paradigm components
 
 task_look = 'task' # define whether participants have to do something (mouse) or is a look-and-listen task, options task or look
@@ -75,11 +107,22 @@ nr_images = 4 # write the number of images that are shown on the screen, 2 or 4.
 preview_length = 1.5 # write the time of the preview window
 img_width = 198
 img_height = 198
+image_cache_folder = 'image_cache' # the images resized to img_width x img_height are saved here (see cache_image)
+audio_columns = ['audio1', 'audio2'] # columns of the excel with the sound files (carrier and target)
+audio_sample_rate = 48000 # sample rate of the sound card, sounds are converted to it once (see cache_audio)
+audio_cache_folder = 'audio_cache' # the decoded sounds are saved here
+audio_lead_time = 0.1 # in seconds, sounds are scheduled this far ahead so that the PTB backend can start them on time
 
 # optional: timeout parameters (Note: timeout is only applicable to task VWP)
 timeout = True
 timeout_time = 1 # time for continuing to the next trial
 
+# mouse tracking (task VWP only): the position of the mouse is recorded from target_onset until the click
+# and saved in <edf name>_mouse.bin in the results folder (see save_trajectory)
+mouse_tracking = True
+mouse_sample_rate = 500 # in Hz
+mouse_max_duration = 30 # in seconds, longer trajectories are cut
+
 ##################################
 ## END COSTUMISATION PARAMETERS ##
 ##################################
@@ -91,65 +134,45 @@ timeout_time = 1 # time for continuing to the next trial
 # open the run_trial function to customise the trial as needed (i.e., save conditions of interest, add triggers where necessary)
 
 def run_trial(trial, nr_images):
+
+    # Perform drift correction (drift check)
+    # before TRIALID and before anything is drawn, so the drift check (and the gaze monitoring of the adaptive mode)
+    # happens between trials and the drift target is shown on an empty screen
+    # the drift target is at the center of the screen
+    if not dummy_mode:
+        drift_check(et_tracker, win, drift_target, (0, 0), scr_width, scr_height, drift_state, abort_exp)
     
     # load images
+    # all the images (and the IAs if you are piloting them) are put together in one texture, see compose_display
 
-    if nr_images == 2:
-        positions, image_1, image_2 = create_positions(nr_images, trial)
-        image_1.draw()
-        image_2.draw()
-    elif nr_images == 4:
-        positions, image_1, image_2, image_3, image_4 = create_positions(nr_images, trial)
-        image_1.draw()
-        image_2.draw()
-        image_3.draw()
-        image_4.draw()
+    positions = create_positions(nr_images, trial)
+    display, rects = compose_display(nr_images, trial, positions)
+    display.draw()
 
-    # create msg for ias
-    msg_IAs = create_ias(nr_images, trial, positions)
+    # create msg for ias, with the same rectangles used to draw the images
+    msg_IAs = create_ias(nr_images, trial, rects)
 
     # load sound
     # TO COSTUMISE
     # this assumes two recordings
 
-    carrier_sound = sound.Sound(trial['audio1'])
-    target_sound = sound.Sound(trial['audio2'])
+    carrier_sound = cached_sound(trial['audio1'])
+    target_sound = cached_sound(trial['audio2'])
     
     carrier_sound.setVolume(1.0)
     target_sound.setVolume(1.0)
 
 
-    # if you want to pilot the areas of interest
-
-    if pilot_IAs:
-        for ia in range(nr_images):
-            rectIA = pilot_IARect(ia, positions, img_width, img_height)
-            rectIA.draw()
-
-
     # mark the beginning of the trial
     # # Send message to the .EDF file (for later data segmentation) and to the ET PC for us
     
-    et_tracker.sendMessage('TRIALID %d' % trials.thisN)
+    et_tracker.sendMessage('TRIALID %d' % (trial_offset + trials.thisN))
 
     # record_status_message : show some info on the ET PC
     # here we show how many trial has been tested
     # you could put condition, stimuli, etc. whatever is informative for you
-    status_msg = 'TRIAL number %d' % trials.thisN
+    status_msg = 'TRIAL number %d' % (trial_offset + trials.thisN)
     et_tracker.sendCommand("record_status_message '%s'" % status_msg)
-
-    # Perform drift correction (drift check)
-    while not dummy_mode:
-        if (not et_tracker.isConnected()) or et_tracker.breakPressed():
-            abort_exp()
-        try:
-            error = et_tracker.doDriftCorrect(int(scr_width/2.0),
-                                              int(scr_height/2.0), 1, 1)
-            # break following a success drift-check
-            if error is not pylink.ESC_KEY:
-                break
-        except:
-            pass
         
     # Start recording
     
@@ -165,12 +188,15 @@ def run_trial(trial, nr_images):
         except RuntimeError as error:
             print("ERROR:", error)
             skip_trial()
+
+    # follow data quality with the link samples (optional, see read_link_samples in experiment_helpers.py)
+    if quality_monitor and not dummy_mode:
+        start_quality_monitor(et_tracker, link_buffer)
     
     mouse.setVisible(visible = False)  # hide the mouse during preview window + audio
 
-    win.flip()
-    et_tracker.sendMessage('preview_onset')
-    preview_onset = core.getTime()
+    # display the images, preview_onset is timestamped at the flip
+    preview_onset = flip_with_messages(win, et_tracker, flip_timing, 'preview_onset')
 
     # tracking mouse clicks
     mouseIsDown = False
@@ -180,6 +206,7 @@ def run_trial(trial, nr_images):
     trialSkipped = False
 
     while True:
+        read_link_samples(et_tracker, link_buffer)
         # catch the error during the preview window
         error = et_tracker.isRecording()
         if error is not pylink.TRIAL_OK:
@@ -200,25 +227,22 @@ def run_trial(trial, nr_images):
             # if we haven't skipped the trial or aborted the experiment after the preview window
             if core.getTime() - preview_onset >= preview_length:
                 if instructionPlayed == False and trialSkipped == False:
-                    carrier_sound.play()
-                    # send trigger audio onset
-                    et_tracker.sendMessage('audio_onset')
-                    print("audio onset")
-                    clock.wait(carrier_sound.getDuration() )
-                    carrier_sound.stop()
+                    # queue both sounds against the same clock: the target starts exactly when the carrier ends
+                    sound_onsets, sound_end = schedule_sounds([carrier_sound, target_sound],
+                                                              [audio_cache[trial['audio1']]['duration'], audio_cache[trial['audio2']]['duration']])
+                    audio_triggers = [('audio_onset', sound_onsets[0]), ('target_onset', sound_onsets[1]), ('target_offset', sound_end)]
+                    if task_look == 'task':
+                        start_mouse_tracking(sound_onsets[1])
                     instructionPlayed = True
                 if instructionPlayed == True and targetPlayed == False and trialSkipped == False:
-                    target_sound.play()
-                    # send trigger target onset
-                    et_tracker.sendMessage('target_onset')
-                    print("target onset")
-                    clock.wait(target_sound.getDuration())
-                    target_sound.stop()
-                    # send trigger target offset
-                    et_tracker.sendMessage('target_offset')
-                    my_clock.reset()
-                    targetPlayed = True
-                    mouse.setPos(newPos=(0, 0))
+                    # send the triggers once their time has passed, stamped with the scheduled time
+                    while len(audio_triggers) > 0 and core.getTime() >= audio_triggers[0][1]:
+                        trigger, trigger_time = audio_triggers.pop(0)
+                        send_message_at(et_tracker, trigger, trigger_time)
+                    if len(audio_triggers) == 0:
+                        my_clock.reset(sound_end - core.getTime()) # the clock is 0 at the (scheduled) end of the target, RTs are measured from there
+                        targetPlayed = True
+                        mouse.setPos(newPos=(0, 0))
                 if targetPlayed == True and audioFinished == False and trialSkipped == False:
                     mouse.setVisible(visible = True)
                     if timeout:
@@ -258,6 +282,22 @@ def run_trial(trial, nr_images):
                     abort_exp()
         else:
             break
+
+    # in case the trial was skipped while the sounds were playing (or still scheduled)
+    carrier_sound.stop()
+    target_sound.stop()
+
+    # mouse trajectory, from target_onset until the click (time 0 is the end of the target, as for RT)
+    mouse_samples = stop_mouse_tracking()
+    if mouse_samples is not None and not trialSkipped:
+        # the trajectory as it is saved and read by mouse_trajectories.py: float32, time in ms from the end of the target
+        trajectory = numpy.column_stack([(mouse_samples[:, 0] - sound_end) * 1000, mouse_samples[:, 1:]]).astype(numpy.float32)
+        save_trajectory(trial_offset + trials.thisN, trajectory)
+        # the measures of mouse_trajectories.py on the same numbers, so the behavioural file and the offline analysis agree
+        # (from time 0: the mouse is only visible, and back at 0, 0, after the target)
+        mouse_metrics = {metric: values[0].item() for metric, values in trajectory_metrics(trajectory[None]).items()}
+    else:
+        mouse_metrics = None
                     
     # log information about areas of interest
     # in DataViewer, coordinates start at the top, left corner (i.e., 0,0)
@@ -276,6 +316,7 @@ def run_trial(trial, nr_images):
     # stop recording; add 100 msec to catch final events before stopping
     pylink.pumpDelay(100)
     et_tracker.stopRecording()
+    stop_quality_monitor(et_tracker, link_buffer, trial_offset + trials.thisN)
 
     # log information about this trial in the EDF file
     ### COSTUMISE WITH WHATEVER INFORMATION YOU WANT TO STORE IN THE EDF FILE
@@ -291,6 +332,9 @@ def run_trial(trial, nr_images):
     
     trials.addData('RT', RT)
     trials.addData('object_clicked', object_clicked)
+    if mouse_metrics is not None:
+        for metric in ['md', 'auc', 'x_flips']:
+            trials.addData('mouse_' + metric, mouse_metrics[metric])
         
     # send a 'TRIAL_RESULT' message to mark the end of trial, see Data
     # Viewer User Manual, "Protocol for EyeLink Data to Viewer Integration"
@@ -302,6 +346,42 @@ def run_trial(trial, nr_images):
 
 # These are helper functions
 
+# TextStims for communicating with participants
+# the instruction screens are built once (see prepare_text_screens) and other text reuses a TextStim from text_pool
+# (the functions are in experiment_helpers.py)
+
+text_pool = {'screens': {}, 'styles': {}}
+
+# settings of the drift check and number of trials since the last full drift check (see drift_check in experiment_helpers.py)
+
+drift_state = {'mode': drift_check_mode, 'every': drift_check_every, 'accept_threshold': drift_accept_threshold,
+               'recalibrate_threshold': drift_recalibrate_threshold, 'monitor_duration': drift_monitor_duration,
+               'monitor_timeout': drift_monitor_timeout, 'trials_since_check': 0}
+
+# images resized to the display size, by file name (see build_image_cache)
+
+image_cache = {}
+
+# decoded sounds and their duration, by file name (see build_audio_cache)
+
+audio_cache = {}
+
+# messages to send at the next flip, and the timing of the previous ones (see flip_with_messages)
+
+flip_timing = {'queue': [], 'flip_time': None, 'offsets': [], 'corrected': []}
+
+# behavioural file we write to after every trial (see write_data_row)
+
+data_writer = {'file': None, 'path': None, 'writer': None, 'columns': None, 'rows': 0}
+
+# ring buffer for the samples we receive over the link (see read_link_samples in experiment_helpers.py)
+
+link_buffer = {'running': False, 'eye_used': 0, 'write': 0, 'trial_start': 0, 'start_time': 0, 'blinks': 0}
+
+# mouse trajectory of the current trial, recorded in a background thread into a preallocated array (see sample_mouse)
+
+mouse_buffer = {'running': False, 'thread': None, 'samples': None, 'n': 0, 'start_time': 0, 'file': None}
+
 def translate_coordinates(coor_val, scr_width, scr_height, axis = 'x', direction = 'to_edf'):
     if direction == 'to_edf':
         if axis == 'x':
@@ -327,19 +407,6 @@ def calculate_edges_image(image, positions, img_width, img_height):
     bottom_pix = y + half_h
     return left_pix, right_pix, top_pix, bottom_pix
 
-def pilot_IARect(image, positions, img_width, img_height):
-
-    left_pix, right_pix, top_pix, bottom_pix = calculate_edges_image(image, positions, img_width, img_height)
-    
-    center_x = (left_pix + right_pix)/2
-    center_y = (top_pix + bottom_pix)/2
-
-    width = abs(right_pix - left_pix)
-    height = abs(bottom_pix - top_pix)
-
-    rectIA = visual.Rect(win, width=width, height=height, pos=(center_x, center_y), fillColor = 'None', lineColor = 'red', units = 'pix')
-    return rectIA
-
 def calculate_object_clicked(x_coor, y_coor, nr_images, trial, positions):
     # y increases upwards in PsychoPy 'pix'
     for image in range(nr_images):
@@ -349,28 +416,100 @@ def calculate_object_clicked(x_coor, y_coor, nr_images, trial, positions):
             return trial[f'image_{image+1}_label']
     return 'none'  # if no hit
 
-def create_ias(nr_images, trial, positions):
+def create_ias(nr_images, trial, rects):
 
     # log information about areas of interest
     # in DataViewer, coordinates start at the top, left corner (i.e., 0,0)
     # RECTANGLE <id> <left> <top> <right> <bottom> [label]
-    # we need to know the size of the images and the size of the screen
+    # rects are already in EDF coordinates (see image_rects)
     
     msg_list = []
     for i in range(nr_images):
-        x, y = positions[i][0], positions[i][1]
-        # Convert center-origin (PsychoPy) to top-left origin (DataViewer/EDF)
-        left   = int(scr_width / 2 + (x - img_width/2))
-        right  = int(scr_width / 2 + (x + img_width/2))
-        # For Y, invert because DataViewer Y grows downward
-        top    = int(scr_height / 2 - (y + img_height/2))
-        bottom = int(scr_height / 2 - (y - img_height/2))
+        left, top, right, bottom = rects[i]
 
         label = trial[f'image_{i+1}_label']
         msg = f'!V IAREA RECTANGLE {i+1} {left} {top} {right} {bottom} IA{i+1}_{label}'
         msg_list.append(msg)
     return msg_list
 
+def cache_image(image_file):
+    """Resize an image to img_width x img_height once and keep it in image_cache_folder
+
+    The cached file (.npy) is named after the content of the image (hash) and the display size, so it is rebuilt
+    if the image or the size changes. It holds the RGB values in PsychoPy's range (-1 to 1), upside down
+    because OpenGL textures start at the bottom row, ready to be uploaded as a texture.
+    returns the image as a memory-mapped array
+    """
+
+    with open(image_file, 'rb') as f:
+        image_hash = hashlib.sha1(f.read()).hexdigest()
+    cache_file = os.path.join(image_cache_folder, '%s_%dx%d.npy' % (image_hash, img_width, img_height))
+    if not os.path.isfile(cache_file):
+        image = Image.open(image_file).convert('RGB').resize((int(img_width), int(img_height)), Image.LANCZOS)
+        pixels = numpy.asarray(image, dtype = numpy.float32) / 127.5 - 1
+        numpy.save(cache_file, numpy.ascontiguousarray(numpy.flipud(pixels)))
+    return numpy.load(cache_file, mmap_mode = 'r')
+
+def build_image_cache(condition_lists):
+    # resize all the images of the experiment before it starts (see cache_image), instead of in every trial
+    if not os.path.exists(image_cache_folder):
+        os.makedirs(image_cache_folder)
+    for condition_list in condition_lists:
+        for trial in condition_list:
+            for i in range(nr_images):
+                image_file = trial[f'image_{i+1}_ID']
+                if image_file not in image_cache:
+                    image_cache[image_file] = cache_image(image_file)
+
+def image_rects(nr_images, positions):
+    # rectangle of every image on the screen (left, top, right, bottom), in EDF coordinates (top-left origin)
+    rects = []
+    for i in range(nr_images):
+        x, y = positions[i][0], positions[i][1]
+        left = int(round(scr_width / 2 + x - img_width / 2))
+        top = int(round(scr_height / 2 - y - img_height / 2))
+        rects.append((left, top, left + int(img_width), top + int(img_height)))
+    return rects
+
+def compose_display(nr_images, trial, positions):
+    """Put all the images of a trial (and the IA rectangles when piloting) in one texture
+
+    The display is then drawn with a single ImageStim (one draw call), and the images are copied from image_cache
+    without any resizing. The canvas only covers the area with images, the rest of the screen is the window colour.
+    returns the ImageStim with the display and the rectangles of the images (see image_rects), used for the IAs
+    """
+
+    rects = image_rects(nr_images, positions)
+    area_left = min(rect[0] for rect in rects)
+    area_top = min(rect[1] for rect in rects)
+    area_right = max(rect[2] for rect in rects)
+    area_bottom = max(rect[3] for rect in rects)
+
+    # like the cached images, the rows of the canvas go from the bottom to the top (OpenGL)
+    canvas = numpy.empty((area_bottom - area_top, area_right - area_left, 3), dtype = numpy.float32)
+    canvas[:] = numpy.asarray(win.color, dtype = numpy.float32)[:3]
+    for i, (left, top, right, bottom) in enumerate(rects):
+        row = area_bottom - bottom
+        column = left - area_left
+        canvas[row:row + int(img_height), column:column + int(img_width)] = image_cache[trial[f'image_{i+1}_ID']]
+        if pilot_IAs: # red outline of the IA
+            red = (1, -1, -1)
+            canvas[row:row + 2, column:column + int(img_width)] = red
+            canvas[row + int(img_height) - 2:row + int(img_height), column:column + int(img_width)] = red
+            canvas[row:row + int(img_height), column:column + 2] = red
+            canvas[row:row + int(img_height), column + int(img_width) - 2:column + int(img_width)] = red
+
+    # an ImageStim has no text layout: the new image only replaces the texture, and the size and position only
+    # change the vertices, which we update only when the area with images is not the same as in the previous trial
+    display_stim.image = canvas
+    size = (area_right - area_left, area_bottom - area_top)
+    pos = ((area_left + area_right) / 2 - scr_width / 2, scr_height / 2 - (area_top + area_bottom) / 2)
+    if tuple(display_stim.size) != size:
+        display_stim.size = size
+    if tuple(display_stim.pos) != pos:
+        display_stim.pos = pos
+    return display_stim, rects
+
 def create_positions(nr_images, trial):
     # Place images at the four quadrants in PIXELS (center-origin)
     # x: left/right offsets ~ quarter of screen width
@@ -388,35 +527,15 @@ def create_positions(nr_images, trial):
     else:
         raise ValueError("nr_images must be 2 or 4 for this template.")
 
-    numpy.random.shuffle(positions)
-
-    # Always set size explicitly
-    if nr_images == 2:
-        image_1 = visual.ImageStim(win, image=trial["image_1_ID"],
-                                   pos=positions[0], size=(img_width, img_height), units='pix')
-        image_2 = visual.ImageStim(win, image=trial["image_2_ID"],
-                                   pos=positions[1], size=(img_width, img_height), units='pix')
-        return positions, image_1, image_2
+    if 'image_layout' in trial: # positions decided at the start of the session (see balance_target_positions)
+        positions = [positions[p] for p in trial['image_layout']]
+    else:
+        numpy.random.shuffle(positions)
 
-    elif nr_images == 4:
-        image_1 = visual.ImageStim(win, image=trial["image_1_ID"],
-                                   pos=positions[0], size=(img_width, img_height), units='pix')
-        image_2 = visual.ImageStim(win, image=trial["image_2_ID"],
-                                   pos=positions[1], size=(img_width, img_height), units='pix')
-        image_3 = visual.ImageStim(win, image=trial["image_3_ID"],
-                                   pos=positions[2], size=(img_width, img_height), units='pix')
-        image_4 = visual.ImageStim(win, image=trial["image_4_ID"],
-                                   pos=positions[3], size=(img_width, img_height), units='pix')
-        return positions, image_1, image_2, image_3, image_4
+    return positions
     
 def message(message_text = "", response_key = "space", duration = 0, height = None, pos = (0.0, 0.0), color = colorText, font = fontStim, size = sizeStim, languageStyle = languageStyleStim):
-    message_on_screen = visual.TextStim(win, text = "OK", languageStyle = languageStyle)
-    message_on_screen.text    = message_text
-    message_on_screen.height  = height
-    message_on_screen.pos     = pos
-    message_on_screen.color   = color
-    message_on_screen.size    = size
-    message_on_screen.font    = font
+    message_on_screen = get_text_stim(win, text_pool, message_text, height, pos, color, font, size, languageStyle)
     
     message_on_screen.draw()
     win.flip()
@@ -425,6 +544,146 @@ def message(message_text = "", response_key = "space", duration = 0, height = No
     else:
         time.sleep(duration) # for the feedback
 
+def sample_mouse():
+    """Store the position of the mouse in mouse_buffer at mouse_sample_rate, from mouse_buffer['start_time'] on
+
+    This runs in a background thread (see start_mouse_tracking), so the trial loop does not do any extra work.
+    The mouse position is updated by the window events, which the trial loop handles all the time (event.getKeys).
+    """
+
+    period = 1.0 / mouse_sample_rate
+    samples = mouse_buffer['samples']
+    next_time = mouse_buffer['start_time']
+    n = 0
+    while mouse_buffer['running'] and n < len(samples):
+        now = core.getTime()
+        if now < next_time:
+            time.sleep(min(next_time - now, 0.0005))
+            continue
+        samples[n, 0] = now
+        samples[n, 1:] = mouse.getPos()
+        n += 1
+        mouse_buffer['n'] = n
+        next_time = max(next_time + period, now) # if we fell behind, we do not try to catch up with a burst of samples
+
+def start_mouse_tracking(start_time):
+    # start recording the mouse trajectory at start_time (core.getTime() clock, e.g., the onset of the target)
+    if not mouse_tracking:
+        return
+    mouse_buffer['n'] = 0
+    mouse_buffer['start_time'] = start_time
+    mouse_buffer['running'] = True
+    mouse_buffer['thread'] = threading.Thread(target = sample_mouse, daemon = True)
+    mouse_buffer['thread'].start()
+
+def stop_mouse_tracking():
+    # stop recording the mouse trajectory, returns the samples of this trial (time, x, y), or None
+    if mouse_buffer['thread'] is None:
+        return None
+    mouse_buffer['running'] = False
+    mouse_buffer['thread'].join()
+    mouse_buffer['thread'] = None
+    return mouse_buffer['samples'][:mouse_buffer['n']]
+
+def save_trajectory(trial_id, trajectory):
+    """Append the trajectory of a trial to the mouse sidecar file (<edf name>_mouse.bin in the results folder)
+
+    Every trial is saved as two int32 (TRIALID, number of samples) followed by the samples as float32
+    (trajectory: time in ms, x, y in pixels, centre of the screen = 0, 0). Read it with
+    mouse_trajectories.py (data-preprocessing folder).
+    """
+
+    if mouse_buffer['file'] is None:
+        return
+    mouse_buffer['file'].write(numpy.array([trial_id, len(trajectory)], dtype = numpy.int32).tobytes())
+    mouse_buffer['file'].write(trajectory.tobytes())
+    mouse_buffer['file'].flush()
+
+def balance_target_positions(trial_list, trial_order, rng):
+    """Decide where every image goes in every trial, so that the target is shown equally often at every position
+
+    returns one layout per trial (in the order of trial_order): layout[i] is the position (see create_positions) of image i+1
+    trials without an image labelled target_label get a random layout
+    """
+
+    nr_targets = sum(target_label in [trial_list[i][f'image_{j+1}_label'] for j in range(nr_images)] for i in trial_order)
+    target_positions = [int(p) for p in numpy.resize(numpy.arange(nr_images), nr_targets)]
+    rng.shuffle(target_positions)
+
+    layouts = []
+    for i in trial_order:
+        labels = [trial_list[i][f'image_{j+1}_label'] for j in range(nr_images)]
+        free_positions = [int(p) for p in rng.permutation(nr_images)]
+        layout = [None] * nr_images
+        if target_label in labels:
+            target_position = target_positions.pop()
+            layout[labels.index(target_label)] = target_position
+            free_positions.remove(target_position)
+        for j in range(nr_images):
+            if layout[j] is None:
+                layout[j] = free_positions.pop()
+        layouts.append(layout)
+    return layouts
+
+def cache_audio(audio_file):
+    """Decode a sound file (.wav, .mp3) once to PCM at audio_sample_rate and keep it in audio_cache_folder
+
+    The cached file (.npy) is named after the content of the sound file (hash) and the sample rate, so it is rebuilt
+    if the file or the sample rate changes.
+    returns the samples (float32, -1 to 1, one column per channel) as a memory-mapped array
+    """
+
+    with open(audio_file, 'rb') as f:
+        audio_hash = hashlib.sha1(f.read()).hexdigest()
+    cache_file = os.path.join(audio_cache_folder, '%s_%d.npy' % (audio_hash, audio_sample_rate))
+    if not os.path.isfile(cache_file):
+        samples, file_rate = soundfile.read(audio_file, dtype = 'float32', always_2d = True)
+        if file_rate != audio_sample_rate:
+            common = math.gcd(int(file_rate), int(audio_sample_rate))
+            samples = resample_poly(samples, audio_sample_rate // common, file_rate // common, axis = 0)
+        numpy.save(cache_file, numpy.clip(samples, -1, 1).astype(numpy.float32))
+    return numpy.load(cache_file, mmap_mode = 'r')
+
+def build_audio_cache(condition_lists):
+    # decode all the sounds of the experiment before it starts (see cache_audio), instead of in every trial
+    if not os.path.exists(audio_cache_folder):
+        os.makedirs(audio_cache_folder)
+    for condition_list in condition_lists:
+        for trial in condition_list:
+            for column in audio_columns:
+                audio_file = trial[column]
+                if audio_file not in audio_cache:
+                    samples = cache_audio(audio_file)
+                    # the exact duration comes from the number of samples
+                    audio_cache[audio_file] = {'samples': numpy.array(samples), 'duration': len(samples) / audio_sample_rate}
+                    print('%s: %d samples, %.4f s' % (audio_file, len(samples), audio_cache[audio_file]['duration']))
+
+def cached_sound(audio_file):
+    # a Sound from the decoded samples (see build_audio_cache), no decoding or disk access during the trial
+    return sound.Sound(value = audio_cache[audio_file]['samples'], sampleRate = audio_sample_rate)
+
+def schedule_sounds(sounds, durations = None, lead_time = audio_lead_time):
+    """Schedule sounds to play one after the other, without gaps (PTB audio backend)
+
+    The PTB backend expects the onsets (when) in PTB time (ptb.GetSecs(), i.e., core.getTime(applyZero = False)), not in the
+    time since PsychoPy started (core.getTime()). The sounds are queued in PTB time, so their onsets do not depend on when
+    Python gets to run, and the onsets are converted back to core.getTime() for the messages (see send_message_at).
+    durations: duration of every sound in seconds (e.g., from build_audio_cache), by default sound.getDuration()
+    returns the onset of every sound and the end of the last one (core.getTime() clock)
+    """
+
+    if durations is None:
+        durations = [audio.getDuration() for audio in sounds]
+    ptb_now = core.getTime(applyZero = False)
+    zero = ptb_now - core.getTime() # start of core.getTime() in PTB time
+    onset = ptb_now + lead_time
+    onsets = []
+    for audio, duration in zip(sounds, durations):
+        audio.play(when = onset)
+        onsets.append(onset - zero)
+        onset += duration
+    return onsets, onset - zero
+
 def skip_trial():
     """Ends recording """
     
@@ -434,6 +693,7 @@ def skip_trial():
         # add 100 ms to catch final trial events
         pylink.pumpDelay(100)
         et_tracker.stopRecording()
+        stop_quality_monitor(et_tracker, link_buffer, trial_offset + trials.thisN)
     # Clean the screen
     win.flip()
     # send a message to mark trial end
@@ -471,6 +731,12 @@ def abort_exp():
         # Close the link to the tracker.
         et_tracker.close()
 
+    # make sure the behavioural data is on the disk
+    close_data_writer(data_writer, data_sidecar)
+    if mouse_buffer['file'] is not None:
+        mouse_buffer['file'].close()
+    update_session(registry_file, edf_name, status = 'aborted', completed_trials = checkpoint['completed'])
+
     # close the PsychoPy window
     win.close()
     core.quit()
@@ -485,33 +751,93 @@ def abort_exp():
 from psychopy import prefs
 prefs.hardware['audioLib'] = ['PTB']  # force PTB first
 
-from psychopy import gui, visual, event, logging, data, sound, clock, core, hardware
-import time, os, numpy
+from psychopy import gui, visual, event, logging, data, sound, clock, core, hardware, monitors
+import time, os, sys, numpy, threading, hashlib, math
+import soundfile
+from scipy.signal import resample_poly
+from PIL import Image
 
 # eye-tracking libraries
 import pylink
+# helper functions shared by all the scripts (experiment_helpers.py, two folders up)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from experiment_helpers import (prepare_text_screens, get_text_stim, reserve_session, update_session, load_checkpoint,
+                                new_checkpoint, count_trial_rows, save_checkpoint, open_data_writer, write_data_row,
+                                close_data_writer, send_message_at, flip_with_messages, report_flip_timing, drift_check,
+                                read_link_samples, start_quality_monitor, stop_quality_monitor)
+# the mouse measures are computed by the pre-processing script, so online and offline values are the same
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', '..', '..', 'data-preprocessing', 'python'))
+from mouse_trajectories import trajectory_metrics
 #from EyeLinkCoreGraphicsPsychoPy import EyeLinkCoreGraphicsPsychoPy # remember to put this script in your folder & sounds
 
 # display GUI
 
 wk_dir = os.getcwd()
 
+# load in stimuli
+
+trial_list = data.importConditions(excel_conditions) 
+
 ppt_number_taken = True
+resume = False
 while ppt_number_taken:
     infoDlg = gui.DlgFromDict(dictionary = info, title = 'Participant information')
     ppt_number = str(info['Participant number'])
-    edf_name = ppt_number # to obtain EDF file name, you could alternatively use ppt_number
     behavioural_file = 'behavioural/pp_' + ppt_number 
-    edf_file = edf_name + '.EDF' # remember to add the .edf extension
     if not infoDlg.OK: #Quit the experiment if 'Cancel' is selected
         core.quit()
-    if not os.path.isfile(behavioural_file + '.csv'):
+    segment = 1
+    checkpoint_file = os.path.join('et_results/pp_' + ppt_number, 'checkpoint.json')
+    checkpoint = load_checkpoint(checkpoint_file)
+    if checkpoint is not None and not checkpoint['finished'] and checkpoint['edf_segments']:
+        # the last session of this participant did not finish (e.g., the STIM PC crashed), we can continue where it stopped
+        resumeDlg = gui.Dlg(title = 'Resume session')
+        resumeDlg.addText('Participant %s stopped after %d of %d trials. Press OK to resume the session, or Cancel to select another participant number' %
+                          (ppt_number, checkpoint['completed'], len(checkpoint['trial_order'])))
+        resumeDlg.show()
+        if not resumeDlg.OK:
+            continue
+        resume = True
+        segment = len(checkpoint['edf_segments']) + 1
+    # the registry gives us the EDF file name (max. 8 characters), or None if the participant number is in use already
+    if os.path.exists(behavioural_file + ('_%d' % segment if resume else '') + '.csv'):
+        edf_name = None # there is a behavioural file for this participant (and segment) already, we never write over it
+    elif checkpoint is not None and checkpoint['finished']:
+        edf_name = None # this participant did the whole experiment on this computer already
+    else:
+        # the checkpoint is saved before the segment is reserved: if the session stops in between (or before the first
+        # trial), the checkpoint says which segment this computer reserved, and the reservation is used again next time
+        new_session = checkpoint is None
+        if new_session:
+            checkpoint, rng = new_checkpoint(ppt_number, trial_list, max_repeats, order_seed)
+            if balance_target_position:
+                checkpoint['image_layouts'] = balance_target_positions(trial_list, checkpoint['trial_order'], rng)
+        recover = checkpoint.get('reserved_segment') == segment
+        checkpoint['reserved_segment'] = segment
+        os.makedirs(os.path.dirname(checkpoint_file), exist_ok = True)
+        save_checkpoint(checkpoint_file, checkpoint)
+        edf_name = reserve_session(registry_file, experiment_name, ppt_number, segment, recover)
+        if edf_name is None and new_session:
+            os.remove(checkpoint_file) # the participant number belongs to a session of another computer
+        elif edf_name is None: # the segment belongs to another computer, it is not ours to recover
+            del checkpoint['reserved_segment']
+            save_checkpoint(checkpoint_file, checkpoint)
+    if edf_name is not None:
         ppt_number_taken = False
     else:
+        resume = False
         infoDlg2 = gui.Dlg(title = 'Error') #If the participant number is not unique, present an error msg
         infoDlg2.addText('This participant number is in use already, please select another')
         infoDlg2.show() #For this dlg method we need the .show() for presenting
 
+edf_file = edf_name + '.EDF' # remember to add the .edf extension
+
+# A resumed session is saved in a new .EDF file (segment) and behavioural file
+# use merge_edf_segments.py (data-preprocessing folder) to put the .EDF files back together
+
+if resume:
+    behavioural_file = behavioural_file + '_%d' % segment
+
 # Set up the folder to save .edf files in the STIM PC
 # There is one general folder for eye-tracking data (et_results) and within that folder, one per participant
 # This is because we are also taking screenshots of each trial for later data pre-processing
@@ -521,19 +847,76 @@ if not os.path.exists(results_folder):
     os.makedirs(results_folder)
 local_edf = os.path.join(results_folder, edf_file) # we call this at the end to transfer .EDF from ET PC to STIM PC
 
-# load in stimuli
+# a resumed session continues after the last trial that has a row in the behavioural files: the checkpoint is saved
+# after the row, so after a crash it can be one trial behind (trial_var_merge.py numbers the trials from the rows as well)
+if resume:
+    checkpoint['completed'] = count_trial_rows(['behavioural/pp_' + ppt_number + ('_%d' % k if k > 1 else '') + '.csv'
+                                                for k in range(1, segment)])
 
-trial_list = data.importConditions(excel_conditions) 
-trials = data.TrialHandler(trial_list, nReps = 1, method = 'random')
-ThisExp = data.ExperimentHandler(dataFileName = behavioural_file, extraInfo = info)
+info['order_seed'] = checkpoint.get('order_seed')
+checkpoint['edf_segments'].append(edf_file)
+del checkpoint['reserved_segment']
+save_checkpoint(checkpoint_file, checkpoint)
+
+trial_offset = checkpoint['completed'] # trials run in previous segments, so that TRIALID is unique across .EDF files
+remaining_trials = []
+for k in range(trial_offset, len(checkpoint['trial_order'])):
+    trial = dict(trial_list[checkpoint['trial_order'][k]])
+    if 'image_layouts' in checkpoint:
+        trial['image_layout'] = checkpoint['image_layouts'][k] # see create_positions
+    remaining_trials.append(trial)
+trials = data.TrialHandler(remaining_trials, nReps = 1, method = 'sequential')
+
+# resize the images and decode the sounds once (the caches are kept between participants), trials only have to use them
+
+experiment_lists = [trial_list] + ([data.importConditions(excel_practice)] if practice and not resume else [])
+build_image_cache(experiment_lists)
+build_audio_cache(experiment_lists)
+# PsychoPy keeps all the data in memory and only saves it at the end of the experiment, we save every trial ourselves instead
+ThisExp = data.ExperimentHandler(dataFileName = behavioural_file, extraInfo = info, savePickle = False, saveWideText = False)
+open_data_writer(data_writer, behavioural_file + '.csv')
 
 
 # create screen
 
-win = visual.Window(fullscr = True, checkTiming=False, color = (1, 1, 1), units = 'pix') # checkTiming is due to PsychoPy's latest release where measuring screen rate is shown to participants, in my case it gets stuck, so adding this parameter to prevent that
+experiment_monitor = monitors.Monitor('experimentMonitor', width = screen_width_cm, distance = screen_distance_cm)
+win = visual.Window(fullscr = True, checkTiming=False, color = (1, 1, 1), units = 'pix', monitor = experiment_monitor) # checkTiming is due to PsychoPy's latest release where measuring screen rate is shown to participants, in my case it gets stuck, so adding this parameter to prevent that
 
 scr_width = win.size[0]
 scr_height = win.size[1]
+experiment_monitor.setSizePix([scr_width, scr_height])
+screen_height_cm = screen_width_cm * scr_height / scr_width # square pixels
+
+# what the pre-processing needs to know about this session
+
+update_session(registry_file, edf_name, edf_file = local_edf, behavioural_file = behavioural_file + '.csv', checkpoint_file = checkpoint_file,
+               resumed = resume, screen_width = int(scr_width), screen_height = int(scr_height), order_seed = checkpoint.get('order_seed'),
+               screen_width_cm = screen_width_cm, screen_height_cm = screen_height_cm, screen_distance_cm = screen_distance_cm)
+
+# build the instruction screens once, message() then only has to draw them
+
+prepare_text_screens(win, text_pool, [welcome_text, explanation_eyetracking, instructions_text, practice_text, break_text, goodbye_text],
+                     color = colorText, font = fontStim, size = sizeStim, languageStyle = languageStyleStim)
+
+# preallocate the ring buffer for the online data quality
+
+if quality_monitor:
+    for column in ['time', 'x', 'y', 'pupil']:
+        link_buffer[column] = numpy.zeros(quality_buffer_size)
+
+# one ImageStim for the whole VWP display (see compose_display)
+
+display_stim = visual.ImageStim(win, units = 'pix', interpolate = False)
+
+# preallocate the mouse trajectory buffer and open the mouse sidecar file (task VWP)
+
+if task_look == 'task' and mouse_tracking:
+    mouse_buffer['samples'] = numpy.zeros((int(mouse_max_duration * mouse_sample_rate), 3))
+    mouse_buffer['file'] = open(os.path.join(results_folder, edf_name + '_mouse.bin'), 'ab')
+
+# drift target for the adaptive drift check (see monitor_drift in experiment_helpers.py)
+
+drift_target = visual.Circle(win, radius = 6, fillColor = 'black', lineColor = 'black', units = 'pix')
 
 # create clock
 
@@ -595,6 +978,10 @@ if not dummy_mode:
     et_tracker.sendCommand("calibration_type = %s" %  calibration_type)
     et_tracker.sendCommand("screen_pixel_coords = 0 0 %d %d" % (scr_width-1, scr_height-1)) # this needs to be modified to the Display PC screen size you are using
     et_tracker.sendMessage("DISPLAY_COORDS 0 0 %d %d" % (scr_width-1, scr_height-1)) # this needs to be modified to the Display PC screen size you are using
+    # physical size of the screen (mm, from the centre) and distance to the eyes, the Host PC uses them for the velocities in degrees
+    et_tracker.sendCommand("screen_phys_coords = %.1f %.1f %.1f %.1f" % (-screen_width_cm * 5, screen_height_cm * 5, screen_width_cm * 5, -screen_height_cm * 5))
+    et_tracker.sendCommand("screen_distance = %d" % round(screen_distance_cm * 10))
+    et_tracker.sendMessage("SCREEN_GEOMETRY %.1f %.1f %.1f" % (screen_width_cm, screen_height_cm, screen_distance_cm)) # for the pre-processing (visual_angle.py)
     
     # get the tracker version to see what data can be stored
     
@@ -650,7 +1037,7 @@ message(instructions_text)
 
 # optional: practice session
 
-if practice:
+if practice and not resume:
     practice_list = data.importConditions(excel_practice) 
     ptrials = data.TrialHandler(practice_list, nReps = 1, method = 'random')
     ThisExp.addLoop(ptrials)
@@ -658,11 +1045,26 @@ if practice:
     for p_trial in ptrials:
         run_trial(p_trial, nr_images)
         ThisExp.nextEntry()
+        write_data_row(data_writer, ThisExp.entries[-1], data_fsync_every)
 
 ThisExp.addLoop(trials)
 for trial in trials:
     run_trial(trial, nr_images)
     ThisExp.nextEntry()
+    write_data_row(data_writer, ThisExp.entries[-1], data_fsync_every)
+    checkpoint['completed'] += 1
+    save_checkpoint(checkpoint_file, checkpoint)
+
+checkpoint['finished'] = True
+save_checkpoint(checkpoint_file, checkpoint)
+close_data_writer(data_writer, data_sidecar)
+update_session(registry_file, edf_name, status = 'finished', completed_trials = checkpoint['completed'])
+if mouse_buffer['file'] is not None:
+    mouse_buffer['file'].close()
+
+# how much did we correct the timing of the onset messages?
+
+report_flip_timing(et_tracker, flip_timing)
 
 # We need to close the data file, transfer it from ET PC to STIM PC and then close the connection between both PCs (plus exist PsychoPy)
 
@@ -0,0 +1,541 @@
+# Helper functions shared by the scripts of this folder (the templates and the demos import them from here,
+# so there is only one copy to maintain)
+# everything the functions need (window, tracker...) is passed as an argument, nothing is taken from the scripts
+
+from psychopy import core, visual
+import time, os, csv, json, re, sqlite3, zlib
+import numpy
+
+import pylink
+
+def make_text_stim(win, message_text, height, pos, color, font = '', size = None, languageStyle = 'LTR',
+                   anchorHoriz = 'center', alignText = 'center', units = ''):
+    # all properties are given when the TextStim is created, so the text layout is only computed once
+    # (setting them one by one afterwards rebuilds the layout every time)
+    # TextStim has no size argument: setting .size only changes the letter height, so the size is given as the height
+    if size is not None:
+        height = size
+    return visual.TextStim(win, text = message_text, height = height, pos = pos, color = color, units = units,
+                           font = font, languageStyle = languageStyle, anchorHoriz = anchorHoriz, alignText = alignText)
+
+# TextStims for communicating with participants
+# the screens we know in advance are built once (see prepare_text_screens) and other text reuses a TextStim of the pool
+# the pool is a dict kept by the script: text_pool = {'screens': {}, 'styles': {}}
+
+def text_style(height, color, font, size, languageStyle):
+    # the properties that change how a piece of text looks, used to find a TextStim that can be reused
+    return (height, str(color), font, size, languageStyle)
+
+def prepare_text_screens(win, text_pool, screen_texts, height = None, pos = (0.0, 0.0), color = 'black', font = '', size = None, languageStyle = 'LTR'):
+    # build the instruction screens (welcome, instructions, breaks...) once at the beginning of the experiment
+    for screen_text in screen_texts:
+        if screen_text == '':
+            continue
+        style = text_style(height, color, font, size, languageStyle)
+        text_pool['screens'][(screen_text, style)] = make_text_stim(win, screen_text, height, pos, color, font, size, languageStyle)
+
+def get_text_stim(win, text_pool, message_text, height, pos, color, font = '', size = None, languageStyle = 'LTR'):
+    style = text_style(height, color, font, size, languageStyle)
+    if (message_text, style) in text_pool['screens']: # instruction screens built with prepare_text_screens
+        text_stim = text_pool['screens'][(message_text, style)]
+    elif style in text_pool['styles']: # other text (e.g., feedback) reuses a TextStim with the same style, so only the text changes
+        text_stim = text_pool['styles'][style]
+        if text_stim.text != message_text:
+            text_stim.text = message_text
+    else:
+        text_stim = make_text_stim(win, message_text, height, pos, color, font, size, languageStyle)
+        text_pool['styles'][style] = text_stim
+    # the position does not change the text layout
+    if tuple(text_stim.pos) != tuple(pos):
+        text_stim.pos = pos
+    return text_stim
+
+def monitor_drift(et_tracker, win, drift_target, target_pos, scr_width, scr_height, duration, timeout = 1.0):
+    """Measure how far gaze is from the drift target, using the samples sent over the link
+
+    Run it between trials (before TRIALID): the samples only go over the link, nothing is written to the .EDF file.
+
+    target_pos: position of the drift target in PsychoPy coordinates (pixels, center-origin)
+    duration: how long we look at gaze on the target (in seconds), from the first sample we get
+    timeout: how long we wait for the first sample (in seconds) before giving up
+    returns the median distance (in pixels) between gaze and the target, or None if there were not enough valid samples
+    """
+
+    drift_target.pos = target_pos
+    drift_target.draw()
+    win.flip()
+
+    # gaze coordinates in the samples are in EDF coordinates (top-left origin)
+    target_x = scr_width / 2 + target_pos[0]
+    target_y = scr_height / 2 - target_pos[1]
+
+    # arguments: sample_to_file, events_to_file, sample_over_link, event_over_link (1-yes, 0-no)
+    et_tracker.setOfflineMode()
+    try:
+        error = et_tracker.startRecording(0, 0, 1, 0)
+    except RuntimeError as err:
+        print('ERROR:', err)
+        return None
+    if error: # the tracker could not start recording
+        print('ERROR: startRecording returned', error)
+        return None
+    eye_used = et_tracker.eyeAvailable()
+
+    errors = []
+    nr_samples = 0
+    last_sample_time = None
+    first_sample_onset = None
+    monitor_onset = core.getTime()
+    while True:
+        now = core.getTime()
+        if first_sample_onset is None and now - monitor_onset > timeout: # no samples over the link
+            break
+        if first_sample_onset is not None and now - first_sample_onset >= duration:
+            break
+        core.wait(0.001, hogCPUperiod = 0) # let the link fill up instead of asking for samples in a busy loop
+        sample = et_tracker.getNewestSample()
+        if sample is None or sample.getTime() == last_sample_time:
+            continue
+        if first_sample_onset is None:
+            first_sample_onset = now
+        last_sample_time = sample.getTime()
+        nr_samples += 1
+        if eye_used == 1 and sample.isRightSample():
+            gaze_x, gaze_y = sample.getRightEye().getGaze()
+        elif eye_used in [0, 2] and sample.isLeftSample():
+            gaze_x, gaze_y = sample.getLeftEye().getGaze()
+        else:
+            continue
+        if gaze_x == pylink.MISSING_DATA or gaze_y == pylink.MISSING_DATA: # e.g., blinks
+            continue
+        errors.append(((gaze_x - target_x) ** 2 + (gaze_y - target_y) ** 2) ** 0.5)
+
+    et_tracker.stopRecording()
+
+    # we need valid gaze for at least half of the samples to trust the measure
+    if nr_samples == 0 or len(errors) < nr_samples / 2:
+        return None
+    return float(numpy.median(errors))
+
+def drift_check(et_tracker, win, drift_target, target_pos, scr_width, scr_height, drift_state, abort_exp):
+    """Drift check before a trial
+
+    With drift_state['mode'] = 'every_trial' this is the usual drift check (doDriftCorrect) before every trial.
+    With drift_state['mode'] = 'adaptive' we first look at gaze on the drift target (see monitor_drift) and:
+    - accept the drift check if the error is below drift_state['accept_threshold']
+    - run the usual drift check if the error is between drift_state['accept_threshold'] and drift_state['recalibrate_threshold']
+    - recalibrate if the error is above drift_state['recalibrate_threshold']
+    Every decision is logged in the .EDF file: DRIFT_MONITOR <decision> <error in pixels>
+
+    target_pos: position of the drift target in PsychoPy coordinates (pixels, center-origin)
+    drift_state: the settings of the script and the number of trials since the last full drift check
+    abort_exp: called when the tracker is disconnected or the experimenter presses Ctrl-C on the Host PC
+    """
+
+    if drift_state['mode'] == 'adaptive':
+        drift_state['trials_since_check'] += 1
+        if drift_state['trials_since_check'] >= drift_state['every']: # a full drift check every now and then, no matter what
+            et_tracker.sendMessage('DRIFT_MONITOR CHECK scheduled')
+        else:
+            error = monitor_drift(et_tracker, win, drift_target, target_pos, scr_width, scr_height,
+                                  drift_state['monitor_duration'], drift_state['monitor_timeout'])
+            error_msg = 'NA' if error is None else '%.1f' % error
+            if error is not None and error <= drift_state['accept_threshold']:
+                et_tracker.sendMessage('DRIFT_MONITOR ACCEPT %s' % error_msg)
+                return
+            if error is not None and error > drift_state['recalibrate_threshold']:
+                et_tracker.sendMessage('DRIFT_MONITOR RECALIBRATE %s' % error_msg)
+                try:
+                    et_tracker.doTrackerSetup()
+                except RuntimeError as err:
+                    print('ERROR:', err)
+                    et_tracker.exitCalibration()
+                drift_state['trials_since_check'] = 0
+                return
+            et_tracker.sendMessage('DRIFT_MONITOR CHECK %s' % error_msg)
+        drift_state['trials_since_check'] = 0
+
+    # Perform drift correction (drift check)
+    # doDriftCorrect expects EDF coordinates (top-left origin)
+    while True:
+        if (not et_tracker.isConnected()) or et_tracker.breakPressed():
+            abort_exp()
+        try:
+            error = et_tracker.doDriftCorrect(int(scr_width / 2 + target_pos[0]),
+                                              int(scr_height / 2 - target_pos[1]), 1, 1)
+            # break following a success drift-check
+            if error is not pylink.ESC_KEY:
+                break
+        except:
+            pass
+
+# Participant registry (SQLite): participant numbers, .EDF names and information about every session
+
+def open_registry(registry_file):
+    # connection to the participant registry (SQLite), the table is created the first time
+    connection = sqlite3.connect(registry_file, timeout = 30, isolation_level = None)
+    connection.execute('''CREATE TABLE IF NOT EXISTS sessions (
+                              experiment TEXT NOT NULL,
+                              participant TEXT NOT NULL,
+                              segment INTEGER NOT NULL,
+                              edf_name TEXT NOT NULL UNIQUE,
+                              status TEXT NOT NULL,
+                              started TEXT NOT NULL,
+                              finished TEXT,
+                              metadata TEXT,
+                              PRIMARY KEY (experiment, participant, segment))''')
+    return connection
+
+def reserve_session(registry_file, experiment_name, participant, segment = 1, recover = False):
+    """Reserve a participant number (segment 1) or a new segment of a resumed session in the registry
+
+    The check and the reservation happen in one transaction, so two computers can never get the same participant number.
+    The .EDF name is the participant number (plus _<segment> for resumed sessions) if it fits in the 8 characters
+    the Host PC allows, otherwise P followed by 7 digits.
+    registry_file: the SQLite file of the registry (several experiments can share one, the sessions are kept per experiment_name)
+    recover: this computer reserved the segment before but stopped before it was added to the checkpoint (see the
+    participant dialog), so the reservation is used again if it is still the last segment of the participant
+    returns the .EDF name (without extension), or None if the participant number is in use already
+    """
+
+    connection = open_registry(registry_file)
+    try:
+        connection.execute('BEGIN IMMEDIATE') # nobody else can write to the registry until we are done
+        if recover:
+            reserved = connection.execute('SELECT edf_name FROM sessions WHERE experiment = ? AND participant = ? AND segment = ? AND status = ?',
+                                          (experiment_name, participant, segment, 'running')).fetchone()
+            later = connection.execute('SELECT COUNT(*) FROM sessions WHERE experiment = ? AND participant = ? AND segment > ?',
+                                       (experiment_name, participant, segment)).fetchone()[0]
+            if reserved is not None and later == 0:
+                connection.execute('COMMIT')
+                return reserved[0]
+        taken = connection.execute('SELECT COUNT(*) FROM sessions WHERE experiment = ? AND participant = ? AND segment >= ?',
+                                   (experiment_name, participant, segment)).fetchone()[0]
+        if taken > 0:
+            connection.execute('ROLLBACK')
+            return None
+        edf_name = participant if segment == 1 else '%s_%d' % (participant, segment)
+        nr_sessions = connection.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+        while (re.fullmatch('[A-Za-z0-9_]{1,8}', edf_name) is None or
+               connection.execute('SELECT COUNT(*) FROM sessions WHERE edf_name = ?', (edf_name,)).fetchone()[0] > 0):
+            nr_sessions += 1
+            edf_name = 'P%07d' % nr_sessions
+        connection.execute('INSERT INTO sessions (experiment, participant, segment, edf_name, status, started) VALUES (?, ?, ?, ?, ?, ?)',
+                           (experiment_name, participant, segment, edf_name, 'running', time.strftime('%Y-%m-%d %H:%M:%S')))
+        connection.execute('COMMIT')
+        return edf_name
+    finally:
+        connection.close()
+
+def update_session(registry_file, edf_name, status = None, **metadata):
+    # save information about the session in the registry (e.g., files, screen), used by the pre-processing scripts
+    connection = open_registry(registry_file)
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        saved = connection.execute('SELECT metadata FROM sessions WHERE edf_name = ?', (edf_name,)).fetchone()
+        session_metadata = json.loads(saved[0]) if saved is not None and saved[0] else {}
+        session_metadata.update(metadata)
+        connection.execute('UPDATE sessions SET metadata = ? WHERE edf_name = ?', (json.dumps(session_metadata), edf_name))
+        if status is not None:
+            connection.execute('UPDATE sessions SET status = ?, finished = ? WHERE edf_name = ?',
+                               (status, time.strftime('%Y-%m-%d %H:%M:%S'), edf_name))
+        connection.execute('COMMIT')
+    finally:
+        connection.close()
+
+# Trial order
+
+def fits_order(trial_list, order, candidate, max_repeats):
+    # would adding trial 'candidate' to 'order' break any of the max_repeats constraints?
+    for column, max_nr in max_repeats.items():
+        if len(order) >= max_nr and all(trial_list[i][column] == trial_list[candidate][column] for i in order[-max_nr:]):
+            return False
+    return True
+
+def randomise_trials(trial_list, max_repeats, rng, max_attempts = 1000):
+    """Random trial order that respects max_repeats (e.g., no more than 3 trials of the same trialtype in a row)
+
+    We shuffle the trials and build the order one trial at a time, taking the first remaining trial that does not
+    break a constraint. If we get stuck (no remaining trial fits), we start again with a new shuffle.
+    max_repeats: {column of the excel: maximum number of trials in a row with the same value}, {} for no constraints
+    rng: numpy random generator (numpy.random.default_rng), seeded so that the order can be reproduced
+    returns the order as a list of indices of trial_list
+    """
+
+    for attempt in range(max_attempts):
+        remaining = [int(i) for i in rng.permutation(len(trial_list))]
+        order = []
+        while len(remaining) > 0:
+            for k, candidate in enumerate(remaining):
+                if fits_order(trial_list, order, candidate, max_repeats):
+                    order.append(remaining.pop(k))
+                    break
+            else:
+                break # stuck, try again
+        if len(remaining) == 0:
+            return order
+    raise ValueError('Could not find a trial order with max_repeats = %s, check whether the constraints are possible' % max_repeats)
+
+# Checkpoints: the progress of a session, to resume it after a crash
+
+def load_checkpoint(checkpoint_file):
+    # returns the checkpoint of a previous session of this participant, or None if there is none
+    if not os.path.isfile(checkpoint_file):
+        return None
+    with open(checkpoint_file) as f:
+        return json.load(f)
+
+def new_checkpoint(participant, trial_list, max_repeats, order_seed = None):
+    """The checkpoint of a new session, before its first .EDF file (segment) is reserved
+
+    The random order of the trials is decided here (and not by the TrialHandler) and saved in the checkpoint
+    after every trial, so that the session can be resumed at the next trial after a crash.
+    The seed is saved as well (checkpoint and behavioural file), so the order can be generated again.
+    order_seed: None for a new random order every session, or a number so that every participant number always gets the same order
+    returns the checkpoint and the random generator, to decide other random things of the session (e.g., where the images go)
+    """
+
+    if order_seed is None:
+        seed = int(numpy.random.SeedSequence().entropy % 2**32)
+    else:
+        seed = (order_seed + zlib.crc32(participant.encode())) % 2**32
+    rng = numpy.random.default_rng(seed)
+    checkpoint = {'participant': participant,
+                  'order_seed': seed,
+                  'trial_order': randomise_trials(trial_list, max_repeats, rng),
+                  'completed': 0,
+                  'edf_segments': [],
+                  'finished': False}
+    return checkpoint, rng
+
+def count_trial_rows(data_files):
+    # number of trials (rows with trials.thisN, so not the practice trials) in the behavioural files of earlier segments
+    count = 0
+    for data_file in data_files:
+        if os.path.isfile(data_file):
+            with open(data_file, newline = '') as f:
+                count += sum(1 for row in csv.DictReader(f) if row.get('trials.thisN', '') != '')
+    return count
+
+def save_checkpoint(checkpoint_file, checkpoint):
+    """Save the progress of the session: trial order, number of completed trials and .EDF files (segments)
+
+    We write a temporary file first and then replace the old checkpoint, so a crash while writing never leaves a broken checkpoint
+    """
+
+    tmp_file = checkpoint_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, checkpoint_file)
+
+# Behavioural file (.csv), written one row at a time
+
+def open_data_writer(data_writer, data_file):
+    # open the behavioural file (.csv) we add a row to after every trial (see write_data_row)
+    # data_writer: the dict the script keeps the state of the file in, {'file': None, 'path': None, 'writer': None, 'columns': None, 'rows': 0}
+    # mode 'x': we never add rows to an old file (every session and every resumed segment has its own file)
+    folder = os.path.dirname(data_file)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    data_writer['file'] = open(data_file, 'x', newline = '')
+    data_writer['path'] = data_file
+
+def new_data_writer(data_writer, columns):
+    # (re)create the csv writer for these columns
+    data_writer['columns'] = columns
+    data_writer['writer'] = csv.DictWriter(data_writer['file'], fieldnames = columns, restval = '', extrasaction = 'ignore')
+
+def add_data_columns(data_writer, new_columns):
+    """Rewrite the behavioural file with more columns
+
+    Rows can have columns the first row did not have (e.g., trials.thisN after the practice trials, or mouse_md), so
+    the rows saved so far are written again with the new header. This only happens when a new column appears.
+    """
+
+    data_writer['file'].close()
+    with open(data_writer['path'], newline = '') as f:
+        rows = list(csv.DictReader(f))
+    with open(data_writer['path'] + '.tmp', 'w', newline = '') as f:
+        writer = csv.DictWriter(f, fieldnames = data_writer['columns'] + new_columns, restval = '')
+        writer.writeheader()
+        writer.writerows(rows)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(data_writer['path'] + '.tmp', data_writer['path'])
+    data_writer['file'] = open(data_writer['path'], 'a', newline = '')
+    new_data_writer(data_writer, data_writer['columns'] + new_columns)
+
+def write_data_row(data_writer, row, fsync_every = 10):
+    """Append one row (e.g., ThisExp.entries[-1]) to the behavioural file
+
+    The row is flushed straight away, so it is not lost if PsychoPy crashes. Forcing it to the disk (fsync) is slower,
+    so we only do that every fsync_every rows.
+    The columns are those of the first row; if a later row has new columns, the file is rewritten with them (see add_data_columns).
+    """
+
+    if data_writer['writer'] is None:
+        new_data_writer(data_writer, list(row.keys()))
+        data_writer['writer'].writeheader()
+    new_columns = [column for column in row if column not in data_writer['columns']]
+    if new_columns:
+        add_data_columns(data_writer, new_columns)
+    data_writer['writer'].writerow(row)
+    data_writer['file'].flush()
+    data_writer['rows'] += 1
+    if data_writer['rows'] % fsync_every == 0:
+        os.fsync(data_writer['file'].fileno())
+
+def close_data_writer(data_writer, sidecar = False):
+    """Close the behavioural file, and save a columnar copy (.parquet) if sidecar is True
+
+    The .parquet file is much faster to load for analysis (pandas.read_parquet), but it needs pandas and pyarrow
+    """
+
+    if data_writer['file'] is None:
+        return
+    data_writer['file'].flush()
+    os.fsync(data_writer['file'].fileno())
+    data_writer['file'].close()
+    data_writer['file'] = None
+    if sidecar:
+        try:
+            import pandas
+            pandas.read_csv(data_writer['path']).to_parquet(os.path.splitext(data_writer['path'])[0] + '.parquet')
+        except ImportError as err:
+            print('WARNING: the .parquet file was not saved,', err)
+
+# Timing of the messages sent to the .EDF file
+
+def send_message_at(et_tracker, msg, msg_time):
+    # send a message to the .EDF file stamped at msg_time (core.getTime() clock) instead of now, using '<offset> <message>'
+    offset = (core.getTime() - msg_time) * 1000
+    et_tracker.sendMessage('%d %s' % (round(offset), msg))
+
+def script_time(ptb_time):
+    # a PTB timestamp (e.g., key.tDown of the PTB keyboard, which counts from an arbitrary point) -> core.getTime() clock
+    return ptb_time - (core.getTime(applyZero = False) - core.getTime())
+
+def flip_with_messages(win, et_tracker, flip_timing, *msgs):
+    """Flip the window and send msgs to the .EDF file, locked to the flip
+
+    The messages are sent from win.callOnFlip, i.e., right after the screen is updated, in the form '<offset> <message>',
+    where offset is the time (ms) between the flip and the moment the message is sent. DataViewer subtracts the offset,
+    so the message is timestamped at the flip.
+    flip_timing: kept by the script, {'queue': [], 'flip_time': None, 'offsets': [], 'corrected': []}
+    returns the time of the flip (core.getTime() clock)
+    """
+
+    flip_timing['queue'].extend(msgs)
+    win.timeOnFlip(flip_timing, 'flip_time')
+    win.callOnFlip(send_flip_messages, et_tracker, flip_timing)
+    win.flip()
+    # how late the messages would have been if we had sent them after win.flip(), for the timing report
+    flip_timing['corrected'].append((core.getTime() - flip_timing['flip_time']) * 1000)
+    return flip_timing['flip_time']
+
+def send_flip_messages(et_tracker, flip_timing):
+    # called by PsychoPy right after the flip (see flip_with_messages)
+    offset = (core.getTime() - flip_timing['flip_time']) * 1000
+    for msg in flip_timing['queue']:
+        et_tracker.sendMessage('%d %s' % (round(offset), msg))
+    del flip_timing['queue'][:]
+    flip_timing['offsets'].append(offset)
+
+def report_flip_timing(et_tracker, flip_timing):
+    # summary of how much flip_with_messages corrected the onset messages, in the console and in the .EDF file
+    if len(flip_timing['corrected']) == 0:
+        return
+    corrected = numpy.array(flip_timing['corrected'])
+    offsets = numpy.array(flip_timing['offsets'])
+    report = 'FLIP_TIMING n %d corrected_mean %.3f corrected_max %.3f offset_mean %.3f offset_max %.3f' % (
+        len(corrected), corrected.mean(), corrected.max(), offsets.mean(), offsets.max())
+    print(report)
+    et_tracker.sendMessage(report)
+
+# Online data quality, from the samples sent over the link
+
+def read_link_samples(et_tracker, link_buffer):
+    """Read the samples and events sent over the link since the last call and store them in the ring buffer (link_buffer)
+
+    pylink is not thread-safe, so this runs on the main thread: call it between frames (or in any waiting loop) while
+    we are recording. The link keeps the samples in a queue, so none are lost between calls as long as the loop runs
+    often enough (the queue holds a few seconds of samples).
+    link_buffer: kept by the script, {'running': False, 'eye_used': 0, 'write': 0, 'trial_start': 0, 'start_time': 0, 'blinks': 0}
+    plus one preallocated array per column ('time', 'x', 'y', 'pupil'), the size of the ring buffer
+    """
+
+    if not link_buffer['running']:
+        return
+    size = len(link_buffer['time'])
+    while True:
+        item_type = et_tracker.getNextData()
+        if not item_type:
+            return
+        if item_type == pylink.SAMPLE_TYPE:
+            sample = et_tracker.getFloatData()
+            if sample.getTime() < link_buffer['start_time']: # left over in the link queue from before this trial
+                continue
+            if link_buffer['eye_used'] == 1 and sample.isRightSample():
+                eye = sample.getRightEye()
+            elif link_buffer['eye_used'] in [0, 2] and sample.isLeftSample():
+                eye = sample.getLeftEye()
+            else:
+                continue
+            i = link_buffer['write'] % size
+            link_buffer['time'][i] = sample.getTime()
+            link_buffer['x'][i], link_buffer['y'][i] = eye.getGaze()
+            link_buffer['pupil'][i] = eye.getPupilSize()
+            link_buffer['write'] += 1
+        elif item_type == pylink.ENDBLINK:
+            # in binocular recordings there is one ENDBLINK per eye, we only count the eye of the samples
+            blink = et_tracker.getFloatData()
+            if blink.getEye() == (1 if link_buffer['eye_used'] == 1 else 0):
+                link_buffer['blinks'] += 1
+
+def start_quality_monitor(et_tracker, link_buffer):
+    # start following the link samples (see read_link_samples), call it after startRecording
+    link_buffer['trial_start'] = link_buffer['write']
+    link_buffer['start_time'] = et_tracker.trackerTime()
+    link_buffer['eye_used'] = et_tracker.eyeAvailable()
+    link_buffer['blinks'] = 0
+    link_buffer['running'] = True
+
+def stop_quality_monitor(et_tracker, link_buffer, trial_id):
+    """Stop reading link samples and show the data quality of the trial in the console
+
+    returns a dictionary with precision (RMS sample-to-sample, in pixels), data loss (proportion of samples
+    without gaze) and blink rate (blinks per minute), or None if there is nothing to report
+    """
+
+    if not link_buffer['running']:
+        return None
+    read_link_samples(et_tracker, link_buffer) # what is left in the link queue
+    link_buffer['running'] = False
+
+    # samples of this trial (only the last size ones if the trial was longer than the buffer)
+    size = len(link_buffer['time'])
+    first = max(link_buffer['trial_start'], link_buffer['write'] - size)
+    indices = numpy.arange(first, link_buffer['write']) % size
+    if len(indices) < 2:
+        return None
+    sample_time = link_buffer['time'][indices]
+    x = link_buffer['x'][indices]
+    y = link_buffer['y'][indices]
+    pupil = link_buffer['pupil'][indices]
+
+    valid = (x != pylink.MISSING_DATA) & (y != pylink.MISSING_DATA) & (pupil > 0)
+    both_valid = valid[1:] & valid[:-1]
+    if both_valid.any():
+        s2s = numpy.diff(x) ** 2 + numpy.diff(y) ** 2
+        rms_s2s = float(numpy.sqrt(numpy.mean(s2s[both_valid])))
+    else:
+        rms_s2s = float('nan')
+    duration = (sample_time[-1] - sample_time[0]) / 1000.0
+    quality = {'rms_s2s': rms_s2s,
+               'data_loss': float(1 - valid.mean()),
+               'blink_rate': link_buffer['blinks'] / duration * 60 if duration > 0 else float('nan')}
+    print('trial %d - precision (RMS-S2S): %.2f px, data loss: %.1f %%, blinks: %.1f per min' %
+          (trial_id, quality['rms_s2s'], quality['data_loss'] * 100, quality['blink_rate']))
+    return quality